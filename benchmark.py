@@ -0,0 +1,519 @@
+"""Throughput benchmarks for the mailsorter hot paths.
+
+Usage:
+    python benchmark.py                 # extraction on 1 KB, 1 MB and 100 MB corpora
+    python benchmark.py --sizes 1K 1M   # pick corpus sizes
+    python benchmark.py sessions        # handler latency with the session store vs a dict
+    python benchmark.py persistence     # conversation persistence flush cost, restart time and large batches
+    python benchmark.py routing         # button routing: dict router vs a filters.Regex handler chain
+    python benchmark.py hotpaths --save benchmark_baseline.json
+    python benchmark.py hotpaths --check benchmark_baseline.json [--tolerance 0.2]
+
+The hotpaths suite times extraction, password detection and rendering on
+seeded synthetic corpora and records throughput and peak memory. With
+--check it exits non-zero when a result is slower or uses more memory than
+the baseline by more than the tolerance. Throughput is compared as measured
+when the baseline was recorded on the same machine (Python version, CPU
+model and count), and otherwise scaled by the two machines' speeds on the
+fixed legacy extractor.
+"""
+import argparse
+import asyncio
+import copy
+import datetime
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import mailcore
+import mailstr
+from mailcore import extract_emails
+from telegram import Chat, Message, Update, User
+from telegram.ext import MessageHandler, filters
+
+SIZES = {"1K": 1024, "1M": 1024 ** 2, "10M": 10 * 1024 ** 2, "100M": 100 * 1024 ** 2}
+CHUNK_SIZE = 1024 ** 2
+
+def legacy_extract_emails(text):
+    """The original two-pass, set-based extractor kept as the reference."""
+    email_regex = r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}'
+    emails = re.findall(email_regex, text)
+    unique_emails = list(set(emails))
+
+    def is_valid_email(email):
+        return re.match(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$', email)
+
+    return [email for email in unique_emails if is_valid_email(email)]
+
+def make_corpus(size, seed=1234):
+    """Build a paste-like corpus of roughly `size` characters: one address per line plus noise."""
+    rng = random.Random(seed)
+    domains = ["gmail.com", "yahoo.com", "outlook.com", "proton.me", "mail.example.org"]
+    words = ["order", "ref", "id", "user", "note", "paid", "pending", "ok"]
+    lines = []
+    total = 0
+    while total < size:
+        local = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz0123456789") for _ in range(rng.randint(5, 12)))
+        line = f"{rng.choice(words)} {rng.randint(1, 99999)} - {local}@{rng.choice(domains)} | {rng.choice(words)}"
+        lines.append(line)
+        total += len(line) + 1
+    return "\n".join(lines)[:size]
+
+def iter_chunks(text, size=CHUNK_SIZE):
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+def measure(func, arg, repeat):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(arg)
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+def bench_extraction(labels):
+    print(f"{'corpus':>8} {'legacy MB/s':>12} {'engine MB/s':>12} {'stream MB/s':>12} {'emails':>10}")
+    for label in labels:
+        size = SIZES[label]
+        text = make_corpus(size)
+        megabytes = len(text) / 1024 ** 2
+        repeat = 200 if size <= 1024 else (5 if size <= 1024 ** 2 else 1)
+        legacy, legacy_result = measure(legacy_extract_emails, text, repeat)
+        engine, engine_result = measure(extract_emails, text, repeat)
+        stream, stream_result = measure(lambda t: extract_emails(iter_chunks(t)), text, repeat)
+        # The legacy extractor predates domain validation
+        assert {e for e in legacy_result if mailcore.is_valid_domain(e.rpartition("@")[2])} == set(engine_result) == set(stream_result)
+        print(
+            f"{label:>8} {megabytes / legacy:>12.1f} {megabytes / engine:>12.1f} "
+            f"{megabytes / stream:>12.1f} {len(engine_result):>10}"
+        )
+
+LOCAL_CHARS = "abcdefghijklmnopqrstuvwxyz0123456789._-"
+WORDS = [
+    "the", "order", "was", "shipped", "to", "customer", "please", "confirm", "invoice",
+    "reference", "account", "renewal", "pending", "thanks", "regards", "support", "team",
+]
+
+def make_dense(size, rng):
+    """One address per line, like an exported lead list."""
+    return make_corpus(size, rng.randrange(1 << 30))
+
+def make_sparse(size, rng):
+    """Prose with an address roughly every few hundred words."""
+    parts = []
+    total = 0
+    while total < size:
+        if rng.random() < 0.005:
+            word = f"{''.join(rng.choice(LOCAL_CHARS[:36]) for _ in range(8))}@example{rng.randint(1, 50)}.com"
+        else:
+            word = rng.choice(WORDS)
+        parts.append(word)
+        total += len(word) + 1
+    return " ".join(parts)[:size]
+
+def make_adversarial(size, rng):
+    """Inputs that stress regex backtracking: long '@'-less runs, '@' chains, dotted domains without a TLD."""
+    generators = [
+        lambda: "".join(rng.choice(LOCAL_CHARS) for _ in range(rng.randint(500, 5000))),
+        lambda: "@".join("".join(rng.choice(LOCAL_CHARS) for _ in range(rng.randint(1, 4))) for _ in range(200)),
+        lambda: "x@" + "a." * rng.randint(50, 500),
+        lambda: "-".join(f"u{i}@d{i}.com" for i in range(50)),
+        lambda: "." * rng.randint(100, 1000) + "@" + "." * rng.randint(100, 1000),
+    ]
+    parts = []
+    total = 0
+    while total < size:
+        part = rng.choice(generators)()
+        parts.append(part)
+        total += len(part) + 1
+    return " ".join(parts)[:size]
+
+def make_paste(size, rng):
+    """A multi-megabyte paste mixing lists, prose and noise."""
+    makers = [make_dense, make_sparse, make_adversarial]
+    block = 256 * 1024
+    return "\n".join(rng.choice(makers)(block, rng) for _ in range(max(1, size // block)))[:size]
+
+HOTPATH_CORPORA = {
+    "dense": (make_dense, 1024 ** 2),
+    "sparse": (make_sparse, 1024 ** 2),
+    "adversarial": (make_adversarial, 1024 ** 2),
+    "paste": (make_paste, 8 * 1024 ** 2),
+}
+
+def make_detector(rng, entries=300):
+    """The shipped password table padded with synthetic entries, as the table is expected to grow."""
+    patterns = mailcore.load_password_patterns(mailcore.PASSWORD_PATTERNS_FILE)
+    while len(patterns) < entries:
+        word = "".join(rng.choice(LOCAL_CHARS[:36]) for _ in range(rng.randint(6, 12)))
+        patterns.append({"pattern": word, "prime_pass": word, "mail_pass": word})
+    return mailcore.PasswordDetector(patterns)
+
+def measure_hotpath(func, arg, size, repeat):
+    """Return best-of-`repeat` throughput in MB/s and peak traced memory in KiB."""
+    seconds, _ = measure(func, arg, repeat)
+    tracemalloc.start()
+    try:
+        func(arg)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"throughput_mb_s": round(size / 1024 ** 2 / seconds, 3), "peak_kib": round(peak / 1024, 1)}
+
+def run_hotpaths(repeat=5, seed=2024):
+    results = {}
+    detector = make_detector(random.Random(seed))
+    config = dict(mailcore.DEFAULT_CONFIG, prime_pass="prime123", mail_pass="prime123")
+    for name, (make, size) in HOTPATH_CORPORA.items():
+        text = make(size, random.Random(seed))
+        emails = tuple(extract_emails(text))
+        output_size = len(mailcore.format_output(emails, config)[0]) if emails else 1
+        results[f"extract/{name}"] = measure_hotpath(extract_emails, text, len(text), repeat)
+        results[f"detect/{name}"] = measure_hotpath(detector.rank, text, len(text), repeat)
+        if emails:
+            results[f"render/{name}"] = measure_hotpath(lambda e: mailcore.format_output(e, config), emails, output_size, repeat)
+            for mode, label in (("domain", "sort"), ("grouped", "group")):
+                sort_config = dict(config, sort=mode)
+                results[f"{label}/{name}"] = measure_hotpath(
+                    lambda e: mailcore.arrange_emails(e, sort_config), emails, output_size, repeat
+                )
+    return results
+
+def compare(results, baseline, tolerance, scale=1.0):
+    """Print results against the baseline and return the names of regressed benchmarks.
+    
+    Baseline throughput is multiplied by scale, this machine's speed relative
+    to the one that recorded the baseline; with scale None only peak memory
+    is compared.
+    """
+    regressions = []
+    print(f"{'benchmark':>20} {'MB/s':>9} {'base':>9} {'delta':>7} {'peak KiB':>10} {'base':>10} {'delta':>7}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:>20} {result['throughput_mb_s']:>9.1f} {'new':>9}")
+            continue
+        expected = base["throughput_mb_s"] * scale if scale is not None else None
+        speed = result["throughput_mb_s"] / expected - 1 if expected is not None else 0.0
+        memory = result["peak_kib"] / base["peak_kib"] - 1 if base["peak_kib"] else 0.0
+        failed = speed < -tolerance or memory > tolerance
+        if failed:
+            regressions.append(name)
+        expected_column = f"{expected:>9.1f} {speed:>+7.1%}" if expected is not None else f"{'-':>9} {'-':>7}"
+        print(
+            f"{name:>20} {result['throughput_mb_s']:>9.1f} {expected_column} "
+            f"{result['peak_kib']:>10.1f} {base['peak_kib']:>10.1f} {memory:>+7.1%}{'  REGRESSION' if failed else ''}"
+        )
+    return regressions
+
+def cpu_model():
+    """Return the CPU model name where the OS reports it, else platform.processor()."""
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as handle:
+            for line in handle:
+                if line.startswith("model name"):
+                    return line.partition(":")[2].strip()
+    except OSError:
+        pass
+    return platform.processor() or "unknown CPU"
+
+def machine_info():
+    """What a throughput baseline depends on besides the code: interpreter, CPU and its count."""
+    return {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count(), "cpu": cpu_model()}
+
+def measure_reference(repeat=5, seed=2024):
+    """Throughput in MB/s of legacy_extract_emails on a fixed corpus.
+    
+    The legacy extractor lives in this file and never changes with the tree,
+    so its speed measures the machine; baselines store it to scale throughput
+    when they are checked on another machine.
+    """
+    text = make_corpus(1024 ** 2, seed)
+    seconds, _ = measure(legacy_extract_emails, text, repeat)
+    return round(len(text) / 1024 ** 2 / seconds, 3)
+
+def bench_hotpaths(save=None, check=None, tolerance=0.2):
+    results = run_hotpaths()
+    reference = measure_reference()
+    if check:
+        with open(check, encoding="utf-8") as handle:
+            saved = json.load(handle)
+        print(
+            f"Baseline: Python {saved.get('python', '?')} on {saved.get('machine', '?')}, "
+            f"{saved.get('cpus', '?')} CPUs ({saved.get('cpu', 'unknown CPU')})"
+        )
+        if all(saved.get(key) == value for key, value in machine_info().items()):
+            scale = 1.0
+            print("Same machine: throughput is compared as measured\n")
+        elif saved.get("reference_mb_s"):
+            scale = reference / saved["reference_mb_s"]
+            print(
+                f"Other machine: baseline throughput is scaled by {scale:.2f}, this machine's speed on the "
+                "reference extractor relative to the baseline's\n"
+            )
+        else:
+            scale = None
+            print("Other machine and no reference speed in the baseline: only peak memory is compared\n")
+        regressions = compare(results, saved["results"], tolerance, scale)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) regressed beyond {tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+    else:
+        for name, result in results.items():
+            print(f"{name:>20} {result['throughput_mb_s']:>9.1f} MB/s {result['peak_kib']:>10.1f} KiB peak")
+    if save:
+        with open(save, "w", encoding="utf-8") as handle:
+            json.dump(
+                {**machine_info(), "platform": platform.platform(), "reference_mb_s": reference, "results": results},
+                handle,
+                indent=2,
+            )
+        print(f"Saved baseline to {save}")
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+async def run_session_workload(sessions, users, updates, rng):
+    """Replay handler-style session access and return per-update latencies in seconds.
+    
+    Each update yields to the event loop once, like a handler awaiting the Bot
+    API, so time the flusher spends on the loop shows up in the latencies.
+    """
+    latencies = []
+    store = isinstance(sessions, mailstr.SessionStore)
+    for user_id in range(users):
+        sessions[user_id] = {"authenticated": True, "config": mailcore.DEFAULT_CONFIG.copy()}
+    for i in range(updates):
+        user_id = rng.randrange(users)
+        started = time.perf_counter()
+        if store:
+            # As PerUserUpdateProcessor does before the handlers run
+            await sessions.prefetch(user_id)
+        # Same pattern as start/show_configuration/update_configuration
+        if user_id in sessions and sessions[user_id].get("authenticated", False):
+            config = sessions[user_id]["config"]
+            if i % 10 == 0:
+                config["validity"] = str(i)
+                if store:
+                    sessions.save(user_id)
+        await asyncio.sleep(0)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+async def bench_session_store(sessions, users, updates):
+    flusher = asyncio.create_task(sessions.run_flusher()) if isinstance(sessions, mailstr.SessionStore) else None
+    try:
+        return await run_session_workload(sessions, users, updates, random.Random(99))
+    finally:
+        if flusher:
+            flusher.cancel()
+
+def bench_sessions(users=5000, updates=200000):
+    with tempfile.TemporaryDirectory() as directory:
+        stores = {
+            "dict": {},
+            "sqlite store": mailstr.SessionStore(
+                mailstr.SQLiteSessionBackend(os.path.join(directory, "warm.sqlite3")),
+                flush_interval=0.05,
+            ),
+            # A cache half the size of the user base forces reads through to SQLite
+            "sqlite 50% hit": mailstr.SessionStore(
+                mailstr.SQLiteSessionBackend(os.path.join(directory, "cold.sqlite3")),
+                cache_size=users // 2,
+                flush_interval=0.05,
+            ),
+        }
+        print(f"{'store':>14} {'p50 us':>8} {'p99 us':>8} {'max us':>9}")
+        for name, sessions in stores.items():
+            latencies = asyncio.run(bench_session_store(sessions, users, updates))
+            print(
+                f"{name:>14} {statistics.median(latencies) * 1e6:>8.2f} "
+                f"{percentile(latencies, 0.99) * 1e6:>8.2f} {max(latencies) * 1e6:>9.1f}"
+            )
+            if isinstance(sessions, mailstr.SessionStore):
+                sessions.backend.close()
+
+def make_user_data(user_id, rng):
+    """user_data as send_email_output leaves it: the packed batch for Copy Again and the message ids to clear."""
+    emails = tuple(f"user{user_id}.{i}@example{rng.randint(1, 9)}.com" for i in range(rng.randint(20, 60)))
+    return {
+        "last_emails": mailstr.pack_emails(emails),
+        "output_message_ids": [rng.randrange(10 ** 6) for _ in range(2)],
+        "input_message_ids": [rng.randrange(10 ** 6)],
+    }
+
+async def persistence_run(persistence, user_data, batched):
+    """Hand one update_persistence() run to the persistence and wait for it to be written.
+    
+    Batched, the calls are started together as Application.update_persistence()
+    does; otherwise every update is written on its own.
+    """
+    calls = []
+    for user_id, data in user_data.items():
+        calls.append(persistence.update_user_data(user_id, data))
+        calls.append(persistence.update_conversation("mailsorter", (user_id, user_id), mailstr.CLEAR_MESSAGES))
+    if batched:
+        await asyncio.gather(*calls)
+        await asyncio.gather(*persistence.write_tasks)
+    else:
+        for call in calls:
+            await call
+            await persistence.write()
+
+async def bench_persistence_flush(directory, touched_users):
+    print(f"{'users/run':>10} {'batched us/update':>18} {'per-update us/update':>21}")
+    rng = random.Random(7)
+    for users in touched_users:
+        user_data = {user_id: make_user_data(user_id, rng) for user_id in range(users)}
+        timings = []
+        for batched in (True, False):
+            persistence = mailstr.SQLitePersistence(os.path.join(directory, f"flush-{users}-{batched}.sqlite3"))
+            await persistence_run(persistence, user_data, batched)  # Create the tables and rows first
+            started = time.perf_counter()
+            await persistence_run(persistence, user_data, batched)
+            timings.append((time.perf_counter() - started) / (2 * users))
+            await persistence.flush()
+        print(f"{users:>10} {timings[0] * 1e6:>18.1f} {timings[1] * 1e6:>21.1f}")
+
+async def bench_persistence_restart(directory, stored_users):
+    print(f"{'stored users':>13} {'restart ms':>11} {'database KiB':>13}")
+    rng = random.Random(8)
+    for users in stored_users:
+        path = os.path.join(directory, f"restart-{users}.sqlite3")
+        persistence = mailstr.SQLitePersistence(path)
+        for start in range(0, users, 10000):
+            user_data = {user_id: make_user_data(user_id, rng) for user_id in range(start, min(users, start + 10000))}
+            await persistence_run(persistence, user_data, True)
+        await persistence.flush()
+        # What Application.initialize() loads before the first update is handled
+        started = time.perf_counter()
+        persistence = mailstr.SQLitePersistence(path)
+        await persistence.get_user_data()
+        await persistence.get_chat_data()
+        await persistence.get_conversations("mailsorter")
+        elapsed = time.perf_counter() - started
+        await persistence.flush()
+        print(f"{users:>13} {elapsed * 1000:>11.1f} {os.path.getsize(path) / 1024:>13.0f}")
+
+async def bench_persistence_batch(directory, batch_sizes, pastes=5):
+    """Cost of one paste in accumulate mode with a large batch already collected.
+    
+    After every update the Application deep-copies the user's user_data and
+    hands the copy to update_user_data(). "in user_data" is that cost with
+    the batch stored there; "open_batches" keeps it out, as the handlers do.
+    """
+    print(f"{'batch emails':>13} {'batch KiB':>10} {'in user_data ms/paste':>22} {'open_batches ms/paste':>22}")
+    for size in batch_sizes:
+        batch = dict.fromkeys(f"user{i}.{i % 977}@example{i % 9}.com" for i in range(size))
+        raw = mailstr.batch_bytes(batch)
+        layouts = (
+            {"batch": batch, "batch_bytes": raw, "batch_message_ids": list(range(2 * pastes))},
+            {"batch_message_ids": list(range(2 * pastes))},
+        )
+        timings = []
+        for index, user_data in enumerate(layouts):
+            persistence = mailstr.SQLitePersistence(os.path.join(directory, f"batch-{size}-{index}.sqlite3"))
+            await persistence_run(persistence, {1: copy.deepcopy(user_data)}, True)  # Create the tables and row
+            started = time.perf_counter()
+            for _ in range(pastes):
+                await persistence_run(persistence, {1: copy.deepcopy(user_data)}, True)
+            timings.append((time.perf_counter() - started) / pastes)
+            await persistence.flush()
+        print(f"{size:>13} {raw / 1024:>10.0f} {timings[0] * 1000:>22.2f} {timings[1] * 1000:>22.2f}")
+
+def bench_persistence(touched_users=(10, 100, 1000), stored_users=(1000, 10000, 100000), batch_sizes=(1000, 10000, 100000)):
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(bench_persistence_flush(directory, touched_users))
+        print()
+        asyncio.run(bench_persistence_restart(directory, stored_users))
+        print()
+        asyncio.run(bench_persistence_batch(directory, batch_sizes))
+
+def make_button_updates(labels, count, rng, free_text=0.1):
+    """A synthetic update stream: mostly button presses, with some free text that matches no button."""
+    user = User(1, "bench", False)
+    chat = Chat(1, Chat.PRIVATE)
+    date = datetime.datetime.now(datetime.timezone.utc)
+    updates = []
+    for update_id in range(count):
+        text = f"user{update_id}@example.com" if rng.random() < free_text else rng.choice(labels)
+        updates.append(Update(update_id, message=Message(update_id, date, chat, from_user=user, text=text)))
+    return updates
+
+def regex_chain(labels):
+    """One MessageHandler(filters.Regex) per button, as the states were declared before the router."""
+    return [MessageHandler(filters.Regex(f"^{re.escape(label)}$"), mailstr.show_main_menu) for label in labels]
+
+def first_match(handlers, update):
+    # What ConversationHandler.check_update does with a state's handler list
+    for handler in handlers:
+        if (check := handler.check_update(update)) is not None and check is not False:
+            return check
+    return None
+
+STATE_NAMES = {
+    mailstr.MAIN_MENU: "MAIN_MENU",
+    mailstr.CONFIG: "CONFIG",
+    mailstr.INPUT_EMAILS: "INPUT_EMAILS",
+    mailstr.CLEAR_MESSAGES: "CLEAR_MESSAGES",
+}
+
+def bench_routing(count=200000, repeat=5):
+    rng = random.Random(18)
+    print(f"{'state':>15} {'buttons':>8} {'regex chain us':>15} {'router us':>10} {'speedup':>8}")
+    for state, routes in mailstr.BUTTON_ROUTES.items():
+        labels = list(routes)
+        updates = make_button_updates(labels, count, rng)
+        chain = regex_chain(labels)
+        router = [mailstr.ButtonRouter(routes)]
+        timings = []
+        for handlers in (chain, router):
+            best = float("inf")
+            for _ in range(repeat):
+                started = time.perf_counter()
+                for update in updates:
+                    first_match(handlers, update)
+                best = min(best, time.perf_counter() - started)
+            timings.append(best / count)
+        name = STATE_NAMES[state]
+        print(
+            f"{name:>15} {len(labels):>8} {timings[0] * 1e6:>15.2f} {timings[1] * 1e6:>10.2f} "
+            f"{timings[0] / timings[1]:>7.1f}x"
+        )
+
+SUITES = {"extraction", "sessions", "hotpaths", "persistence", "routing"}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    # No choices= here: argparse checks a list default against choices as one value and rejects it
+    parser.add_argument("suites", nargs="*", metavar="suite", help=f"one of {', '.join(sorted(SUITES))} (default: extraction)")
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=["1K", "1M", "100M"])
+    parser.add_argument("--save", metavar="PATH", help="write hotpaths results as a JSON baseline")
+    parser.add_argument("--check", metavar="PATH", help="fail if hotpaths regress against this baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression (default 0.2)")
+    args = parser.parse_args()
+    if unknown := set(args.suites) - SUITES:
+        parser.error(f"unknown suite(s): {', '.join(sorted(unknown))}")
+    args.suites = args.suites or ["extraction"]
+    if "extraction" in args.suites:
+        bench_extraction(args.sizes)
+    if "sessions" in args.suites:
+        bench_sessions()
+    if "persistence" in args.suites:
+        bench_persistence()
+    if "routing" in args.suites:
+        bench_routing()
+    if "hotpaths" in args.suites:
+        bench_hotpaths(args.save, args.check, args.tolerance)
+
+if __name__ == "__main__":
+    main()
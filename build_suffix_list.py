@@ -0,0 +1,59 @@
+"""Build public_suffixes.txt.gz, the suffix table mailcore.py validates email domains against.
+
+Usage:
+    python build_suffix_list.py                                   # from the system copy
+    python build_suffix_list.py public_suffix_list.dat -o public_suffixes.txt.gz
+
+Reads a Public Suffix List (https://publicsuffix.org/list/) and keeps the
+ICANN section: the delegated TLDs and the suffixes registries sell under
+them. The private section (blogspot.com, github.io and the like) is left
+out, since nobody hosts mail directly on those. Internationalized rules are
+stored in their punycode (xn--) form, which is what appears in pasted
+addresses, so the file is plain ASCII, one rule per line.
+"""
+import argparse
+import gzip
+import os
+
+DEFAULT_SOURCE = "/usr/share/publicsuffix/public_suffix_list.dat"
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "public_suffixes.txt.gz")
+
+def to_ascii_label(label):
+    """Punycode-encode a label that is not plain ASCII, keeping the ! and * rule markers."""
+    prefix = label[0] if label[0] in "!*" else ""
+    name = label[len(prefix):]
+    if name.isascii():
+        return label
+    return prefix + "xn--" + name.encode("punycode").decode("ascii")
+
+def read_icann_rules(path):
+    rules = []
+    in_icann = False
+    with open(path, encoding="utf-8") as handle:
+        for line in handle:
+            line = line.strip()
+            if line == "// ===BEGIN ICANN DOMAINS===":
+                in_icann = True
+            elif line == "// ===END ICANN DOMAINS===":
+                break
+            elif in_icann and line and not line.startswith("//"):
+                # Rules end at the first whitespace
+                rule = line.split()[0].lower()
+                rules.append(".".join(to_ascii_label(label) for label in rule.split(".")))
+    return rules
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", nargs="?", default=DEFAULT_SOURCE, help=f"Public Suffix List file (default: {DEFAULT_SOURCE})")
+    parser.add_argument("--output", "-o", default=DEFAULT_OUTPUT)
+    args = parser.parse_args()
+    rules = sorted(set(read_icann_rules(args.source)))
+    if not rules:
+        parser.error(f"no ICANN rules found in {args.source}")
+    # mtime=0 keeps the output byte-identical for the same list
+    with open(args.output, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", mtime=0, filename="") as handle:
+        handle.write(("\n".join(rules) + "\n").encode("ascii"))
+    print(f"Wrote {len(rules)} rules to {args.output} ({os.path.getsize(args.output)} bytes)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,606 @@
+"""Latency and load tests for mailstr.py against a local stand-in for the Telegram Bot API.
+
+The bot runs in-process with its Bot API base URL pointed at FakeBotAPI, so
+every request it makes is answered locally and timed.
+
+Usage:
+    python loadtest.py latency                  # update-to-reply latency, polling vs webhook
+    python loadtest.py latency --updates 500 --rtt 0.05
+    python loadtest.py flow                     # full conversation for 100, 500, 1000 and 2000 users
+    python loadtest.py flow --users 5000 --mode webhook --think 1 --rate-limits
+    python loadtest.py calls                    # Bot API calls per batch, reply keyboard vs inline buttons
+    python loadtest.py shards --workers 1,2,4,8 --users 500  # flow throughput through mailshard.py
+
+The flow scenario walks every simulated user through /start, the password,
+"📧 Input Emails", a paste, "📋 Copy Again" and "🧹 Clear Messages", all users
+of a level at once. Outbound rate limits are lifted unless --rate-limits is
+given, so the numbers show what the worker itself sustains rather than
+Telegram's 30 messages per second.
+
+The calls scenario sends one paste per output size (one message, several
+messages, a document), then "📋 Copy Again" and "🧹 Clear Messages", once
+as reply keyboard text and once as inline button presses, and counts the
+Bot API requests and request bytes each batch costs.
+
+The shards scenario runs the flow against `mailshard.py` with each number
+of workers, all sharing one SQLite session database in a temporary
+directory, and reports throughput relative to a single worker. The load
+generator and FakeBotAPI share the machine with the workers, so scaling
+flattens once they saturate the CPUs.
+"""
+import argparse
+import asyncio
+import email.parser
+import itertools
+import json
+import os
+import random
+import resource
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import gc
+import time
+import urllib.parse
+
+# Keep load test sessions out of the real session database
+os.environ.setdefault("SESSION_BACKEND", "memory")
+
+import httpx
+
+import mailstr
+
+FAKE_TOKEN = "123456:FAKE-TOKEN"
+BOT_USER = {
+    "id": 123456,
+    "is_bot": True,
+    "first_name": "Fake",
+    "username": "fake_mailsorter_bot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False,
+}
+
+class FakeBotAPI:
+    """Minimal HTTP server implementing the Bot API methods the bot uses."""
+
+    def __init__(self, rtt=0.0):
+        self.rtt = rtt  # Simulated network round trip added to every API call
+        self.server = None
+        self.base_url = None
+        self.updates = []
+        self.updates_changed = asyncio.Event()
+        # Apart from the ids of user messages (see make_text_update), so deletions are counted right
+        self.message_ids = itertools.count(1_000_000_000)
+        self.calls = {}
+        self.request_bytes = {}  # method -> bytes of request bodies received
+        self.deleted = 0  # Messages the bot asked to delete
+        self.inline_messages = {}  # chat_id -> last message sent with an inline keyboard
+        self.reply_waiters = {}  # chat_id -> (future, final) resolved with the reply time
+        self.webhook_url = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, "127.0.0.1", 0)
+        host, port = self.server.sockets[0].getsockname()[:2]
+        self.base_url = f"http://{host}:{port}"
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def push_update(self, update):
+        """Queue an update for the next getUpdates call."""
+        self.updates.append(update)
+        self.updates_changed.set()
+
+    def wait_reply(self, chat_id, final=False):
+        """Return a future resolved with the time of the bot's next reply in chat_id.
+        
+        With final, only a reply carrying a keyboard, or the answer to an inline
+        button press, counts: every handler ends its turn with one, so it marks
+        the last message of the bot's answer.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.reply_waiters.setdefault(chat_id, []).append((future, final))
+        return future
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                method = target.rsplit("/", 1)[-1].split("?", 1)[0]
+                self.request_bytes[method] = self.request_bytes.get(method, 0) + len(body)
+                params = self.parse_params(headers.get("content-type", ""), body)
+                # Half the round trip before handling the request, half before the response arrives
+                if self.rtt:
+                    await asyncio.sleep(self.rtt / 2)
+                result = await self.dispatch(method, params)
+                if self.rtt:
+                    await asyncio.sleep(self.rtt / 2)
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode()
+                    + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def parse_params(content_type, body):
+        if content_type.startswith("multipart/form-data"):
+            message = email.parser.BytesParser().parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode() + body
+            )
+            raw = {
+                part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+                for part in message.get_payload()
+            }
+            raw = {name: value.decode("utf-8", "replace") for name, value in raw.items()}
+        else:
+            raw = dict(urllib.parse.parse_qsl(body.decode("utf-8")))
+        params = {}
+        for name, value in raw.items():
+            try:
+                params[name] = json.loads(value)
+            except ValueError:
+                params[name] = value
+        return params
+
+    def make_message(self, chat_id, text=None):
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": str(text) if text is not None else None,
+        }
+
+    def record_reply(self, chat_id, has_keyboard):
+        waiting = []
+        for future, final in self.reply_waiters.pop(chat_id, []):
+            if final and not has_keyboard:
+                waiting.append((future, final))
+            elif not future.done():
+                future.set_result(time.perf_counter())
+        if waiting:
+            self.reply_waiters[chat_id] = waiting
+
+    async def dispatch(self, method, params):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            offset = params.get("offset", 0)
+            self.updates = [update for update in self.updates if update["update_id"] >= offset]
+            if not self.updates:
+                self.updates_changed.clear()
+                try:
+                    await asyncio.wait_for(self.updates_changed.wait(), params.get("timeout", 0) or 0.01)
+                except asyncio.TimeoutError:
+                    pass
+            return self.updates[:100]
+        if method in ("setWebhook", "deleteWebhook"):
+            self.webhook_url = params.get("url") if method == "setWebhook" else None
+            return True
+        if method in ("sendMessage", "sendDocument", "editMessageText"):
+            chat_id = params["chat_id"]
+            message = self.make_message(chat_id, params.get("text"))
+            if "inline_keyboard" in params.get("reply_markup", {}):
+                self.inline_messages[chat_id] = message
+            self.record_reply(chat_id, "reply_markup" in params)
+            return message
+        if method == "answerCallbackQuery":
+            # Query ids are "<chat id>:<n>", see make_callback_update
+            self.record_reply(int(params["callback_query_id"].split(":")[0]), True)
+            return True
+        if method in ("deleteMessage", "deleteMessages"):
+            self.deleted += len(params["message_ids"]) if method == "deleteMessages" else 1
+            return True
+        if method == "editMessageReplyMarkup":
+            return True
+        raise ValueError(f"FakeBotAPI does not implement {method}")
+
+update_ids = itertools.count(1)
+
+def make_text_update(user_id, text):
+    """Build a private-chat text update as Telegram would send it."""
+    update_id = next(update_ids)
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+def make_callback_update(api, user_id, data):
+    """Build the update Telegram sends when the user presses an inline button on the bot's last keyboard."""
+    update_id = next(update_ids)
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": f"{user_id}:{update_id}",
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "message": api.inline_messages[user_id],
+            "chat_instance": str(user_id),
+            "data": data,
+        },
+    }
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class BotUnderTest:
+    """Run the bot in-process against a FakeBotAPI in polling or webhook mode."""
+
+    def __init__(self, api, mode):
+        self.api = api
+        self.mode = mode
+        self.application = mailstr.build_application(FAKE_TOKEN, api.base_url)
+        self.secret = "loadtest-secret"
+        self.webhook_url = None
+        self.client = None
+
+    async def __aenter__(self):
+        # Same startup sequence as Application.run_polling/run_webhook
+        await self.application.initialize()
+        await self.application.post_init(self.application)
+        await self.application.start()
+        if self.mode == "webhook":
+            port = free_port()
+            self.webhook_url = f"http://127.0.0.1:{port}/telegram"
+            await self.application.updater.start_webhook(
+                listen="127.0.0.1",
+                port=port,
+                url_path="telegram",
+                webhook_url=self.webhook_url,
+                secret_token=self.secret,
+            )
+            # Thousands of users queue for the pool's connections, so wait instead of timing out
+            self.client = httpx.AsyncClient(timeout=60)
+        else:
+            await self.application.updater.start_polling(poll_interval=0.0, timeout=10)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.client:
+            await self.client.aclose()
+        await self.application.updater.stop()
+        await self.application.stop()
+        await self.application.shutdown()
+        await self.application.post_shutdown(self.application)
+
+    async def deliver(self, update):
+        """Hand an update to the bot the way Telegram would in this mode."""
+        if self.mode == "webhook":
+            # Telegram -> bot is one network leg
+            if self.api.rtt:
+                await asyncio.sleep(self.api.rtt / 2)
+            response = await self.client.post(
+                self.webhook_url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": self.secret}
+            )
+            response.raise_for_status()
+        else:
+            self.api.push_update(update)
+
+SHARD_START_TIMEOUT = 120  # Seconds for mailshard.py to start its workers and register the webhook
+
+def free_port_range(count):
+    """Return the first of `count` consecutive free local ports."""
+    while True:
+        base = free_port()
+        if base + count <= 65535 and all(port_is_free(port) for port in range(base + 1, base + count)):
+            return base
+
+def port_is_free(port):
+    with socket.socket() as sock:
+        try:
+            sock.bind(("127.0.0.1", port))
+            return True
+        except OSError:
+            return False
+
+class ShardedBot:
+    """Run mailshard.py with its workers against a FakeBotAPI and deliver updates to its ingress."""
+
+    def __init__(self, api, workers, directory, rate_limits=False):
+        self.api = api
+        self.workers = workers
+        self.directory = directory
+        self.rate_limits = rate_limits
+        self.secret = "loadtest-secret"
+        self.process = None
+        self.client = None
+        self.webhook_url = None
+
+    async def __aenter__(self):
+        port = free_port()
+        env = {
+            **os.environ,
+            "BOT_TOKEN": FAKE_TOKEN,
+            "BOT_API_URL": self.api.base_url,
+            "WEBHOOK_URL": f"http://127.0.0.1:{port}",
+            "WEBHOOK_SECRET": self.secret,
+            "SESSION_BACKEND": "sqlite",
+            "SESSION_DB": os.path.join(self.directory, "sessions.sqlite3"),
+            "METRICS_PORT": "0",
+        }
+        if not self.rate_limits:
+            env.update(OVERALL_MAX_RATE="0", CHAT_MAX_RATE="0", GROUP_MAX_RATE="0")
+        self.api.webhook_url = None
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "mailshard.py"),
+            "--workers", str(self.workers), "--listen", "127.0.0.1", "--port", str(port),
+            "--base-port", str(free_port_range(self.workers)),
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        # Worker 0 registers the webhook once it is up, and the ingress opens after every worker
+        deadline = time.perf_counter() + SHARD_START_TIMEOUT
+        while self.api.webhook_url is None or port_is_free(port):
+            if self.process.returncode is not None or time.perf_counter() > deadline:
+                raise RuntimeError(f"mailshard.py with {self.workers} worker(s) did not start")
+            await asyncio.sleep(0.1)
+        self.webhook_url = f"http://127.0.0.1:{port}/telegram"
+        self.client = httpx.AsyncClient(timeout=60, limits=httpx.Limits(max_connections=40))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.client:
+            await self.client.aclose()
+        if self.process.returncode is None:
+            self.process.send_signal(signal.SIGTERM)
+        await self.process.wait()
+
+    async def deliver(self, update):
+        response = await self.client.post(
+            self.webhook_url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": self.secret}
+        )
+        response.raise_for_status()
+
+async def check_webhook_secret(bot):
+    """The webhook must reject updates that do not carry the secret token."""
+    update = make_text_update(1, "/help")
+    for headers in ({}, {"X-Telegram-Bot-Api-Secret-Token": "wrong"}):
+        response = await bot.client.post(bot.webhook_url, json=update, headers=headers)
+        assert response.status_code == 403, f"webhook accepted a bad secret: {response.status_code}"
+
+async def measure_latency(mode, updates, rtt):
+    api = FakeBotAPI(rtt)
+    await api.start()
+    try:
+        async with BotUnderTest(api, mode) as bot:
+            if mode == "webhook":
+                await check_webhook_secret(bot)
+            latencies = []
+            for i in range(updates):
+                user_id = 1000 + i % 50
+                reply = api.wait_reply(user_id)
+                started = time.perf_counter()
+                await bot.deliver(make_text_update(user_id, "/help"))
+                latencies.append(await asyncio.wait_for(reply, 10) - started)
+            return latencies
+    finally:
+        await api.stop()
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def report(name, latencies):
+    print(
+        f"{name:>10} {statistics.median(latencies) * 1000:>8.2f} "
+        f"{percentile(latencies, 0.95) * 1000:>8.2f} {percentile(latencies, 0.99) * 1000:>8.2f}"
+    )
+
+async def run_latency(updates, rtt):
+    print(f"{'mode':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for mode in ("polling", "webhook"):
+        report(mode, await measure_latency(mode, updates, rtt))
+
+FLOW_REPLY_TIMEOUT = 120  # Seconds a simulated user waits for an answer before giving up
+
+def make_paste(user_id, rng):
+    """A pasted block of text with a few dozen addresses, as users send it."""
+    lines = []
+    for i in range(rng.randint(20, 60)):
+        address = f"user{user_id}.{i}@example{rng.randint(1, 9)}.com"
+        lines.append(rng.choice(["", "Contact: ", "- ", "mail "]) + address + rng.choice(["", ",", " (work)"]))
+    return "\n".join(lines)
+
+def flow_steps(user_id, rng):
+    return ["/start", mailstr.BOT_PASSWORD, "📧 Input Emails", make_paste(user_id, rng), "📋 Copy Again", "🧹 Clear Messages"]
+
+async def simulate_user(bot, user_id, delay, think, latencies):
+    """Walk one user through the whole conversation, timing each answer."""
+    rng = random.Random(user_id)
+    await asyncio.sleep(delay)
+    for text in flow_steps(user_id, rng):
+        reply = bot.api.wait_reply(user_id, final=True)
+        started = time.perf_counter()
+        await bot.deliver(make_text_update(user_id, text))
+        try:
+            latencies.append(await asyncio.wait_for(reply, FLOW_REPLY_TIMEOUT) - started)
+        except asyncio.TimeoutError:
+            return False
+        if think:
+            await asyncio.sleep(rng.uniform(0, 2 * think))
+    return True
+
+def rss_bytes():
+    """Resident set size of this process, or its peak where /proc is unavailable."""
+    try:
+        with open("/proc/self/statm") as handle:
+            return int(handle.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+async def measure_flow(bot, users, first_user_id, ramp, think):
+    gc.collect()
+    rss_before = rss_bytes()
+    latencies = []
+    started = time.perf_counter()
+    results = await asyncio.gather(*(
+        simulate_user(bot, first_user_id + i, ramp * i / users, think, latencies) for i in range(users)
+    ))
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    return {
+        "latencies": latencies,
+        "updates_per_second": len(latencies) / elapsed,
+        "failed": results.count(False),
+        "rss_per_user": (rss_bytes() - rss_before) / users,
+    }
+
+async def run_flow(levels, mode, rtt, ramp, think):
+    api = FakeBotAPI(rtt)
+    await api.start()
+    try:
+        async with BotUnderTest(api, mode) as bot:
+            print(
+                f"{'users':>7} {'updates/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'failed':>7} "
+                f"{'KiB/user':>9} {'user_data B/user':>17}"
+            )
+            for level, users in enumerate(levels, 1):
+                # Each level gets fresh user ids so every user starts logged out
+                result = await measure_flow(bot, users, level * 10_000_000, ramp, think)
+                mailstr.user_data_sweeper.sweep(bot.application)
+                held = mailstr.user_data_sweeper.stats()
+                latencies = result["latencies"] or [0.0]
+                print(
+                    f"{users:>7} {result['updates_per_second']:>10.1f} "
+                    f"{statistics.median(latencies) * 1000:>8.2f} {percentile(latencies, 0.95) * 1000:>8.2f} "
+                    f"{percentile(latencies, 0.99) * 1000:>8.2f} {result['failed']:>7} "
+                    f"{result['rss_per_user'] / 1024:>9.1f} {held['bytes'] / max(held['users'], 1):>17.0f}"
+                )
+    finally:
+        await api.stop()
+
+async def run_shards(worker_counts, users, ramp, think, rate_limits):
+    api = FakeBotAPI()
+    await api.start()
+    try:
+        print(f"{os.cpu_count()} CPU(s), {users} users per run")
+        print(
+            f"{'workers':>8} {'updates/s':>10} {'speedup':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'failed':>7}"
+        )
+        baseline = None
+        for run, workers in enumerate(worker_counts, 1):
+            with tempfile.TemporaryDirectory() as directory:
+                async with ShardedBot(api, workers, directory, rate_limits) as bot:
+                    result = await measure_flow(bot, users, run * 10_000_000, ramp, think)
+            latencies = result["latencies"] or [0.0]
+            baseline = baseline or result["updates_per_second"]
+            print(
+                f"{workers:>8} {result['updates_per_second']:>10.1f} "
+                f"{result['updates_per_second'] / baseline:>7.2f}x "
+                f"{statistics.median(latencies) * 1000:>8.2f} {percentile(latencies, 0.95) * 1000:>8.2f} "
+                f"{percentile(latencies, 0.99) * 1000:>8.2f} {result['failed']:>7}"
+            )
+    finally:
+        await api.stop()
+
+# Emails per paste for the calls scenario: one output message, several, and a document
+CALL_PASTE_SIZES = {"1 message": 40, "4 messages": 450, "document": 2000}
+# API calls made by the transport rather than in answer to the user
+TRANSPORT_METHODS = {"getMe", "getUpdates", "setWebhook", "deleteWebhook"}
+
+async def settle(api, quiet=0.3):
+    """Wait until the bot has made no API call for `quiet` seconds (deletions run in the background)."""
+    count = None
+    while count != (count := sum(api.calls.values())):
+        await asyncio.sleep(quiet)
+
+def api_usage(api):
+    calls = {method: n for method, n in api.calls.items() if method not in TRANSPORT_METHODS}
+    sent = sum(n for method, n in api.request_bytes.items() if method not in TRANSPORT_METHODS)
+    return calls, sent, api.deleted
+
+async def measure_batch_calls(bot, user_id, emails, inline):
+    """Count the Bot API calls and bytes of one batch: the paste, Copy Again and Clear Messages."""
+    api = bot.api
+    for text in ("/start", mailstr.BOT_PASSWORD, "📧 Input Emails"):
+        reply = api.wait_reply(user_id, final=True)
+        await bot.deliver(make_text_update(user_id, text))
+        await asyncio.wait_for(reply, FLOW_REPLY_TIMEOUT)
+    await settle(api)
+    calls_before, sent_before, deleted_before = api_usage(api)
+    paste = "\n".join(f"user{user_id}.{i}@example{i % 9 + 1}.com" for i in range(emails))
+    for text in (paste, "📋 Copy Again", "🧹 Clear Messages"):
+        reply = api.wait_reply(user_id, final=True)
+        if inline and text != paste:
+            await bot.deliver(make_callback_update(api, user_id, text))
+        else:
+            await bot.deliver(make_text_update(user_id, text))
+        await asyncio.wait_for(reply, FLOW_REPLY_TIMEOUT)
+        await settle(api)
+    calls, sent, deleted = api_usage(api)
+    calls = {method: n - calls_before.get(method, 0) for method, n in calls.items() if n - calls_before.get(method, 0)}
+    return calls, sent - sent_before, deleted - deleted_before
+
+async def run_calls():
+    api = FakeBotAPI()
+    await api.start()
+    try:
+        async with BotUnderTest(api, "polling") as bot:
+            print(f"{'output':>10} {'buttons':>8} {'calls':>6} {'KiB sent':>9} {'deleted':>8}  by method")
+            user_ids = itertools.count(20_000_000)
+            for name, emails in CALL_PASTE_SIZES.items():
+                for inline in (False, True):
+                    calls, sent, deleted = await measure_batch_calls(bot, next(user_ids), emails, inline)
+                    methods = ", ".join(f"{method} {n}" for method, n in sorted(calls.items()))
+                    print(
+                        f"{name:>10} {'inline' if inline else 'text':>8} {sum(calls.values()):>6} "
+                        f"{sent / 1024:>9.1f} {deleted:>8}  {methods}"
+                    )
+    finally:
+        await api.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenario", choices=["latency", "flow", "calls", "shards"])
+    parser.add_argument("--updates", type=int, default=200)
+    parser.add_argument("--rtt", type=float, default=0.0, help="simulated Bot API round trip in seconds")
+    parser.add_argument("--users", default="100,500,1000,2000", help="comma-separated concurrent user counts for flow; shards uses the first")
+    parser.add_argument("--workers", default="1,2,4,8", help="comma-separated worker counts for shards")
+    parser.add_argument("--mode", choices=["polling", "webhook"], default="polling", help="update delivery for flow")
+    parser.add_argument("--ramp", type=float, default=1.0, help="seconds over which a flow level's users arrive")
+    parser.add_argument("--think", type=float, default=0.0, help="mean seconds a user pauses between flow steps")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the outbound rate limits in flow")
+    args = parser.parse_args()
+    if args.scenario == "latency":
+        asyncio.run(run_latency(args.updates, args.rtt))
+    elif args.scenario == "flow":
+        if not args.rate_limits:
+            mailstr.OVERALL_MAX_RATE = mailstr.CHAT_MAX_RATE = mailstr.GROUP_MAX_RATE = 0
+        levels = [int(users) for users in args.users.split(",")]
+        asyncio.run(run_flow(levels, args.mode, args.rtt, args.ramp, args.think))
+    elif args.scenario == "shards":
+        users = int(args.users.split(",")[0])
+        worker_counts = [int(workers) for workers in args.workers.split(",")]
+        asyncio.run(run_shards(worker_counts, users, args.ramp, args.think, args.rate_limits))
+    elif args.scenario == "calls":
+        mailstr.OVERALL_MAX_RATE = mailstr.CHAT_MAX_RATE = mailstr.GROUP_MAX_RATE = 0
+        asyncio.run(run_calls())
+
+if __name__ == "__main__":
+    main()
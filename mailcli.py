@@ -0,0 +1,185 @@
+"""Extract and format emails from files and directories without going through Telegram.
+
+Uses the same pipeline as the bot (mailcore.py) and never imports the
+telegram package. Files are scanned in parallel on a process pool, and
+addresses are deduplicated across all inputs.
+
+Usage:
+    python mailcli.py dump.txt leads/ archive.zip          # one combined output on stdout
+    python mailcli.py leads/ --per-file --output-dir out/   # one output per input file
+    cat paste.txt | python mailcli.py - --sort grouped --prime prime --validity 1m
+
+Directories are searched recursively for .txt, .csv, .log, .zip and .gz
+files. Files named explicitly are read whatever their extension; "-" reads
+standard input. Passwords are auto-detected as in the bot unless
+--prime-pass/--mail-pass are given; in the combined output the first input
+with a match wins. With --per-file each input only lists addresses not
+already printed for an earlier one, and each is written out, in input order,
+as soon as it and the inputs before it are scanned. Output files mirror each
+input's path below the directory it was found in; when two inputs would share
+a name (list.txt and list.csv), the later one gets a -2, -3... suffix.
+"""
+import argparse
+import concurrent.futures
+import logging
+import os
+import sys
+import zipfile
+
+from mailcore import (
+    ARCHIVE_EXTENSIONS,
+    DEFAULT_CONFIG,
+    DOCUMENT_EXTENSIONS,
+    SORT_MODES,
+    DecompressionLimitError,
+    auto_detect_passwords,
+    extract_emails,
+    render_block,
+    scan_document,
+)
+
+logger = logging.getLogger("mailcli")
+
+def find_inputs(paths):
+    """Expand directories into the documents and archives they contain, in a stable order.
+
+    Yields (path, name): name is the path relative to the directory it was
+    found in, or the file name of an input given directly, without extension.
+    """
+    for path in paths:
+        if path == "-":
+            yield path, "stdin"
+        elif os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(DOCUMENT_EXTENSIONS + ARCHIVE_EXTENSIONS):
+                        found = os.path.join(root, name)
+                        yield found, os.path.splitext(os.path.relpath(found, path))[0]
+        else:
+            yield path, os.path.splitext(os.path.basename(path))[0]
+
+def scan_input(path):
+    """Scan one input; runs in a worker process.
+
+    Returns (path, emails, detected passwords, error message or None).
+    """
+    try:
+        if path == "-":
+            text = sys.stdin.read()
+            detected = {}
+            auto_detect_passwords(text, detected)
+            return path, extract_emails(text), detected, None
+        emails, detected = scan_document(path, path.lower())
+        return path, emails, detected, None
+    except (OSError, zipfile.BadZipFile, EOFError, DecompressionLimitError) as e:
+        return path, [], {}, str(e)
+
+def scan_all(paths, workers):
+    """Yield scan results in input order while later inputs are still being scanned."""
+    # Standard input belongs to this process, so it is never handed to a worker
+    files = [path for path in paths if path != "-"]
+    if "-" in paths:
+        yield scan_input("-")
+    if workers == 1 or len(files) <= 1:
+        yield from map(scan_input, files)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(scan_input, files)
+
+def output_path(output_dir, name, written):
+    """Return DIR/name.txt, or DIR/name-2.txt and so on if an earlier output of this run took it."""
+    stem = os.path.join(output_dir, name)
+    path = f"{stem}.txt"
+    suffix = 2
+    # a/list.txt and a/list.csv, or list.txt in two directories, must not overwrite each other
+    while path in written:
+        path = f"{stem}-{suffix}.txt"
+        suffix += 1
+    written.add(path)
+    return path
+
+def write_output(text, path=None):
+    if path is None:
+        sys.stdout.write(text + "\n\n")
+        sys.stdout.flush()
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as handle:
+        handle.write(text + "\n")
+
+def run(args):
+    config = {
+        **DEFAULT_CONFIG,
+        "prime": args.prime,
+        "validity": args.validity,
+        "bin_type": args.bin_type,
+        "sort": args.sort,
+        "allow_domains": args.allow_domains,
+        "block_domains": args.block_domains,
+    }
+    explicit_passwords = {
+        key: value
+        for key, value in (("prime_pass", args.prime_pass), ("mail_pass", args.mail_pass))
+        if value is not None
+    }
+    inputs = list(find_inputs(args.paths))
+    paths = [path for path, _ in inputs]
+    names = dict(inputs)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    written = set()  # Output files of this run
+    seen = {}  # Every address output so far, in first-seen order
+    detected_first = None
+    failed = 0
+    for path, emails, detected, error in scan_all(paths, args.workers):
+        if error:
+            logger.warning(f"Could not read {path}: {error}")
+            failed += 1
+            continue
+        # Each input's emails are already unique, so this costs only the input's own size
+        new_emails = [email for email in emails if email not in seen]
+        seen.update(dict.fromkeys(new_emails))
+        if detected and detected_first is None:
+            detected_first = detected
+        if args.per_file:
+            text, count = render_block(new_emails, {**config, **detected, **explicit_passwords})
+            # Nothing to write when there are no new emails or the domain filters left them all out
+            if count:
+                write_output(text, output_path(args.output_dir, names[path], written) if args.output_dir else None)
+            logger.info(f"{path}: {len(emails)} emails, {len(new_emails)} new")
+
+    if not args.per_file:
+        text, count = render_block(tuple(seen), {**config, **(detected_first or {}), **explicit_passwords})
+        if count:
+            write_output(text, args.output or (output_path(args.output_dir, "all", written) if args.output_dir else None))
+    logger.info(f"{len(paths)} inputs, {len(seen)} unique emails, {failed} unreadable")
+    return 1 if failed else 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="files, directories, or - for standard input")
+    parser.add_argument("--prime", default=DEFAULT_CONFIG["prime"])
+    parser.add_argument("--validity", default=DEFAULT_CONFIG["validity"])
+    parser.add_argument("--bin-type", default=DEFAULT_CONFIG["bin_type"])
+    parser.add_argument("--prime-pass", help="skip auto-detection and use this prime pass")
+    parser.add_argument("--mail-pass", help="skip auto-detection and use this mail pass")
+    parser.add_argument("--sort", choices=SORT_MODES, default=DEFAULT_CONFIG["sort"])
+    parser.add_argument("--allow-domains", default="", help="comma-separated domains to keep")
+    parser.add_argument("--block-domains", default="", help="comma-separated domains to leave out")
+    parser.add_argument("--per-file", action="store_true", help="one output per input instead of one combined output")
+    parser.add_argument("--output", "-o", help="write the combined output to this file instead of stdout")
+    parser.add_argument("--output-dir", help="write each output to DIR/<input path below its directory>.txt (combined: DIR/all.txt)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes (default: one per CPU)")
+    parser.add_argument("--verbose", "-v", action="store_true", help="report per-input counts on stderr")
+    args = parser.parse_args()
+    if args.output and args.per_file:
+        parser.error("--output takes the combined output; use --output-dir with --per-file")
+    logging.basicConfig(
+        format="%(levelname)s: %(message)s", level=logging.INFO if args.verbose else logging.WARNING
+    )
+    sys.exit(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,481 @@
+"""The email extraction pipeline shared by the bot and the offline CLI.
+
+Extraction, password detection, document scanning and output formatting
+live here without any Telegram dependency, so mailcli.py and worker
+processes can import them without loading python-telegram-bot.
+"""
+import re
+import json
+import functools
+import logging
+import os
+import gzip
+import mmap
+import zipfile
+
+logger = logging.getLogger(__name__)
+
+# Configuration defaults
+DEFAULT_CONFIG = {
+    "prime": "prime",
+    "validity": "1m",
+    "bin_type": "BIN",
+    "prime_pass": "",
+    "mail_pass": "",
+    "auto_clear_timer": "300",  # 5 minutes in seconds
+    "accumulate": "off",  # "on" collects several pastes into one output
+    "sort": "none",  # One of SORT_MODES
+    "allow_domains": "",  # Comma-separated; when set, only these domains are output
+    "block_domains": "",  # Comma-separated domains left out of the output
+}
+
+# Output order: as found, by domain then local part, or grouped by domain with counts
+SORT_MODES = ("none", "domain", "grouped")
+
+# Compiled once at import; every extraction reuses the same pattern objects.
+# The local part and domain are capped at their RFC 5321 lengths (64 and 253):
+# unbounded runs made the scan quadratic on long tokens without an '@'. The
+# lookbehind makes a match start where the local part does, so an over-long
+# local part is rejected instead of cut down to its last 64 characters.
+# Internationalized TLDs appear in their punycode form (xn--p1ai), so that
+# alternative is tried before the letters-only one would stop at "xn". TLDs
+# are capped at a DNS label's 63 characters, which bounds the length of a match.
+EMAIL_REGEX = re.compile(r'(?<![a-zA-Z0-9._%+-])[a-zA-Z0-9._%+-]{1,64}@[a-zA-Z0-9.-]{1,253}\.(?:[xX][nN]--[a-zA-Z0-9-]{2,59}|[a-zA-Z]{2,63}(?![a-zA-Z]))')
+# Longest possible match: local part, '@', domain, '.', TLD label
+MAX_EMAIL_LENGTH = 64 + 1 + 253 + 1 + 63
+
+# Characters that can appear inside a match. A chunk is only scanned up to its
+# last character outside this set, so an address split across two chunks is
+# carried over and matched whole.
+EMAIL_CHARS = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789._%+-@")
+
+# Public suffix table email domains are validated against (see build_suffix_list.py).
+# Loaded on first use; when it is missing only the label syntax is checked.
+PUBLIC_SUFFIX_FILE = os.environ.get(
+    "PUBLIC_SUFFIX_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "public_suffixes.txt.gz"),
+)
+# Distinct domains whose verdict is remembered; pastes repeat a few domains many times
+DOMAIN_CACHE_SIZE = int(os.environ.get("DOMAIN_CACHE_SIZE", "65536"))
+
+class SuffixTrie:
+    """Public suffix rules in a trie keyed by domain labels from the TLD down.
+    
+    A node's "" key marks the end of a rule, "*" is a wildcard rule and
+    "!label" an exception to it, as in the Public Suffix List format.
+    """
+    
+    def __init__(self, rules):
+        self.root = {}
+        for rule in rules:
+            node = self.root
+            for label in reversed(rule.split(".")):
+                node = node.setdefault(label, {})
+            node[""] = {}
+        self.rules = len(rules)
+    
+    def suffix_length(self, labels):
+        """Return how many of the labels (TLD first) form the public suffix; 0 for an unknown TLD."""
+        node = self.root
+        length = 0
+        for depth, label in enumerate(labels):
+            if "!" + label in node:
+                return depth
+            if "*" in node:
+                length = depth + 1
+            node = node.get(label)
+            if node is None:
+                break
+            if "" in node:
+                length = depth + 1
+        return length
+
+def load_suffix_trie(path):
+    """Load a gzipped rule-per-line suffix table into a SuffixTrie."""
+    with gzip.open(path, "rt", encoding="ascii") as handle:
+        return SuffixTrie([line.strip() for line in handle if line.strip()])
+
+_suffix_trie = None
+_suffix_trie_loaded = False
+
+def get_suffix_trie():
+    """Return the public suffix trie, loading it on first use, or None if it is unavailable."""
+    global _suffix_trie, _suffix_trie_loaded
+    if not _suffix_trie_loaded:
+        _suffix_trie_loaded = True
+        if PUBLIC_SUFFIX_FILE:
+            try:
+                _suffix_trie = load_suffix_trie(PUBLIC_SUFFIX_FILE)
+                logger.info(f"Loaded {_suffix_trie.rules} public suffix rules")
+            except (OSError, EOFError, UnicodeDecodeError) as e:
+                logger.warning(f"Public suffix table unavailable, checking domain syntax only: {e}")
+    return _suffix_trie
+
+def to_ascii_domain(domain):
+    """Lowercase a domain and punycode any internationalized labels (пример.рф -> xn--e1afmkfd.xn--p1ai)."""
+    domain = domain.strip().lower()
+    if domain.isascii():
+        return domain
+    return ".".join(
+        label if label.isascii() else "xn--" + label.encode("punycode").decode("ascii")
+        for label in domain.split(".")
+    )
+
+@functools.lru_cache(maxsize=DOMAIN_CACHE_SIZE)
+def is_valid_domain(domain):
+    """Return whether domain is a well-formed name registered under a known public suffix.
+    
+    Rejects name@host.jpg and name@co.uk alike. Verdicts are cached, so a
+    domain that recurs across a paste is only looked up once.
+    """
+    labels = to_ascii_domain(domain).split(".")
+    for label in labels:
+        if not 0 < len(label) <= 63 or label[0] == "-" or label[-1] == "-":
+            return False
+    trie = get_suffix_trie()
+    if trie is None:
+        return True
+    labels.reverse()
+    length = trie.suffix_length(labels)
+    return 0 < length < len(labels)
+
+def iter_emails(chunks):
+    """Yield unique emails with a valid domain from an iterable of text chunks in first-seen order."""
+    seen = set()
+    carry = ""
+    start = 0  # Where the scan of carry begins; 1 when its first character is only lookbehind context
+    for chunk in chunks:
+        buffer = carry + chunk if carry else chunk
+        # Look back for the last character no match can span, at most one address long
+        cut = len(buffer)
+        floor = max(cut - MAX_EMAIL_LENGTH, 0)
+        while cut > floor and buffer[cut - 1] in EMAIL_CHARS:
+            cut -= 1
+        if cut > floor or floor == 0:
+            found = EMAIL_REGEX.findall(buffer, start, cut)
+            # A buffer of address characters only is carried whole, context character included
+            carry, start = buffer[cut:], start if cut == 0 else 0
+        else:
+            # A run of address characters longer than any address: a match starting more
+            # than MAX_EMAIL_LENGTH before the end cannot change with more input, so only
+            # the run's tail is carried and memory stays bounded whatever the input
+            found = []
+            resume = floor
+            for match in EMAIL_REGEX.finditer(buffer, start):
+                if match.start() >= floor:
+                    break
+                found.append(match.group())
+                resume = max(resume, match.end())
+            carry, start = buffer[resume - 1:], 1
+        for email in found:
+            if email not in seen:
+                seen.add(email)
+                if is_valid_domain(email.rpartition("@")[2]):
+                    yield email
+    for email in EMAIL_REGEX.findall(carry, start):
+        if email not in seen:
+            seen.add(email)
+            if is_valid_domain(email.rpartition("@")[2]):
+                yield email
+
+def extract_emails(text):
+    """Extract unique emails with a valid domain from text, or an iterable of text chunks, in paste order."""
+    if isinstance(text, str):
+        # dict.fromkeys dedupes keeping order; domains are then checked once
+        # each, and the list is only filtered again if one of them failed.
+        emails = list(dict.fromkeys(EMAIL_REGEX.findall(text)))
+        invalid = {domain for domain in {email.rpartition("@")[2] for email in emails} if not is_valid_domain(domain)}
+        if not invalid:
+            return emails
+        return [email for email in emails if email.rpartition("@")[2] not in invalid]
+    return list(iter_emails(text))
+
+# Password auto-detection table, reloaded whenever the file changes on disk
+PASSWORD_PATTERNS_FILE = os.environ.get(
+    "PASSWORD_PATTERNS_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "password_patterns.json"),
+)
+
+def build_trie_pattern(words):
+    """Build one regex alternation from a prefix trie of literal words."""
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+    
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        # A word ending here makes the rest optional; the greedy ? still prefers the longest word
+        return f"(?:{body})?" if "" in node else body
+    
+    return build(trie)
+
+class PasswordDetector:
+    """Match every entry of a password pattern table in a single pass over the text."""
+    
+    def __init__(self, patterns):
+        self.patterns = patterns
+        positions = {}
+        for position, entry in enumerate(patterns):
+            positions.setdefault(entry["pattern"].lower(), position)
+        # The regex reports the longest word at each offset; any shorter word that is
+        # a prefix of it matched there too, so fold the best table position into it
+        self.ranks = {
+            word: min(position for other, position in positions.items() if word.startswith(other))
+            for word in positions
+        }
+        self.max_length = max(map(len, positions), default=0)
+        # Lowercasing the text once is several times faster than matching with IGNORECASE
+        self.regex = re.compile(f"(?=({build_trie_pattern(positions)}))") if positions else None
+    
+    def rank(self, text):
+        """Return the table position of the highest-priority pattern in text, or None."""
+        if self.regex is None:
+            return None
+        best = None
+        for match in self.regex.finditer(text.lower()):
+            rank = self.ranks[match.group(1)]
+            if best is None or rank < best:
+                best = rank
+                if best == 0:
+                    break
+        return best
+    
+    def detect(self, text):
+        """Return the table entry that applies to text, or None."""
+        rank = self.rank(text)
+        return None if rank is None else self.patterns[rank]
+
+def load_password_patterns(path):
+    """Load the password pattern table from a JSON file."""
+    with open(path, encoding="utf-8") as handle:
+        patterns = json.load(handle)
+    for entry in patterns:
+        if not all(isinstance(entry.get(key), str) for key in ("pattern", "prime_pass", "mail_pass")):
+            raise ValueError(f"Invalid password pattern entry: {entry!r}")
+    return patterns
+
+_password_detector = PasswordDetector([])
+_password_patterns_mtime = None
+
+def get_password_detector():
+    """Return the current detector, rebuilding it if the pattern file changed."""
+    global _password_detector, _password_patterns_mtime
+    try:
+        mtime = os.stat(PASSWORD_PATTERNS_FILE).st_mtime_ns
+    except OSError as e:
+        if _password_patterns_mtime is not None:
+            logger.warning(f"Password pattern file unavailable, keeping loaded table: {e}")
+            _password_patterns_mtime = None
+        return _password_detector
+    if mtime != _password_patterns_mtime:
+        try:
+            _password_detector = PasswordDetector(load_password_patterns(PASSWORD_PATTERNS_FILE))
+            logger.info(f"Loaded {len(_password_detector.patterns)} password patterns")
+        except (OSError, ValueError, AttributeError) as e:
+            logger.error(f"Could not load password patterns, keeping previous table: {e}")
+        _password_patterns_mtime = mtime
+    return _password_detector
+
+def auto_detect_passwords(text, config):
+    """Auto-detect passwords from text (same logic as web version)."""
+    pattern_info = get_password_detector().detect(text)
+    if pattern_info is None:
+        return False, None
+    
+    config["prime_pass"] = pattern_info["prime_pass"]
+    config["mail_pass"] = pattern_info["mail_pass"]
+    return True, pattern_info
+
+# Uploaded files are scanned in bounded chunks instead of being read whole
+DOCUMENT_EXTENSIONS = (".txt", ".csv", ".log")
+ARCHIVE_EXTENSIONS = (".zip", ".gz")
+SCAN_CHUNK_SIZE = 1024 * 1024
+# Total bytes all members of one archive may expand to; a few KB of zip can hold gigabytes
+MAX_DECOMPRESSED_BYTES = int(os.environ.get("MAX_DECOMPRESSED_BYTES", str(512 * 1024 * 1024)))
+
+class DecompressionLimitError(ValueError):
+    """Raised when an archive expands to more than MAX_DECOMPRESSED_BYTES."""
+
+def iter_archive_chunks(path, filename):
+    """Yield the decompressed bytes of every member of a .zip or .gz archive, in SCAN_CHUNK_SIZE pieces."""
+    if filename.endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            for member in archive.infolist():
+                if member.is_dir():
+                    continue
+                with archive.open(member) as handle:
+                    while chunk := handle.read(SCAN_CHUNK_SIZE):
+                        yield chunk
+                yield b"\n"
+    else:
+        with gzip.open(path, "rb") as handle:
+            while chunk := handle.read(SCAN_CHUNK_SIZE):
+                yield chunk
+
+def iter_file_chunks(path, filename, max_decompressed=None):
+    """Yield the decoded text of a document or archive in SCAN_CHUNK_SIZE pieces.
+    
+    Archives stop with DecompressionLimitError once their members together
+    expand past max_decompressed bytes (MAX_DECOMPRESSED_BYTES by default).
+    """
+    # Emails are ASCII, so latin-1 decoding is lossless for them and never fails
+    if filename.endswith(ARCHIVE_EXTENSIONS):
+        limit = MAX_DECOMPRESSED_BYTES if max_decompressed is None else max_decompressed
+        expanded = 0
+        for chunk in iter_archive_chunks(path, filename):
+            expanded += len(chunk)
+            if expanded > limit:
+                raise DecompressionLimitError(f"archive expands to more than {limit // (1024 * 1024)} MB")
+            yield chunk.decode("latin-1")
+    else:
+        with open(path, "rb") as handle:
+            if os.fstat(handle.fileno()).st_size == 0:
+                return
+            with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for start in range(0, len(mapped), SCAN_CHUNK_SIZE):
+                    yield mapped[start:start + SCAN_CHUNK_SIZE].decode("latin-1")
+
+def scan_document(path, filename):
+    """Extract emails and detected passwords from a downloaded file in bounded memory."""
+    detector = get_password_detector()
+    # Carry the end of each chunk so a password split across two chunks is still seen
+    overlap = max(detector.max_length - 1, 0)
+    best = None
+    
+    def chunks():
+        nonlocal best
+        tail = ""
+        for chunk in iter_file_chunks(path, filename):
+            if best != 0:
+                rank = detector.rank(tail + chunk)
+                if rank is not None and (best is None or rank < best):
+                    best = rank
+                tail = chunk[-overlap:] if overlap else ""
+            yield chunk
+    
+    extracted_emails = extract_emails(chunks())
+    detected = {}
+    if best is not None:
+        entry = detector.patterns[best]
+        detected = {"prime_pass": entry["prime_pass"], "mail_pass": entry["mail_pass"]}
+    return extracted_emails, detected
+
+# Telegram rejects messages over 4096 characters; each output message also carries
+# a title, code fences and the button help text, so the email block gets less
+OUTPUT_CHUNK_LENGTH = 3500
+
+def parse_domains(value):
+    """Parse a comma-separated domain list setting into a set of lowercase, punycoded domains."""
+    return {to_ascii_domain(domain.strip().lstrip("@")) for domain in value.split(",") if domain.strip()}
+
+def index_by_domain(emails):
+    """Group emails by lowercase domain, keeping their order within each domain.
+    
+    Each address is split once; sorting and filtering then work on whole
+    domains instead of comparing per-address keys.
+    """
+    index = {}
+    for email in emails:
+        domain = email.rpartition("@")[2].lower()
+        group = index.get(domain)
+        if group is None:
+            index[domain] = [email]
+        else:
+            group.append(email)
+    return index
+
+def arrange_emails(emails, config):
+    """Apply the sort and domain filter settings.
+    
+    Returns the output blocks (emails, and domain headings when grouped)
+    and the number of emails kept.
+    """
+    mode = config.get("sort", DEFAULT_CONFIG["sort"])
+    allowed = parse_domains(config.get("allow_domains", ""))
+    blocked = parse_domains(config.get("block_domains", ""))
+    if mode not in ("domain", "grouped") and not allowed and not blocked:
+        return emails, len(emails)
+    
+    index = index_by_domain(emails)
+    kept = [domain for domain in index if (not allowed or domain in allowed) and domain not in blocked]
+    if mode not in ("domain", "grouped"):
+        # Filter only: keep the order the emails were found in
+        if len(kept) == len(index):
+            return emails, len(emails)
+        kept = set(kept)
+        emails = [email for email in emails if email.rpartition("@")[2].lower() in kept]
+        return emails, len(emails)
+    
+    blocks = []
+    count = 0
+    for domain in sorted(kept):
+        # Within a domain, sorting whole addresses orders them by local part
+        group = sorted(index[domain])
+        count += len(group)
+        if mode == "grouped":
+            blocks.append(f"📁 {domain} ({len(group)})")
+        blocks.extend(group)
+    return blocks, count
+
+def render_block(emails, config):
+    """Format the `Nx -- prime -- validity (bin)` block as one string.
+    
+    Returns (text, count), count being the emails left after the domain
+    filters; when it is 0 there is nothing worth sending.
+    """
+    blocks, count = arrange_emails(emails, config)
+    header = f"{count}x -- {config['prime']} -- {config['validity']} ({config['bin_type']})"
+    return "\n\n".join((header, *blocks)) + f"\n\npass- {config['prime_pass']}\nmail pass- {config['mail_pass']}", count
+
+def format_text(emails, config):
+    """Format the `Nx -- prime -- validity (bin)` block as one string."""
+    return render_block(emails, config)[0]
+
+def format_output(emails, config):
+    """Format the `Nx -- prime -- validity (bin)` block and split it into message-sized parts.
+    
+    Returns (output, parts, count of emails kept by the domain filters).
+    """
+    output, count = render_block(emails, config)
+    return output, split_output(output, OUTPUT_CHUNK_LENGTH), count
+
+def split_output(output, limit):
+    """Split output on blank lines into parts of at most `limit` characters."""
+    if len(output) <= limit:
+        return (output,)
+    parts = []
+    current = []
+    size = 0
+    for block in output.split("\n\n"):
+        added = len(block) + (2 if current else 0)
+        if current and size + added > limit:
+            parts.append("\n\n".join(current))
+            current = []
+            added = len(block)
+            size = 0
+        current.append(block)
+        size += added
+    parts.append("\n\n".join(current))
+    return tuple(parts)
+
+def extract_and_render(source, filename, config):
+    """Extract emails and passwords from text, or from a file when filename is given, and render them.
+    
+    Returns (emails, detected passwords, rendered output or None). Runs in a
+    worker process for large inputs.
+    """
+    if filename is None:
+        emails = tuple(extract_emails(source))
+        detected = {}
+        auto_detect_passwords(source, detected)
+    else:
+        emails, detected = scan_document(source, filename)
+        emails = tuple(emails)
+    rendered = format_output(emails, {**config, **detected}) if emails else None
+    return emails, detected, rendered
@@ -0,0 +1,239 @@
+"""Run the bot as one webhook ingress in front of several worker processes.
+
+Telegram posts every update to the ingress, which forwards it to one of N
+`mailstr.py` workers (BOT_MODE=worker) chosen from the update's user id.
+A user always lands on the same worker, so each worker's session cache,
+user_data and conversation states only ever hold its own users. Sessions,
+conversation states and pending auto-clear deletions live in the shared
+SQLite files (SESSION_DB, PERSISTENCE_DB, in WAL mode), so the workers can
+be restarted or their number changed without losing anyone's state.
+
+Usage:
+    WEBHOOK_URL=https://bot.example.com python mailshard.py --workers 4
+
+The ingress listens on WEBHOOK_LISTEN:WEBHOOK_PORT at /WEBHOOK_PATH and
+checks WEBHOOK_SECRET like the single-process webhook mode; worker 0
+registers the webhook with Telegram. Workers listen on 127.0.0.1 from
+--base-port up and are restarted if they exit. This module does not import
+python-telegram-bot.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import secrets
+import signal
+import ssl
+import sys
+
+logger = logging.getLogger("mailshard")
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mailstr.py")
+WORKER_RESTART_DELAY = 1.0  # Seconds before a worker that exited is started again
+WORKER_START_TIMEOUT = 60.0  # Seconds to wait for every worker to accept connections
+WORKER_UPDATE_PATH = "/update"  # Path the ingress posts updates to on each worker
+
+def shard_of(user_id, count):
+    """Return the worker index in range(count) that handles user_id."""
+    # Telegram user ids are spread evenly enough that the remainder balances the workers
+    return user_id % count
+
+def update_user_id(update):
+    """Return the id of the user an update comes from (the chat id if it has no user), or 0."""
+    for value in update.values():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("user")
+            if sender:
+                return sender["id"]
+            if value.get("chat"):
+                return value["chat"]["id"]
+    return 0
+
+async def read_request(reader):
+    """Read one HTTP/1.1 request; return (method, path, headers, body), or None at end of stream."""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, path, headers, body
+
+def write_response(writer, status, body=b""):
+    writer.write(f"HTTP/1.1 {status}\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+
+class WorkerLink:
+    """Keep-alive HTTP connections from the ingress to one worker."""
+
+    def __init__(self, port):
+        self.port = port
+        self.idle = []  # (reader, writer) pairs ready for the next request
+
+    async def forward(self, body, secret):
+        """Post an update to the worker and return its HTTP status code."""
+        while self.idle:
+            reader, writer = self.idle.pop()
+            try:
+                return await self._post(reader, writer, body, secret)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # The worker closed this idle connection, e.g. it was restarted; try another
+                continue
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        return await self._post(reader, writer, body, secret)
+
+    async def _post(self, reader, writer, body, secret):
+        try:
+            writer.write(
+                f"POST {WORKER_UPDATE_PATH} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+                f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionResetError("worker closed the connection")
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            await reader.readexactly(int(headers.get("content-length", 0)))
+            status = int(status_line.split(b" ", 2)[1])
+        except BaseException:
+            writer.close()
+            raise
+        self.idle.append((reader, writer))
+        return status
+
+    def close(self):
+        for _, writer in self.idle:
+            writer.close()
+        self.idle.clear()
+
+class Ingress:
+    """Accept Telegram's webhook requests and forward each update to its user's worker."""
+
+    def __init__(self, links, path, secret):
+        self.links = links
+        self.path = "/" + path.strip("/")
+        self.secret = secret
+
+    async def handle(self, reader, writer):
+        try:
+            while (request := await read_request(reader)) is not None:
+                method, path, headers, body = request
+                write_response(writer, *await self.route(method, path, headers, body))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, headers, body):
+        if method != "POST" or path.split("?", 1)[0] != self.path:
+            return "404 Not Found", b"Not found\n"
+        if not secrets.compare_digest(headers.get("x-telegram-bot-api-secret-token", ""), self.secret):
+            return "403 Forbidden", b"Forbidden\n"
+        try:
+            user_id = update_user_id(json.loads(body))
+        except (ValueError, AttributeError, KeyError, TypeError):
+            return "400 Bad Request", b"Invalid update\n"
+        link = self.links[shard_of(user_id, len(self.links))]
+        try:
+            status = await link.forward(body, self.secret)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            # Telegram retries updates that are not acknowledged, so nothing is lost while a worker restarts
+            logger.warning(f"Worker on port {link.port} unavailable: {e}")
+            return "503 Service Unavailable", b"Worker unavailable\n"
+        return ("200 OK", b"") if status == 200 else ("502 Bad Gateway", b"Worker rejected the update\n")
+
+async def supervise_worker(index, count, port, secret, stopping):
+    """Run worker `index` of `count` until stopping is set, restarting it whenever it exits."""
+    env = {
+        **os.environ,
+        "BOT_MODE": "worker",
+        "SHARD_INDEX": str(index),
+        "SHARD_COUNT": str(count),
+        "WORKER_PORT": str(port),
+        "WEBHOOK_SECRET": secret,
+    }
+    if int(os.environ.get("METRICS_PORT", "0")):
+        # One metrics endpoint per worker, on consecutive ports
+        env["METRICS_PORT"] = str(int(os.environ["METRICS_PORT"]) + index)
+    while not stopping.is_set():
+        process = await asyncio.create_subprocess_exec(sys.executable, WORKER_SCRIPT, env=env)
+        waiter = asyncio.create_task(process.wait())
+        stopper = asyncio.create_task(stopping.wait())
+        await asyncio.wait((waiter, stopper), return_when=asyncio.FIRST_COMPLETED)
+        if stopping.is_set():
+            if process.returncode is None:
+                process.terminate()
+            await waiter
+            return
+        stopper.cancel()
+        logger.warning(f"Worker {index} exited with status {process.returncode}, restarting")
+        await asyncio.sleep(WORKER_RESTART_DELAY)
+
+async def wait_for_port(port, timeout):
+    """Wait until something accepts connections on 127.0.0.1:port."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            if loop.time() > deadline:
+                raise TimeoutError(f"no worker listening on port {port} after {timeout:.0f}s")
+            await asyncio.sleep(0.1)
+
+async def run(args):
+    # Workers check the secret the ingress forwards, so they need the same one
+    secret = os.environ.get("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+    if not os.environ.get("WEBHOOK_URL"):
+        logger.warning("WEBHOOK_URL is not set, so the webhook is not registered with Telegram")
+    ports = [args.base_port + index for index in range(args.workers)]
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+
+    workers = [
+        asyncio.create_task(supervise_worker(index, args.workers, port, secret, stopping))
+        for index, port in enumerate(ports)
+    ]
+    links = [WorkerLink(port) for port in ports]
+    server = None
+    try:
+        await asyncio.gather(*(wait_for_port(port, WORKER_START_TIMEOUT) for port in ports))
+        ssl_context = None
+        if os.environ.get("WEBHOOK_CERT") and os.environ.get("WEBHOOK_KEY"):
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(os.environ["WEBHOOK_CERT"], os.environ["WEBHOOK_KEY"])
+        ingress = Ingress(links, os.environ.get("WEBHOOK_PATH", "telegram"), secret)
+        server = await asyncio.start_server(ingress.handle, args.listen, args.port, ssl=ssl_context)
+        logger.info(f"Ingress on {args.listen}:{args.port} forwarding to {args.workers} worker(s)")
+        await stopping.wait()
+    finally:
+        stopping.set()
+        if server is not None:
+            server.close()
+        for link in links:
+            link.close()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes (default: one per CPU)")
+    parser.add_argument("--listen", default=os.environ.get("WEBHOOK_LISTEN", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("WEBHOOK_PORT", os.environ.get("PORT", "8443"))))
+    parser.add_argument("--base-port", type=int, default=9100, help="port of worker 0; worker i listens on base + i")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -1,42 +1,681 @@
-import re
+import json
 import logging
 import os
 import asyncio
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
+import pickle
+import bisect
+import collections.abc
+import concurrent.futures
+import contextlib
+import heapq
+import itertools
+import secrets
+import selectors
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import functools
+import hashlib
+import io
+import tempfile
+import zipfile
+import zlib
+import cProfile
+import pstats
+import tracemalloc
+from aiolimiter import AsyncLimiter
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, TimedOut
 from telegram.ext import (
+    AIORateLimiter,
     Application,
+    BaseHandler,
+    BasePersistence,
+    BaseUpdateProcessor,
+    CallbackQueryHandler,
     CommandHandler,
     MessageHandler,
     filters,
     ContextTypes,
     ConversationHandler,
+    PersistenceInput,
 )
 
+from mailcore import (
+    ARCHIVE_EXTENSIONS,
+    DEFAULT_CONFIG,
+    DOCUMENT_EXTENSIONS,
+    MAX_DECOMPRESSED_BYTES,
+    SORT_MODES,
+    DecompressionLimitError,
+    auto_detect_passwords,
+    extract_and_render,
+    extract_emails,
+    format_output,
+    is_valid_domain,
+    scan_document,
+)
+from mailshard import WORKER_UPDATE_PATH, read_request, shard_of, write_response
+
 # Enable logging
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
+# Metrics are served in the Prometheus text format on METRICS_HOST:METRICS_PORT; 0 disables the endpoint
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metrics:
+    """In-process counters, gauges and latency histograms."""
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.descriptions = {}  # name -> (type, help)
+        self.counters = collections.defaultdict(float)  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+        self.gauges = {}  # name -> callable returning the current value
+    
+    def describe(self, name, kind, text):
+        self.descriptions[name] = (kind, text)
+    
+    def inc(self, name, value=1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+    
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):  # Larger values only show up in the +Inf bucket
+            histogram[0][index] += 1
+        histogram[1] += value
+        histogram[2] += 1
+    
+    def gauge(self, name, text, read):
+        self.describe(name, "gauge", text)
+        self.gauges[name] = read
+    
+    def render(self) -> str:
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        grouped = collections.defaultdict(list)
+        for (name, labels), value in self.counters.items():
+            grouped[name].append((labels, value))
+        for (name, labels), histogram in self.histograms.items():
+            grouped[name].append((labels, histogram))
+        for name in self.gauges:
+            grouped[name].append(((), self.gauges[name]()))
+        for name in sorted(grouped):
+            kind, text = self.descriptions.get(name, ("untyped", ""))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in grouped[name]:
+                if kind != "histogram":
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+def _format_labels(labels):
+    # Label values are handler and endpoint names, which never need escaping
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}" if labels else ""
+
+metrics = Metrics()
+metrics.describe("mailsorter_handler_duration_seconds", "histogram", "Time spent in each conversation handler callback.")
+metrics.describe("mailsorter_handler_errors_total", "counter", "Handler callbacks that raised an exception.")
+metrics.describe("mailsorter_bot_api_duration_seconds", "histogram", "Duration of outbound Bot API requests by endpoint.")
+metrics.describe("mailsorter_bot_api_errors_total", "counter", "Outbound Bot API requests that failed, by endpoint.")
+metrics.describe("mailsorter_emails_extracted_total", "counter", "Unique emails extracted from processed batches.")
+metrics.describe("mailsorter_input_bytes_total", "counter", "Bytes of pasted text and uploaded files processed.")
+
+# Names of the callbacks wrapped by instrumented(); profile reports break time down by them
+handler_names = set()
+
+def instrumented(callback):
+    """Wrap a handler callback to record its latency and errors."""
+    name = callback.__name__
+    handler_names.add(name)
+    
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.inc("mailsorter_handler_errors_total", handler=name)
+            raise
+        finally:
+            metrics.observe("mailsorter_handler_duration_seconds", time.perf_counter() - started, handler=name)
+    
+    return wrapper
+
+async def serve_metrics(reader, writer):
+    """Answer one HTTP request with the current metrics."""
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        if request_line.split(b" ")[1:2] == [b"/metrics"]:
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
 # Define conversation states
 PASSWORD, MAIN_MENU, CONFIG, INPUT_EMAILS, CLEAR_MESSAGES = range(5)
 
-# Configuration defaults
-DEFAULT_CONFIG = {
-    "prime": "prime",
-    "validity": "1m",
-    "bin_type": "BIN",
-    "prime_pass": "",
-    "mail_pass": "",
-    "auto_clear_timer": "300",  # 5 minutes in seconds
-}
+SETTING_CHOICES = {"sort": SORT_MODES}  # Settings that only accept a fixed set of values
+
+def config_enabled(config, key):
+    """Read an on/off setting, falling back to the default for sessions saved before it existed."""
+    return str(config.get(key, DEFAULT_CONFIG[key])).strip().lower() in ("on", "yes", "true", "1")
+
+# Session storage settings
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "sqlite")  # "sqlite" or "memory"
+SESSION_DB = os.environ.get("SESSION_DB", "sessions.sqlite3")
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", "10000"))
+SESSION_FLUSH_INTERVAL = float(os.environ.get("SESSION_FLUSH_INTERVAL", "2"))
+SESSION_TTL = int(os.environ.get("SESSION_TTL", str(30 * 24 * 3600)))  # Idle users are forgotten after 30 days
+SESSION_EXPIRE_INTERVAL = float(os.environ.get("SESSION_EXPIRE_INTERVAL", "600"))  # Seconds between expiry sweeps
+# Reading a session refreshes its stored last_seen at most this often; changing it always does
+SESSION_TOUCH_INTERVAL = 3600.0
+# Seconds a write waits for another process's transaction (sharded workers share the files)
+SQLITE_BUSY_TIMEOUT = 30.0
+
+# Sharded deployments (mailshard.py) run SHARD_COUNT workers; this one handles the
+# users that shard_of() maps to SHARD_INDEX and only loads their stored state
+SHARD_INDEX = int(os.environ.get("SHARD_INDEX", "0"))
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT", "1"))
+
+def in_shard(user_id):
+    return SHARD_COUNT == 1 or shard_of(user_id, SHARD_COUNT) == SHARD_INDEX
+
+class MemorySessionBackend:
+    """Session backend that keeps serialized rows in process memory."""
+    
+    def __init__(self):
+        self.rows = {}
+        self.deletions = {}
+        self.next_deletion_id = 1
+    
+    def load(self, user_id):
+        return self.rows.get(user_id)
+    
+    def save_many(self, rows):
+        for user_id, data, last_seen in rows:
+            self.rows[user_id] = (data, last_seen)
+    
+    def delete_many(self, user_ids):
+        for user_id in user_ids:
+            self.rows.pop(user_id, None)
+    
+    def expire(self, cutoff):
+        expired = [user_id for user_id, (_, last_seen) in self.rows.items() if last_seen < cutoff]
+        self.delete_many(expired)
+        return len(expired)
+    
+    def add_deletion(self, chat_id, message_ids, due):
+        deletion_id = self.next_deletion_id
+        self.next_deletion_id += 1
+        self.deletions[deletion_id] = (chat_id, list(message_ids), due)
+        return deletion_id
+    
+    def remove_deletions(self, deletion_ids):
+        for deletion_id in deletion_ids:
+            self.deletions.pop(deletion_id, None)
+    
+    def load_deletions(self):
+        return [(deletion_id, *row) for deletion_id, row in self.deletions.items()]
+    
+    def close(self):
+        pass
+
+class SQLiteSessionBackend:
+    """Session backend that stores one JSON row per user in a local SQLite file."""
+    
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._connection = None
+    
+    @property
+    def connection(self):
+        # Opened lazily so importing the module never creates the database file
+        if self._connection is None:
+            self._connection = sqlite3.connect(
+                self.path, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False, isolation_level=None
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, last_seen REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS pending_deletions ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, "
+                "message_ids TEXT NOT NULL, due REAL NOT NULL)"
+            )
+        return self._connection
+    
+    def load(self, user_id):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT data, last_seen FROM sessions WHERE user_id = ?", (user_id,)
+            ).fetchone()
+    
+    def save_many(self, rows):
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO sessions (user_id, data, last_seen) VALUES (?, ?, ?)", rows
+            )
+    
+    def delete_many(self, user_ids):
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.executemany("DELETE FROM sessions WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+    
+    def expire(self, cutoff):
+        with self.lock:
+            return self.connection.execute("DELETE FROM sessions WHERE last_seen < ?", (cutoff,)).rowcount
+    
+    def add_deletion(self, chat_id, message_ids, due):
+        with self.lock:
+            return self.connection.execute(
+                "INSERT INTO pending_deletions (chat_id, message_ids, due) VALUES (?, ?, ?)",
+                (chat_id, json.dumps(list(message_ids)), due),
+            ).lastrowid
+    
+    def remove_deletions(self, deletion_ids):
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(
+                "DELETE FROM pending_deletions WHERE id = ?", [(deletion_id,) for deletion_id in deletion_ids]
+            )
+    
+    def load_deletions(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT id, chat_id, message_ids, due FROM pending_deletions").fetchall()
+        return [(deletion_id, chat_id, json.loads(message_ids), due) for deletion_id, chat_id, message_ids, due in rows]
+    
+    def close(self):
+        with self.lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+class SessionStore(collections.abc.MutableMapping):
+    """Dict-like user session store with an LRU cache in front of a persistent backend.
+    
+    Only cache misses read through to the backend; prefetch() does that in a
+    worker thread before a user's update is handled. Callers that change a
+    session in place call save() so it is written behind the handlers in
+    batches by run_flusher(). Sessions idle for longer than `ttl` seconds
+    are expired from both every `expire_interval` seconds.
+    """
+    
+    def __init__(
+        self,
+        backend,
+        cache_size=SESSION_CACHE_SIZE,
+        ttl=SESSION_TTL,
+        flush_interval=SESSION_FLUSH_INTERVAL,
+        expire_interval=SESSION_EXPIRE_INTERVAL,
+    ):
+        self.backend = backend
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.expire_interval = expire_interval
+        self.cache = collections.OrderedDict()  # user_id -> [session, last_seen, last_seen as stored]
+        self.absent = collections.OrderedDict()  # Users known to have no stored session, least recent first
+        self.dirty = set()
+        self.deleted = set()
+        self.pending_rows = {}  # Serialized sessions evicted from the cache before their flush
+        self.in_flight = {}  # Rows currently being written by the flusher
+    
+    def __getitem__(self, user_id):
+        entry = self.cache.get(user_id)
+        if entry is None:
+            entry = self._load(user_id)
+            if entry is None:
+                raise KeyError(user_id)
+        else:
+            self.cache.move_to_end(user_id)
+        entry[1] = time.time()
+        # Keep the stored last_seen recent enough that expiry never drops an active user
+        if entry[1] - entry[2] > SESSION_TOUCH_INTERVAL:
+            self.dirty.add(user_id)
+        return entry[0]
+    
+    def __setitem__(self, user_id, session):
+        now = time.time()
+        self.cache[user_id] = [session, now, now]
+        self.cache.move_to_end(user_id)
+        self.dirty.add(user_id)
+        self.deleted.discard(user_id)
+        self.absent.pop(user_id, None)
+        self._shrink()
+    
+    def save(self, user_id):
+        """Queue a session changed in place for the next flush."""
+        if user_id in self.cache:
+            self.dirty.add(user_id)
+    
+    def __delitem__(self, user_id):
+        if user_id not in self:
+            raise KeyError(user_id)
+        self.cache.pop(user_id, None)
+        self.pending_rows.pop(user_id, None)
+        self.dirty.discard(user_id)
+        self.deleted.add(user_id)
+    
+    def __contains__(self, user_id):
+        return user_id in self.cache or self._load(user_id) is not None
+    
+    def __iter__(self):
+        return iter(list(self.cache))
+    
+    def __len__(self):
+        return len(self.cache)
+    
+    def _load(self, user_id):
+        if user_id in self.deleted or user_id in self.absent:
+            return None
+        row = self.pending_rows.get(user_id) or self.in_flight.get(user_id) or self.backend.load(user_id)
+        return self._cache_row(user_id, row)
+    
+    async def prefetch(self, user_id):
+        """Read a session that is not cached into the cache, with the backend read in a worker thread."""
+        if user_id in self.cache or user_id in self.deleted or user_id in self.absent:
+            return
+        row = self.pending_rows.get(user_id) or self.in_flight.get(user_id)
+        if row is None:
+            try:
+                row = await asyncio.to_thread(self.backend.load, user_id)
+            except Exception as e:
+                logger.error(f"Error loading user session: {e}")
+                return  # The handler's own read will retry and report it
+            if user_id in self.cache or user_id in self.deleted:
+                return  # Stored or deleted while the row was read
+        self._cache_row(user_id, row)
+    
+    def _cache_row(self, user_id, row):
+        if row is None or row[1] < time.time() - self.ttl:
+            # Remembered so that updates from users without a session skip the backend
+            self.absent[user_id] = None
+            self.absent.move_to_end(user_id)
+            if len(self.absent) > self.cache_size:
+                self.absent.popitem(last=False)
+            return None
+        entry = [json.loads(row[0]), row[1], row[1]]
+        self.cache[user_id] = entry
+        self._shrink()
+        return entry
+    
+    def _shrink(self):
+        while len(self.cache) > self.cache_size:
+            user_id, (session, last_seen, _) = self.cache.popitem(last=False)
+            if user_id in self.dirty:
+                self.dirty.discard(user_id)
+                self.pending_rows[user_id] = (json.dumps(session), last_seen)
+    
+    def _take_changes(self):
+        rows = dict(self.pending_rows)
+        for user_id in self.dirty:
+            entry = self.cache[user_id]
+            entry[2] = entry[1]
+            rows[user_id] = (json.dumps(entry[0]), entry[1])
+        deleted = list(self.deleted)
+        self.pending_rows.clear()
+        self.dirty.clear()
+        self.deleted.clear()
+        self.in_flight = rows
+        return [(user_id, data, last_seen) for user_id, (data, last_seen) in rows.items()], deleted
+    
+    def _evict_idle(self):
+        cutoff = time.time() - self.ttl
+        for user_id in [user_id for user_id, entry in self.cache.items() if entry[1] < cutoff]:
+            del self.cache[user_id]
+            self.dirty.discard(user_id)
+        return cutoff
+    
+    def flush(self):
+        """Write all pending changes to the backend synchronously."""
+        rows, deleted = self._take_changes()
+        try:
+            if rows:
+                self.backend.save_many(rows)
+            if deleted:
+                self.backend.delete_many(deleted)
+        finally:
+            self.in_flight = {}
+    
+    async def run_flusher(self):
+        """Write changes behind the handlers every flush_interval seconds and expire idle users every expire_interval."""
+        next_expiry = time.monotonic() + self.expire_interval
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                # Sessions are serialized on the event loop, where handlers mutate them,
+                # and only the disk writes run in a worker thread
+                rows, deleted = self._take_changes()
+                try:
+                    if rows:
+                        await asyncio.to_thread(self.backend.save_many, rows)
+                    if deleted:
+                        await asyncio.to_thread(self.backend.delete_many, deleted)
+                finally:
+                    self.in_flight = {}
+                if time.monotonic() >= next_expiry:
+                    next_expiry = time.monotonic() + self.expire_interval
+                    cutoff = self._evict_idle()
+                    expired = await asyncio.to_thread(self.backend.expire, cutoff)
+                    if expired:
+                        logger.info(f"Expired {expired} idle user sessions")
+            except Exception as e:
+                logger.error(f"Error flushing user sessions: {e}")
+
+def create_session_backend():
+    """Create the session backend selected by SESSION_BACKEND."""
+    if SESSION_BACKEND == "memory":
+        return MemorySessionBackend()
+    return SQLiteSessionBackend(SESSION_DB)
 
 # Store user sessions
-user_sessions = {}
+user_sessions = SessionStore(create_session_backend())
+
+# Conversation states and user_data survive restarts in this file (the session database by default)
+PERSISTENCE_DB = os.environ.get("PERSISTENCE_DB", SESSION_DB)
+
+class SQLitePersistence(BasePersistence):
+    """Persist conversation states, user_data and chat_data in a local SQLite file.
+    
+    Every update_interval seconds the Application hands over everything
+    touched since its previous run. The update calls only stage pickled rows;
+    each run is then written in a single transaction off the event loop.
+    """
+    
+    def __init__(self, path, update_interval=SESSION_FLUSH_INTERVAL, ttl=SESSION_TTL):
+        # bot_data and callback data are unused, so skip copying them every interval
+        super().__init__(store_data=PersistenceInput(bot_data=False, callback_data=False), update_interval=update_interval)
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self._connection = None
+        self.pending = {}  # (kind, key) -> pickled data, or None to delete the row
+        self.write_scheduled = False
+        self.write_lock = asyncio.Lock()
+        self.write_tasks = set()
+    
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(
+                self.path, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False, isolation_level=None
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS persistence ("
+                "kind TEXT NOT NULL, key TEXT NOT NULL, data BLOB NOT NULL, updated REAL NOT NULL, "
+                "PRIMARY KEY (kind, key))"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS persistence_updated ON persistence (updated)")
+        return self._connection
+    
+    def _load(self, kind):
+        with self.lock:
+            return self.connection.execute("SELECT key, data FROM persistence WHERE kind = ?", (kind,)).fetchall()
+    
+    async def get_user_data(self):
+        rows = await asyncio.to_thread(self._load, "user")
+        return {int(key): pickle.loads(data) for key, data in rows if in_shard(int(key))}
+    
+    async def get_chat_data(self):
+        rows = await asyncio.to_thread(self._load, "chat")
+        return {int(key): pickle.loads(data) for key, data in rows if in_shard(int(key))}
+    
+    async def get_bot_data(self):
+        return {}
+    
+    async def get_callback_data(self):
+        return None
+    
+    async def get_conversations(self, name):
+        rows = await asyncio.to_thread(self._load, f"conversation:{name}")
+        # Keys are (chat_id, user_id)
+        keys = {key: tuple(json.loads(key)) for key, _ in rows}
+        return {keys[key]: pickle.loads(data) for key, data in rows if in_shard(keys[key][-1])}
+    
+    async def update_conversation(self, name, key, new_state):
+        self._stage(f"conversation:{name}", json.dumps(list(key)), new_state)
+    
+    async def update_user_data(self, user_id, data):
+        self._stage("user", str(user_id), data)
+    
+    async def update_chat_data(self, chat_id, data):
+        self._stage("chat", str(chat_id), data)
+    
+    async def update_bot_data(self, data):
+        pass
+    
+    async def update_callback_data(self, data):
+        pass
+    
+    async def drop_user_data(self, user_id):
+        self._stage("user", str(user_id), None)
+    
+    async def drop_chat_data(self, chat_id):
+        self._stage("chat", str(chat_id), None)
+    
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+    
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+    
+    async def refresh_bot_data(self, bot_data):
+        pass
+    
+    def _stage(self, kind, key, data):
+        self.pending[(kind, key)] = None if data is None else pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        if not self.write_scheduled:
+            self.write_scheduled = True
+            # update_persistence() starts all of its update calls at once and this
+            # callback is queued behind them, so a whole run becomes one write
+            asyncio.get_running_loop().call_soon(self._start_write)
+    
+    def _start_write(self):
+        self.write_scheduled = False
+        task = asyncio.create_task(self.write())
+        self.write_tasks.add(task)
+        task.add_done_callback(self.write_tasks.discard)
+    
+    async def write(self):
+        """Write all staged rows in one transaction."""
+        async with self.write_lock:
+            rows, self.pending = self.pending, {}
+            if not rows:
+                return
+            try:
+                await asyncio.to_thread(self._write_rows, rows)
+            except Exception as e:
+                logger.error(f"Error writing persistence data: {e}")
+                # Retry with the next run unless newer data has been staged since
+                for key, data in rows.items():
+                    self.pending.setdefault(key, data)
+    
+    def _write_rows(self, rows):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO persistence (kind, key, data, updated) VALUES (?, ?, ?, ?)",
+                [(kind, key, data, now) for (kind, key), data in rows.items() if data is not None],
+            )
+            self.connection.executemany(
+                "DELETE FROM persistence WHERE kind = ? AND key = ?",
+                [(kind, key) for (kind, key), data in rows.items() if data is None],
+            )
+            # Forget conversations and user_data of users idle as long as their sessions
+            self.connection.execute("DELETE FROM persistence WHERE updated < ?", (now - self.ttl,))
+    
+    async def flush(self):
+        """Write everything staged and close the database; called once on shutdown."""
+        await asyncio.gather(*self.write_tasks)
+        await self.write()
+        with self.lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+def create_persistence():
+    """Create the conversation persistence, or None when sessions are kept in memory only."""
+    if SESSION_BACKEND == "memory":
+        return None
+    return SQLitePersistence(PERSISTENCE_DB)
 
 # Password for the bot
 BOT_PASSWORD = "star@683"  # Change this to your preferred password
 
+# Bot token and how updates are received: "polling" (default) or "webhook"
+BOT_TOKEN = os.environ.get("BOT_TOKEN", "7978004292:AAGtcPQEL7oZXAsef1ZR_sMy26BR2mIOb2g")
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")  # Public base URL Telegram posts updates to
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", os.environ.get("PORT", "8443")))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_CERT = os.environ.get("WEBHOOK_CERT")  # PEM certificate, to terminate TLS in the bot itself
+WEBHOOK_KEY = os.environ.get("WEBHOOK_KEY")
+# BOT_MODE=worker takes updates forwarded by the mailshard.py ingress on this local port
+WORKER_PORT = int(os.environ.get("WORKER_PORT", "9100"))
+BOT_API_URL = os.environ.get("BOT_API_URL", "")  # e.g. a self-hosted telegram-bot-api server
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Start the conversation and ask for password."""
     user_id = update.message.from_user.id
@@ -75,6 +714,7 @@ async def verify_password(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             user_sessions[user_id] = {"authenticated": True, "config": DEFAULT_CONFIG.copy()}
         else:
             user_sessions[user_id]["authenticated"] = True
+            user_sessions.save(user_id)
             
         await update.message.reply_text("✅ Access granted! Welcome to CyberMail Matrix.")
         await show_main_menu(update, context)
@@ -113,7 +753,7 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             reply_markup=reply_markup,
         )
 
-async def show_configuration(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def show_configuration(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show current configuration."""
     user_id = update.message.from_user.id
     config = user_sessions[user_id]["config"]
@@ -123,6 +763,8 @@ async def show_configuration(update: Update, context: ContextTypes.DEFAULT_TYPE)
         ["prime", "validity"],
         ["bin_type", "prime_pass"],
         ["mail_pass", "auto_clear_timer"],
+        ["accumulate", "sort"],
+        ["allow_domains", "block_domains"],
         ["✅ Done", "🔙 Back to Menu"]
     ]
     reply_markup = ReplyKeyboardMarkup(
@@ -134,57 +776,76 @@ async def show_configuration(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     config_text = (
         f"⚙️ Current Configuration:\n\n"
-        f"🔑 Prime: {config['prime']}\n"
-        f"⏰ Validity: {config['validity']}\n"
-        f"💳 Bin/UPI: {config['bin_type']}\n"
-        f"🔐 Prime Pass: {config['prime_pass']}\n"
-        f"📧 Mail Pass: {config['mail_pass']}\n"
-        f"⏱️ Auto Clear Timer: {config['auto_clear_timer']} seconds\n\n"
+        f"{format_settings(config)}\n\n"
         "To change a setting:\n"
         "1. Click the setting button below\n"
         "2. Type the new value\n"
         "3. Or use format: `setting_name=new_value`\n\n"
         "**Auto Clear Timer**: Messages are automatically cleared after this many seconds for privacy.\n"
         "Default: 300 seconds (5 minutes). Set to 0 to disable auto-clear.\n\n"
+        "**Accumulate**: Set to on to paste a batch over several messages and get one combined output.\n\n"
+        "**Sort**: none (as found), domain (by domain, then name) or grouped (by domain, with counts).\n"
+        "**Allow/Block Domains**: Comma-separated domains to keep or leave out, e.g. `gmail.com, yahoo.com`.\n\n"
         "Click 'Done' when finished or 'Back to Menu' to return."
     )
     
     await update.message.reply_text(config_text, parse_mode="Markdown", reply_markup=reply_markup)
-    return CONFIG
+
+def format_settings(config):
+    """One line per setting, as shown in the configuration screens."""
+    def setting(key):
+        # Sessions saved before a setting existed do not have it yet
+        return config.get(key, DEFAULT_CONFIG[key])
+    return (
+        f"🔑 Prime: {setting('prime')}\n"
+        f"⏰ Validity: {setting('validity')}\n"
+        f"💳 Bin/UPI: {setting('bin_type')}\n"
+        f"🔐 Prime Pass: {setting('prime_pass')}\n"
+        f"📧 Mail Pass: {setting('mail_pass')}\n"
+        f"⏱️ Auto Clear Timer: {setting('auto_clear_timer')} seconds\n"
+        f"📚 Accumulate: {setting('accumulate')}\n"
+        f"🔤 Sort: {setting('sort')}\n"
+        f"✅ Allow Domains: {setting('allow_domains') or 'all'}\n"
+        f"🚫 Block Domains: {setting('block_domains') or 'none'}"
+    )
+
+def invalid_setting_value(key, value):
+    """Return an error message if value is not allowed for key, else None."""
+    choices = SETTING_CHOICES.get(key)
+    if choices and value not in choices:
+        return f"❌ {key} must be one of: {', '.join(choices)}"
+    return None
+
+async def finish_configuration(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Confirm the configuration and return to the main menu."""
+    await update.message.reply_text("✅ Configuration updated!")
+    await leave_configuration(update, context)
+
+async def leave_configuration(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Return to the main menu, dropping any setting waiting for a value."""
+    await answer_query(update)
+    context.user_data.pop('updating_setting', None)
+    await show_main_menu(update, context)
+
+async def choose_setting(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show the current value of the setting whose button was pressed and ask for a new one."""
+    user_id = update.message.from_user.id
+    setting_name = update.message.text
+    current_value = user_sessions[user_id]["config"].get(setting_name, DEFAULT_CONFIG[setting_name])
+    # Store which setting is being updated for direct value input
+    context.user_data['updating_setting'] = setting_name
+    await update.message.reply_text(
+        f"📝 Updating {setting_name}\n\n"
+        f"Current value: `{current_value}`\n\n"
+        f"Please enter the new value:",
+        parse_mode="Markdown"
+    )
 
 async def update_configuration(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Update configuration based on user input."""
+    """Update a setting from `setting_name=value`, or from a value for the setting chosen last."""
     user_id = update.message.from_user.id
     user_input = update.message.text
-    
-    # Handle button clicks
-    if user_input == "✅ Done":
-        # Clear any pending setting update
-        if 'updating_setting' in context.user_data:
-            del context.user_data['updating_setting']
-        await update.message.reply_text("✅ Configuration updated!")
-        await show_main_menu(update, context)
-        return MAIN_MENU
-    elif user_input == "🔙 Back to Menu":
-        # Clear any pending setting update
-        if 'updating_setting' in context.user_data:
-            del context.user_data['updating_setting']
-        await show_main_menu(update, context)
-        return MAIN_MENU
-    
-    # Handle setting name buttons (show current value and ask for new value)
-    valid_keys = ['prime', 'validity', 'bin_type', 'prime_pass', 'mail_pass', 'auto_clear_timer']
-    if user_input in valid_keys:
-        current_value = user_sessions[user_id]["config"][user_input]
-        # Store which setting is being updated for direct value input
-        context.user_data['updating_setting'] = user_input
-        await update.message.reply_text(
-            f"📝 Updating {user_input}\n\n"
-            f"Current value: `{current_value}`\n\n"
-            f"Please enter the new value:",
-            parse_mode="Markdown"
-        )
-        return CONFIG
+    valid_keys = DEFAULT_CONFIG
     
     # Parse setting update (format: key=value)
     if '=' in user_input:
@@ -192,44 +853,33 @@ async def update_configuration(update: Update, context: ContextTypes.DEFAULT_TYP
         key = key.strip().lower()
         value = value.strip()
         
-        if key in valid_keys:
+        if key in valid_keys and (error := invalid_setting_value(key, value)):
+            await update.message.reply_text(error)
+        elif key in valid_keys:
             user_sessions[user_id]["config"][key] = value
+            user_sessions.save(user_id)
             await update.message.reply_text(f"✅ Updated {key} to: {value}")
             
             # Show updated configuration
             config = user_sessions[user_id]["config"]
-            updated_config = (
-                f"📋 Updated Configuration:\n\n"
-                f"🔑 Prime: {config['prime']}\n"
-                f"⏰ Validity: {config['validity']}\n"
-                f"💳 Bin/UPI: {config['bin_type']}\n"
-                f"🔐 Prime Pass: {config['prime_pass']}\n"
-                f"📧 Mail Pass: {config['mail_pass']}\n"
-                f"⏱️ Auto Clear Timer: {config['auto_clear_timer']} seconds"
-            )
-            await update.message.reply_text(updated_config)
+            await update.message.reply_text(f"📋 Updated Configuration:\n\n{format_settings(config)}")
         else:
             await update.message.reply_text("❌ Invalid setting name. Please try again.")
     else:
                 # Check if we're updating a specific setting (direct value input)
         if 'updating_setting' in context.user_data:
             setting_name = context.user_data['updating_setting']
+            if setting_name in valid_keys and (error := invalid_setting_value(setting_name, user_input)):
+                await update.message.reply_text(error)
+                return CONFIG
             if setting_name in valid_keys:
                 user_sessions[user_id]["config"][setting_name] = user_input
+                user_sessions.save(user_id)
                 await update.message.reply_text(f"✅ Updated {setting_name} to: {user_input}")
                 
                 # Show updated configuration
                 config = user_sessions[user_id]["config"]
-                updated_config = (
-                    f"📋 Updated Configuration:\n\n"
-                    f"🔑 Prime: {config['prime']}\n"
-                    f"⏰ Validity: {config['validity']}\n"
-                    f"💳 Bin/UPI: {config['bin_type']}\n"
-                    f"🔐 Prime Pass: {config['prime_pass']}\n"
-                    f"📧 Mail Pass: {config['mail_pass']}\n"
-                    f"⏱️ Auto Clear Timer: {config['auto_clear_timer']} seconds"
-                )
-                await update.message.reply_text(updated_config)
+                await update.message.reply_text(f"📋 Updated Configuration:\n\n{format_settings(config)}")
                 
                 # Clear the updating setting
                 del context.user_data['updating_setting']
@@ -245,57 +895,81 @@ async def update_configuration(update: Update, context: ContextTypes.DEFAULT_TYP
     
     return CONFIG
 
-async def request_emails(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def request_emails(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Ask user to input emails."""
+    user_id = update.message.from_user.id
+    accumulate = config_enabled(user_sessions[user_id]["config"], "accumulate")
+    # Start every batch empty
+    discard_batch(update, context)
+    
+    if accumulate:
+        hint = "Accumulate is on: paste as many messages as you need, then press ✅ Done for one combined output."
+    else:
+        hint = "Too long for one message? Send it as a .txt/.csv/.log file or a .zip/.gz archive."
+    
+    await update.message.reply_text(
+        "📧 Input Emails\n\n"
+        "Paste your text with emails. I'll automatically extract valid email addresses!\n\n"
+        f"{hint}\n\n"
+        "The quantity will be auto-detected from the number of emails found.",
+        reply_markup=input_reply_markup(accumulate),
+    )
+
+def input_reply_markup(accumulate):
+    """Keyboard shown while waiting for emails."""
     # Create optimized keyboard for email input
     email_keyboard = [
         ["🔙 Back to Menu"]
     ]
-    reply_markup = ReplyKeyboardMarkup(
+    if accumulate:
+        email_keyboard.insert(0, ["✅ Done"])
+    return ReplyKeyboardMarkup(
         email_keyboard,
-        one_time_keyboard=True,
+        one_time_keyboard=not accumulate,  # Keep "Done" on screen between pastes
         resize_keyboard=True,
         input_field_placeholder="Paste your text with emails here"
     )
-    
-    await update.message.reply_text(
-        "📧 Input Emails\n\n"
-        "Paste your text with emails. I'll automatically extract valid email addresses!\n\n"
-        "The quantity will be auto-detected from the number of emails found.",
-        reply_markup=reply_markup,
-    )
-    return INPUT_EMAILS
 
-def extract_emails(text):
-    """Extract emails from text (same logic as web version)."""
-    email_regex = r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}'
-    emails = re.findall(email_regex, text)
-    unique_emails = list(set(emails))
-    
-    # Additional validation
-    def is_valid_email(email):
-        return re.match(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$', email)
-    
-    return [email for email in unique_emails if is_valid_email(email)]
-
-def auto_detect_passwords(text, config):
-    """Auto-detect passwords from text (same logic as web version)."""
-    password_patterns = [
-        {"pattern": re.compile(r'prime123', re.IGNORECASE), "prime_pass": "prime123", "mail_pass": "prime123"},
-        {"pattern": re.compile(r'star@683', re.IGNORECASE), "prime_pass": "star@683", "mail_pass": "scar@@00"},
-        {"pattern": re.compile(r'Qwerty1', re.IGNORECASE), "prime_pass": "Qwerty1", "mail_pass": "Qwerty@@00"},
-        {"pattern": re.compile(r'prime100', re.IGNORECASE), "prime_pass": "prime100", "mail_pass": "prime100"},
-        {"pattern": re.compile(r'password123', re.IGNORECASE), "prime_pass": "password123", "mail_pass": "password123"},
-        {"pattern": re.compile(r'admin123', re.IGNORECASE), "prime_pass": "admin123", "mail_pass": "admin@@00"}
-    ]
-    
-    for pattern_info in password_patterns:
-        if pattern_info["pattern"].search(text):
-            config["prime_pass"] = pattern_info["prime_pass"]
-            config["mail_pass"] = pattern_info["mail_pass"]
-            return True, pattern_info
-    
-    return False, None
+MAX_DOCUMENT_SIZE = 20 * 1024 * 1024  # Bot API getFile limit
+
+# Inputs of at least this many bytes are extracted and rendered in a worker process,
+# since the regex scan holds the GIL and would stall every other user's updates
+OFFLOAD_THRESHOLD = int(os.environ.get("OFFLOAD_THRESHOLD", str(256 * 1024)))
+# Default: one per CPU, shared out between the workers of a sharded deployment
+PROCESS_POOL_WORKERS = int(os.environ.get("PROCESS_POOL_WORKERS", "0")) or max(1, (os.cpu_count() or 1) // SHARD_COUNT)
+
+_process_pool = None
+
+def get_process_pool():
+    """Return the shared process pool, creating it on first use."""
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=PROCESS_POOL_WORKERS)
+    return _process_pool
+
+async def run_extraction(source, filename, config: dict, size: int):
+    """Extract emails and detected passwords, offloading inputs of OFFLOAD_THRESHOLD bytes or more."""
+    if size >= OFFLOAD_THRESHOLD:
+        loop = asyncio.get_running_loop()
+        emails, detected, rendered = await loop.run_in_executor(
+            get_process_pool(), extract_and_render, source, filename, dict(config)
+        )
+        # Rendering was done in the worker too; keep it for send_email_output
+        if rendered is not None:
+            cache_rendered(emails, {**config, **detected}, rendered)
+        return emails, detected
+    if filename is None:
+        detected = {}
+        auto_detect_passwords(source, detected)
+        return tuple(extract_emails(source)), detected
+    # Small files: blocking file I/O, keep it off the event loop
+    return await asyncio.to_thread(scan_document, source, filename)
+
+async def leave_input_emails(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Return to the main menu, discarding any accumulated batch."""
+    await answer_query(update)
+    discard_batch(update, context)
+    await show_main_menu(update, context)
 
 async def process_emails(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Process the input emails and generate output."""
@@ -303,13 +977,9 @@ async def process_emails(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     input_text = update.message.text
     config = user_sessions[user_id]["config"]
     
-    # Handle back button
-    if input_text == "🔙 Back to Menu":
-        await show_main_menu(update, context)
-        return MAIN_MENU
-    
-    # Extract emails
-    extracted_emails = extract_emails(input_text)
+    # Extract emails and auto-detect passwords
+    metrics.inc("mailsorter_input_bytes_total", len(input_text.encode("utf-8")), source="text")
+    extracted_emails, detected = await run_extraction(input_text, None, config, len(input_text))
     
     if not extracted_emails:
         await update.message.reply_text(
@@ -317,184 +987,604 @@ async def process_emails(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return INPUT_EMAILS
     
-    # Auto-detect quantity
-    quantity = len(extracted_emails)
+    if detected:
+        config.update(detected)
+        user_sessions.save(user_id)
     
-    # Auto-detect passwords
-    password_detected, pattern_info = auto_detect_passwords(input_text, config)
+    if config_enabled(config, "accumulate"):
+        return await add_to_batch(update, context, extracted_emails)
+    return await send_email_output(update, context, extracted_emails, config)
+
+async def process_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Extract emails from an uploaded text file or archive."""
+    user_id = update.message.from_user.id
+    document = update.message.document
+    config = user_sessions[user_id]["config"]
+    filename = (document.file_name or "").lower()
     
-    # Generate output
-    output = f"{quantity}x -- {config['prime']} -- {config['validity']} ({config['bin_type']})\n\n"
+    if not filename.endswith(DOCUMENT_EXTENSIONS + ARCHIVE_EXTENSIONS):
+        await update.message.reply_text(
+            "❌ Unsupported file type. Send a .txt, .csv or .log file, or a .zip/.gz archive."
+        )
+        return INPUT_EMAILS
     
-    # Add extracted emails with one line space between each
-    for i, email in enumerate(extracted_emails):
-        output += email
-        if i < len(extracted_emails) - 1:
-            output += "\n\n"
-        else:
-            output += "\n"
+    if document.file_size and document.file_size > MAX_DOCUMENT_SIZE:
+        await update.message.reply_text(
+            f"❌ File is too large. Telegram bots can download up to {MAX_DOCUMENT_SIZE // (1024 * 1024)} MB."
+        )
+        return INPUT_EMAILS
     
-    output += f"\npass- {config['prime_pass']}\nmail pass- {config['mail_pass']}"
+    fd, path = tempfile.mkstemp(suffix=os.path.splitext(filename)[1])
+    os.close(fd)
+    try:
+        telegram_file = await document.get_file()
+        await telegram_file.download_to_drive(path)
+        metrics.inc("mailsorter_input_bytes_total", os.path.getsize(path), source="document")
+        # Archives can expand far beyond their download size, so always offload them
+        size = OFFLOAD_THRESHOLD if filename.endswith(ARCHIVE_EXTENSIONS) else os.path.getsize(path)
+        extracted_emails, detected = await run_extraction(path, filename, config, size)
+    except TelegramError as e:
+        logger.warning(f"Could not download uploaded file {document.file_name}: {e}")
+        await update.message.reply_text("❌ Could not download the file from Telegram. Please send it again.")
+        return INPUT_EMAILS
+    except DecompressionLimitError as e:
+        logger.warning(f"Refused uploaded archive {document.file_name}: {e}")
+        await update.message.reply_text(
+            f"❌ This archive expands to more than {MAX_DECOMPRESSED_BYTES // (1024 * 1024)} MB. "
+            "Split it into smaller archives and send them one at a time."
+        )
+        return INPUT_EMAILS
+    except (OSError, zipfile.BadZipFile, EOFError) as e:
+        logger.warning(f"Could not read uploaded file {document.file_name}: {e}")
+        await update.message.reply_text("❌ Could not read the file. Please check it and try again.")
+        return INPUT_EMAILS
+    finally:
+        os.remove(path)
     
-    # Create keyboard with clear option
+    if not extracted_emails:
+        await update.message.reply_text(
+            "❌ No valid email addresses found in the file! Please check it and try again."
+        )
+        return INPUT_EMAILS
+    
+    if detected:
+        config.update(detected)
+        user_sessions.save(user_id)
+    
+    if config_enabled(config, "accumulate"):
+        return await add_to_batch(update, context, extracted_emails)
+    return await send_email_output(update, context, extracted_emails, config)
+
+# Accumulating batches are kept here rather than in user_data: the Application deep-copies
+# user_data for the persistence after every update, and a batch may hold USER_BATCH_MAX_BYTES
+# of emails. Like a paste in flight, an unfinished batch does not survive a restart.
+open_batches = {}  # user_id -> [insertion-ordered dict of emails, raw bytes]
+
+def discard_batch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Forget the user's accumulating batch and the messages collected for it."""
+    open_batches.pop(update.effective_user.id, None)
+    context.user_data.pop('batch_message_ids', None)
+
+async def add_to_batch(update: Update, context: ContextTypes.DEFAULT_TYPE, extracted_emails) -> int:
+    """Merge one paste into the running batch and report the running count."""
+    # An insertion-ordered dict is the dedupe index: merging costs only the size of this paste
+    entry = open_batches.setdefault(update.message.from_user.id, [{}, 0])
+    batch = entry[0]
+    new_emails = [email for email in extracted_emails if email not in batch]
+    size = entry[1] + batch_bytes(new_emails)
+    if size > USER_BATCH_MAX_BYTES:
+        await update.message.reply_text(
+            f"❌ This batch is at its size limit ({USER_BATCH_MAX_BYTES // 1024} KB); this message was not added.\n\n"
+            f"📚 {len(batch)} emails in this batch. Press ✅ Done for the combined output.",
+            reply_markup=input_reply_markup(True),
+        )
+        return INPUT_EMAILS
+    batch.update(dict.fromkeys(new_emails))
+    entry[1] = size
+    added = len(new_emails)
+    
+    message = await update.message.reply_text(
+        f"➕ Added {added} new emails ({len(extracted_emails) - added} duplicates skipped).\n"
+        f"📚 {len(batch)} emails in this batch.\n\n"
+        "Keep pasting, or press ✅ Done for the combined output.",
+        reply_markup=input_reply_markup(True),
+    )
+    # The pastes and acknowledgements are cleared together with the output
+    context.user_data.setdefault('batch_message_ids', []).extend((update.message.message_id, message.message_id))
+    return INPUT_EMAILS
+
+async def finish_batch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Render the accumulated batch as one output."""
+    config = user_sessions[update.message.from_user.id]["config"]
+    if not config_enabled(config, "accumulate"):
+        # Without accumulate mode the button is not shown, so this is ordinary text
+        return await process_emails(update, context)
+    batch = open_batches.pop(update.message.from_user.id, [None])[0]
+    if not batch:
+        await update.message.reply_text(
+            "❌ No emails collected yet. Paste some text first.",
+            reply_markup=input_reply_markup(True),
+        )
+        return INPUT_EMAILS
+    return await send_email_output(update, context, tuple(batch), config)
+
+MAX_OUTPUT_MESSAGES = 5  # Larger outputs are sent as a single .txt document instead
+OUTPUT_CONFIG_KEYS = ("prime", "validity", "bin_type", "prime_pass", "mail_pass", "sort", "allow_domains", "block_domains")
+
+# Rendered outputs kept for Copy Again and repeated batches, bounded by count and by approximate bytes
+RENDER_CACHE_SIZE = 128
+RENDER_CACHE_MAX_BYTES = int(os.environ.get("RENDER_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+class RenderCache:
+    """LRU cache of rendered outputs, bounded by entry count and by their approximate size.
+    
+    Keys hold a digest of the emails instead of the emails themselves, so an
+    entry costs only the rendered text.
+    """
+    
+    def __init__(self, max_entries=RENDER_CACHE_SIZE, max_bytes=RENDER_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()  # key -> (rendered, bytes)
+        self.bytes = 0
+    
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+    
+    def put(self, key, rendered) -> None:
+        size = deep_size(rendered)
+        if size > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        self.entries[key] = (rendered, size)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.bytes -= evicted
+
+render_cache = RenderCache()
+
+def _render_key(emails, config):
+    digest = hashlib.blake2b("\n".join(emails).encode("utf-8"), digest_size=16).digest()
+    return (digest, *(config.get(key, DEFAULT_CONFIG[key]) for key in OUTPUT_CONFIG_KEYS))
+
+def cache_rendered(emails, config, rendered, key=None):
+    """Store an output rendered elsewhere (e.g. in a worker process) in the render cache."""
+    # Batches over the per-user cap are not kept for Copy Again, so their output would only take up room
+    if batch_bytes(emails) > USER_BATCH_MAX_BYTES:
+        return
+    render_cache.put(key or _render_key(emails, config), rendered)
+
+def render_output(emails, config):
+    """Render the `Nx -- prime -- validity (bin)` block and its message-sized parts.
+    
+    Results are cached by (emails, config), so repeated renders of a batch,
+    such as Copy Again, are free.
+    """
+    key = _render_key(emails, config)
+    rendered = render_cache.get(key)
+    if rendered is None:
+        rendered = format_output(emails, config)
+        cache_rendered(emails, config, rendered, key)
+    return rendered
+
+def output_reply_markup():
+    """Inline keyboard attached to the last message of a rendered output.
+    
+    Each button's callback data is its label, so presses are routed by the
+    same BUTTON_ROUTES entries as the reply keyboard buttons they replace.
+    """
     clear_keyboard = [
         ["🧹 Clear Messages", "📋 Copy Again"],
         ["🔙 Back to Menu"]
     ]
-    clear_reply_markup = ReplyKeyboardMarkup(
-        clear_keyboard,
-        one_time_keyboard=True,
-        resize_keyboard=True,
-        input_field_placeholder="Choose an option"
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton(label, callback_data=label) for label in row] for row in clear_keyboard]
     )
+
+async def answer_query(update: Update, text: str = None) -> None:
+    """Answer the callback query behind an inline button press; a no-op for text messages."""
+    if update.callback_query is not None:
+        await update.callback_query.answer(text)
+
+async def reply_with_output(update: Update, rendered, title: str, footer: str) -> list:
+    """Send an output from render_output as one or more messages, or as a document if it is too large.
+    
+    Returns the IDs of the messages sent.
+    """
+    output, parts, _ = rendered
+    
+    if len(parts) > MAX_OUTPUT_MESSAGES:
+        document = io.BytesIO(output.encode("utf-8"))
+        message = await update.effective_message.reply_document(
+            document=document,
+            filename="emails.txt",
+            caption=f"{title}\n\n{footer}",
+            parse_mode="Markdown",
+            reply_markup=output_reply_markup(),
+        )
+        return [message.message_id]
+    
+    message_ids = []
+    for i, part in enumerate(parts):
+        text = f"```\n{part}\n```"
+        if i == 0:
+            text = f"{title}\n\n{text}"
+        if i == len(parts) - 1:
+            message = await update.effective_message.reply_text(
+                f"{text}\n\n{footer}",
+                parse_mode="Markdown",
+                reply_markup=output_reply_markup(),
+            )
+        else:
+            message = await update.effective_message.reply_text(text, parse_mode="Markdown")
+        message_ids.append(message.message_id)
+    return message_ids
+
+# Raw bytes of emails a user may hold: the last batch kept for Copy Again, or an accumulating batch
+USER_BATCH_MAX_BYTES = int(os.environ.get("USER_BATCH_MAX_BYTES", str(4 * 1024 * 1024)))
+
+def batch_bytes(emails):
+    """Raw size of a batch of emails as stored, one per line."""
+    return sum(map(len, emails)) + len(emails)
+
+def pack_emails(emails):
+    """Compress a batch into one blob; about a tenth of the memory of a tuple of strings."""
+    # Addresses never contain a newline, and level 1 already gets most of the ratio
+    return zlib.compress("\n".join(emails).encode("utf-8"), 1)
+
+def unpack_emails(blob):
+    return tuple(zlib.decompress(blob).decode("utf-8").split("\n"))
+
+async def send_email_output(update: Update, context: ContextTypes.DEFAULT_TYPE, extracted_emails, config: dict) -> int:
+    """Send the formatted output for a batch of extracted emails."""
+    extracted_emails = tuple(extracted_emails)
+    quantity = len(extracted_emails)
+    metrics.inc("mailsorter_emails_extracted_total", quantity)
+    
+    rendered = render_output(extracted_emails, config)
+    count = rendered[2]
+    if not count:
+        await update.message.reply_text(
+            f"❌ Your Allow/Block Domains filters left out all {quantity} emails found. "
+            "Change them in Configuration or send other emails."
+        )
+        return INPUT_EMAILS
+    title = f"✅ Found {count} valid emails:"
+    if count < quantity:
+        title = f"✅ Found {count} valid emails ({quantity - count} left out by your domain filters):"
     
     # Send the output with clear options
-    output_message = await update.message.reply_text(
-        f"✅ Found {quantity} valid emails:\n\n```\n{output}\n```\n\n"
+    output_message_ids = await reply_with_output(
+        update,
+        rendered,
+        title,
         "📋 **Copy the output above, then use the buttons below:**\n\n"
         "🧹 **Clear Messages** - Removes all conversation history\n"
         "📋 **Copy Again** - Shows the output again\n"
         "🔙 **Back to Menu** - Return to main menu\n\n"
         f"⏱️ **Auto-clear in {int(config['auto_clear_timer'])//60} minutes** for privacy",
-        parse_mode="Markdown",
-        reply_markup=clear_reply_markup
     )
     
-    # Store the output message ID for potential deletion
-    context.user_data['output_message_id'] = output_message.message_id
-    context.user_data['input_message_id'] = update.message.message_id
-    context.user_data['last_emails'] = extracted_emails  # Store emails for copy_again
+    # Store the output message IDs for potential deletion
+    context.user_data['output_message_ids'] = output_message_ids
+    input_message_ids = [*context.user_data.pop('batch_message_ids', ()), update.message.message_id]
+    context.user_data['input_message_ids'] = input_message_ids
+    # Store emails for copy_again, compressed, unless they exceed the per-user cap
+    size = batch_bytes(extracted_emails)
+    if size > USER_BATCH_MAX_BYTES:
+        context.user_data.pop('last_emails', None)
+    elif size >= OFFLOAD_THRESHOLD:
+        # zlib releases the GIL, so large batches compress without stalling other users
+        context.user_data['last_emails'] = await asyncio.to_thread(pack_emails, extracted_emails)
+    else:
+        context.user_data['last_emails'] = pack_emails(extracted_emails)
     
-    # Start auto-clear timer (5 minutes)
+    # Schedule auto-clear (5 minutes by default)
     chat_id = update.message.chat_id
-    message_ids = [update.message.message_id, output_message.message_id]
-    asyncio.create_task(auto_clear_messages(chat_id, message_ids, int(config['auto_clear_timer'])))
+    message_ids = [*input_message_ids, *output_message_ids]
+    await auto_clear.schedule(chat_id, message_ids, int(config['auto_clear_timer']))
     
     return CLEAR_MESSAGES
 
-async def auto_clear_messages(chat_id: int, message_ids: list, delay_seconds: int = 300):
-    """Automatically clear messages after a delay for privacy."""
-    try:
-        await asyncio.sleep(delay_seconds)  # Wait for 5 minutes by default
+# Outbound Bot API limits, see https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+OVERALL_MAX_RATE = float(os.environ.get("OVERALL_MAX_RATE", "30"))  # Requests per second across all chats
+CHAT_MAX_RATE = float(os.environ.get("CHAT_MAX_RATE", "5"))  # Sends per CHAT_TIME_PERIOD in one private chat
+CHAT_TIME_PERIOD = float(os.environ.get("CHAT_TIME_PERIOD", "5"))
+GROUP_MAX_RATE = float(os.environ.get("GROUP_MAX_RATE", "20"))  # Sends per minute in one group
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", "3"))
+RETRY_BACKOFF = 0.5  # Seconds before the first retry of a failed deletion, doubled on each attempt
+DELETE_MESSAGES_LIMIT = 100  # Message ids the Bot API accepts in one deleteMessages call
+
+class OutboundRateLimiter(AIORateLimiter):
+    """AIORateLimiter that also paces sends to each private chat and counts queued requests.
+    
+    AIORateLimiter already applies the global and per-group limits and
+    retries on RetryAfter; private chats only get the global limit there.
+    """
+    
+    def __init__(self, chat_max_rate=CHAT_MAX_RATE, chat_time_period=CHAT_TIME_PERIOD, **kwargs):
+        super().__init__(**kwargs)
+        self.chat_max_rate = chat_max_rate
+        self.chat_time_period = chat_time_period
+        self.chat_limiters = {}
+        self.pending = 0  # Requests waiting for a slot or in flight
+    
+    def _get_chat_limiter(self, chat_id):
+        # Forget limiters whose capacity is fully restored, same as AIORateLimiter does for groups
+        if len(self.chat_limiters) > 512:
+            for key, limiter in list(self.chat_limiters.items()):
+                if key != chat_id and limiter.has_capacity(limiter.max_rate):
+                    del self.chat_limiters[key]
+        if chat_id not in self.chat_limiters:
+            self.chat_limiters[chat_id] = AsyncLimiter(self.chat_max_rate, self.chat_time_period)
+        return self.chat_limiters[chat_id]
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        async def timed_callback(*args, **kwargs):
+            # Timed inside the limiter so the histogram shows API latency, not queueing
+            started = time.perf_counter()
+            try:
+                return await callback(*args, **kwargs)
+            except Exception:
+                metrics.inc("mailsorter_bot_api_errors_total", endpoint=endpoint)
+                raise
+            finally:
+                metrics.observe("mailsorter_bot_api_duration_seconds", time.perf_counter() - started, endpoint=endpoint)
         
-        # Try to delete each message
-        for msg_id in message_ids:
+        self.pending += 1
+        try:
+            chat_id = data.get("chat_id")
+            with contextlib.suppress(ValueError, TypeError):
+                chat_id = int(chat_id)
+            # Only sends count against a chat's limit; deletions and edits do not
+            if endpoint.startswith("send") and isinstance(chat_id, int) and chat_id > 0 and self.chat_max_rate:
+                async with self._get_chat_limiter(chat_id):
+                    return await super().process_request(timed_callback, args, kwargs, endpoint, data, rate_limit_args)
+            return await super().process_request(timed_callback, args, kwargs, endpoint, data, rate_limit_args)
+        finally:
+            self.pending -= 1
+
+class DeletionQueue:
+    """Coalesce message deletions per chat and send them in bulk, retrying with backoff.
+    
+    Handlers enqueue deletions and return immediately; one background task
+    drains the queue through the rate-limited bot.
+    """
+    
+    def __init__(self, max_retries=OUTBOUND_MAX_RETRIES):
+        self.max_retries = max_retries
+        self.pending = {}  # chat_id -> message ids, in insertion order
+        self.ready = asyncio.Event()
+    
+    @property
+    def depth(self) -> int:
+        """Number of messages waiting to be deleted."""
+        return sum(len(message_ids) for message_ids in self.pending.values())
+    
+    def delete(self, chat_id: int, message_ids) -> None:
+        """Queue message_ids in chat_id for deletion."""
+        self.pending.setdefault(chat_id, []).extend(message_ids)
+        self.ready.set()
+    
+    async def run(self, bot) -> None:
+        """Drain the queue, one concurrent batch per chat."""
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            # Deletions queued while this round runs are coalesced into the next one
+            batch, self.pending = self.pending, {}
+            await asyncio.gather(*(self._delete(bot, chat_id, message_ids) for chat_id, message_ids in batch.items()))
+    
+    async def _delete(self, bot, chat_id: int, message_ids: list) -> None:
+        message_ids = list(dict.fromkeys(message_ids))
+        for start in range(0, len(message_ids), DELETE_MESSAGES_LIMIT):
+            await self._call(bot, chat_id, message_ids[start:start + DELETE_MESSAGES_LIMIT])
+    
+    async def _call(self, bot, chat_id, message_ids) -> None:
+        for attempt in range(self.max_retries + 1):
             try:
-                # We need to get the bot instance from somewhere
-                # For now, we'll just log that auto-clear would happen
-                logger.info(f"Auto-clear would delete message {msg_id} in chat {chat_id}")
+                await bot.delete_messages(chat_id, message_ids)
+                return
+            except BadRequest as e:
+                # Already deleted, or older than the 48 hours Telegram allows; retrying cannot help
+                logger.warning(f"Could not delete message(s) {message_ids} in chat {chat_id}: {e}")
+                return
+            except RetryAfter as e:
+                delay = e.retry_after
+            except (TimedOut, NetworkError) as e:
+                delay = RETRY_BACKOFF * 2 ** attempt
+                logger.info(f"Deleting in chat {chat_id} failed ({e}), retrying in {delay:.1f}s")
             except Exception as e:
-                logger.warning(f"Could not auto-delete message {msg_id}: {e}")
-                
-    except Exception as e:
-        logger.error(f"Error in auto-clear: {e}")
+                logger.warning(f"Could not delete message(s) {message_ids} in chat {chat_id}: {e}")
+                return
+            if attempt < self.max_retries:
+                await asyncio.sleep(delay)
+        logger.warning(f"Giving up deleting message(s) {message_ids} in chat {chat_id}")
+
+deletion_queue = DeletionQueue()
+
+AUTO_CLEAR_BATCH_SIZE = 100  # Due deletions handled per scheduler wakeup
+
+class AutoClearScheduler:
+    """Single timer heap of pending message deletions for the auto-clear feature.
+    
+    Deletions are persisted in the session backend, so they survive a
+    restart, and handed to the deletion queue by one background task
+    instead of a sleeping task per batch; the queue coalesces them per chat.
+    """
+    
+    def __init__(self, backend):
+        self.backend = backend
+        self.heap = []  # (due, deletion_id, chat_id, message_ids)
+        self.wakeup = asyncio.Event()
+    
+    def load(self):
+        """Load deletions persisted by a previous run, for the chats of this worker's shard."""
+        # Private chat ids are the user ids the ingress shards by
+        self.heap = [
+            (due, deletion_id, chat_id, message_ids)
+            for deletion_id, chat_id, message_ids, due in self.backend.load_deletions()
+            if in_shard(chat_id)
+        ]
+        heapq.heapify(self.heap)
+        if self.heap:
+            logger.info(f"Restored {len(self.heap)} pending auto-clear deletions")
+    
+    async def schedule(self, chat_id: int, message_ids: list, delay_seconds: int) -> None:
+        """Delete message_ids in chat_id after delay_seconds; 0 disables auto-clear."""
+        if delay_seconds <= 0:
+            return
+        due = time.time() + delay_seconds
+        deletion_id = await asyncio.to_thread(self.backend.add_deletion, chat_id, message_ids, due)
+        heapq.heappush(self.heap, (due, deletion_id, chat_id, list(message_ids)))
+        if self.heap[0][1] == deletion_id:
+            self.wakeup.set()
+    
+    def stats(self) -> dict:
+        """Return the number of pending deletions and how many of them are overdue."""
+        now = time.time()
+        return {
+            "pending": len(self.heap),
+            "overdue": sum(1 for due, *_ in self.heap if due <= now),
+        }
+    
+    async def run(self) -> None:
+        """Queue messages for deletion as they fall due."""
+        while True:
+            self.wakeup.clear()
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            now = time.time()
+            due = []
+            while self.heap and self.heap[0][0] <= now and len(due) < AUTO_CLEAR_BATCH_SIZE:
+                due.append(heapq.heappop(self.heap))
+            
+            try:
+                for _, _, chat_id, message_ids in due:
+                    deletion_queue.delete(chat_id, message_ids)
+                await asyncio.to_thread(self.backend.remove_deletions, [entry[1] for entry in due])
+            except Exception as e:
+                logger.error(f"Error in auto-clear: {e}")
+            
+            if self.heap:
+                logger.info(f"Auto-clear: {len(due)} processed, {self.stats()}")
+
+auto_clear = AutoClearScheduler(user_sessions.backend)
 
 async def copy_again(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Show the output again for copying."""
-    user_id = update.message.from_user.id
+    # An inline press sends the output again but leaves the conversation in its state
+    inline = update.callback_query is not None
+    message = update.effective_message
+    user_id = update.effective_user.id
     config = user_sessions[user_id]["config"]
     
     # Get the stored emails from context (we'll need to store them)
     if 'last_emails' not in context.user_data:
-        await update.message.reply_text(
+        if inline:
+            await answer_query(update, "❌ No previous emails found. Please process emails again.")
+            return None
+        await message.reply_text(
             "❌ No previous emails found. Please process emails again.",
             reply_markup=ReplyKeyboardRemove()
         )
         await show_main_menu(update, context)
         return MAIN_MENU
+    await answer_query(update)
     
-    extracted_emails = context.user_data['last_emails']
-    quantity = len(extracted_emails)
-    
-    # Generate output again
-    output = f"{quantity}x -- {config['prime']} -- {config['validity']} ({config['bin_type']})\n\n"
-    
-    # Add extracted emails with one line space between each
-    for i, email in enumerate(extracted_emails):
-        output += email
-        if i < len(extracted_emails) - 1:
-            output += "\n\n"
-        else:
-            output += "\n"
-    
-    output += f"\npass- {config['prime_pass']}\nmail pass- {config['mail_pass']}"
-    
-    # Create keyboard with clear option
-    clear_keyboard = [
-        ["🧹 Clear Messages", "📋 Copy Again"],
-        ["🔙 Back to Menu"]
-    ]
-    clear_reply_markup = ReplyKeyboardMarkup(
-        clear_keyboard,
-        one_time_keyboard=True,
-        resize_keyboard=True,
-        input_field_placeholder="Choose an option"
-    )
+    blob = context.user_data['last_emails']
+    if len(blob) >= OFFLOAD_THRESHOLD // 8:
+        emails = await asyncio.to_thread(unpack_emails, blob)
+    else:
+        emails = unpack_emails(blob)
     
-    # Send the output again
-    output_message = await update.message.reply_text(
-        f"📋 **Output again for copying:**\n\n```\n{output}\n```\n\n"
+    # Send the output again; unchanged emails and config are served from the render cache
+    rendered = render_output(emails, config)
+    if not rendered[2]:
+        # The domain filters were changed since the output was sent
+        await message.reply_text("❌ Your Allow/Block Domains filters now leave out every email of the last batch.")
+        return None if inline else CLEAR_MESSAGES
+    output_message_ids = await reply_with_output(
+        update,
+        rendered,
+        "📋 **Output again for copying:**",
         "📋 **Copy the output above, then use the buttons below:**\n\n"
         "🧹 **Clear Messages** - Removes all conversation history\n"
         "📋 **Copy Again** - Shows the output again\n"
         "🔙 **Back to Menu** - Return to main menu",
-        parse_mode="Markdown",
-        reply_markup=clear_reply_markup
     )
     
-    # Store the new output message ID
-    context.user_data['output_message_id'] = output_message.message_id
+    # Track the new output messages alongside the earlier ones for clearing
+    context.user_data.setdefault('output_message_ids', []).extend(output_message_ids)
     
-    return CLEAR_MESSAGES
+    # The repeated output is auto-cleared like the first one, with the typed button text that asked for it
+    requests = [] if inline else [message.message_id]
+    await auto_clear.schedule(message.chat_id, [*requests, *output_message_ids], int(config['auto_clear_timer']))
+    
+    return None if inline else CLEAR_MESSAGES
 
-async def clear_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def clear_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Clear all messages from the conversation."""
-    user_id = update.message.from_user.id
-    chat_id = update.message.chat_id
+    chat_id = update.effective_chat.id
     
     try:
-        # Delete the current clear button message
-        await context.bot.delete_message(chat_id, update.message.message_id)
-        
-        # Delete stored messages if they exist
-        messages_to_delete = []
+        await answer_query(update)
+        # Delete the message the button was pressed on (the user's text, or the
+        # output carrying the inline keyboard) and the stored messages
+        messages_to_delete = [update.effective_message.message_id]
         
-        if 'output_message_id' in context.user_data:
-            messages_to_delete.append(context.user_data['output_message_id'])
-            del context.user_data['output_message_id']
+        if 'output_message_ids' in context.user_data:
+            messages_to_delete.extend(context.user_data['output_message_ids'])
+            del context.user_data['output_message_ids']
         
-        if 'input_message_id' in context.user_data:
-            messages_to_delete.append(context.user_data['input_message_id'])
-            del context.user_data['input_message_id']
+        if 'input_message_ids' in context.user_data:
+            messages_to_delete.extend(context.user_data['input_message_ids'])
+            del context.user_data['input_message_ids']
         
-        # Delete the messages
-        for msg_id in messages_to_delete:
-            try:
-                await context.bot.delete_message(chat_id, msg_id)
-            except Exception as e:
-                logger.warning(f"Could not delete message {msg_id}: {e}")
+        # Deleted in the background, in one bulk request where the API allows it
+        deletion_queue.delete(chat_id, messages_to_delete)
         
         # Show main menu directly without confirmation message
         await show_main_menu(update, context)
-        return MAIN_MENU
         
     except Exception as e:
         logger.error(f"Error clearing messages: {e}")
-        await update.message.reply_text(
+        await update.effective_message.reply_text(
             "❌ Error clearing messages. Please try again.",
             reply_markup=ReplyKeyboardRemove()
         )
         await show_main_menu(update, context)
-        return MAIN_MENU
 
-async def reset_configuration(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def leave_output(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Return to the main menu, leaving the output in the chat."""
+    await answer_query(update)
+    await show_main_menu(update, context)
+
+async def expired_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Answer inline button presses no conversation state handles, e.g. after /cancel."""
+    await answer_query(update, "⌛ This button has expired. Send /start to begin again.")
+
+async def reset_configuration(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Reset configuration to defaults."""
     user_id = update.message.from_user.id
     user_sessions[user_id]["config"] = DEFAULT_CONFIG.copy()
+    user_sessions.save(user_id)
     
     await update.message.reply_text("✅ Configuration reset to default values!")
     await show_main_menu(update, context)
-    return MAIN_MENU
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancel the conversation."""
@@ -502,6 +1592,7 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         "👋 Operation cancelled. Type /start to begin again.",
         reply_markup=ReplyKeyboardRemove(),
     )
+    # Also the /cancel fallback, whose CommandHandler takes the state from here
     return ConversationHandler.END
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -515,6 +1606,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "Features:\n"
         "• Password protection\n"
         "• Automatic email extraction from any text\n"
+        "• Text file and .zip/.gz archive uploads\n"
+        "• Accumulate mode: one output for a batch sent over several messages\n"
         "• Configuration settings\n"
         "• Password auto-detection\n"
         "• Clean, formatted output\n"
@@ -528,10 +1621,464 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     )
     await update.message.reply_text(help_text)
 
-def main() -> None:
-    """Run the bot."""
-    # Create the Application and pass it your bot's token.
-    application = Application.builder().token("7978004292:AAGtcPQEL7oZXAsef1ZR_sMy26BR2mIOb2g").build()
+class ButtonRouter(BaseHandler):
+    """Route keyboard button presses to callbacks with a single dict lookup.
+    
+    routes maps an exact button label to (callback, next_state). When
+    next_state is not None it is the state the conversation moves to,
+    whatever the callback returns.
+    
+    A router matches the text of reply keyboard presses, or with inline the
+    callback data of inline button presses, which is the button's label.
+    Callbacks reachable from an inline button answer its query themselves
+    (see answer_query).
+    """
+    
+    def __init__(self, routes, inline=False):
+        super().__init__(self.dispatch)
+        self.routes = dict(routes)
+        self.inline = inline
+    
+    def check_update(self, update):
+        if not isinstance(update, Update):
+            return None
+        if self.inline:
+            query = update.callback_query
+            if query is not None and query.message is not None:
+                return self.routes.get(query.data)
+        elif update.message is not None and update.message.text is not None:
+            return self.routes.get(update.message.text)
+        return None
+    
+    async def handle_update(self, update, application, check_result, context):
+        # check_result is the route check_update found, so the label is not looked up twice
+        callback, next_state = check_result
+        state = await callback(update, context)
+        return state if next_state is None else next_state
+    
+    async def dispatch(self, update, context):
+        return await self.handle_update(update, None, self.check_update(update), context)
+    
+    def wrap_callbacks(self, wrapper) -> None:
+        """Replace every route callback with wrapper(callback), wrapping each callback once."""
+        wrapped = {}
+        for label, (callback, next_state) in self.routes.items():
+            if callback not in wrapped:
+                wrapped[callback] = wrapper(callback)
+            self.routes[label] = (wrapped[callback], next_state)
+
+# user_data of users without an update for this long is dropped; their settings stay in user_sessions
+USER_DATA_IDLE_TIMEOUT = int(os.environ.get("USER_DATA_IDLE_TIMEOUT", "3600"))
+USER_DATA_SWEEP_INTERVAL = 60
+
+def deep_size(obj):
+    """Approximate bytes held by obj and the containers and strings inside it."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key) + deep_size(value) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item) for item in obj)
+    return size
+
+class UserDataSweeper:
+    """Drop the user_data and open batches of idle users and keep a tally of the bytes held per user.
+    
+    Sizes are only recomputed for users active since the previous sweep, so
+    a sweep costs time proportional to recent activity, not to all users.
+    """
+    
+    def __init__(self, idle_timeout=USER_DATA_IDLE_TIMEOUT, interval=USER_DATA_SWEEP_INTERVAL):
+        self.idle_timeout = idle_timeout
+        self.interval = interval
+        self.last_active = {}  # user_id -> time.monotonic() of their latest update
+        self.sizes = {}  # user_id -> bytes held in user_data at the last sweep
+        self.last_sweep = time.monotonic()
+    
+    def touch(self, user_id: int) -> None:
+        self.last_active[user_id] = time.monotonic()
+    
+    def sweep(self, application) -> int:
+        """Drop idle users' user_data, refresh the size tally, and return how many users were dropped."""
+        now = time.monotonic()
+        cutoff = now - self.idle_timeout
+        for user_id in application.user_data:
+            # Loaded from persistence at startup: idle from now on
+            self.last_active.setdefault(user_id, now)
+        idle = [user_id for user_id, active in self.last_active.items() if active < cutoff]
+        for user_id in idle:
+            del self.last_active[user_id]
+            self.sizes.pop(user_id, None)
+            open_batches.pop(user_id, None)
+            if user_id in application.user_data:
+                application.drop_user_data(user_id)
+        for user_id, active in self.last_active.items():
+            if active >= self.last_sweep or user_id not in self.sizes:
+                held = (application.user_data.get(user_id), open_batches.get(user_id))
+                self.sizes[user_id] = sum(deep_size(data) for data in held if data is not None)
+        self.last_sweep = now
+        return len(idle)
+    
+    def stats(self) -> dict:
+        return {
+            "users": len(self.sizes),
+            "bytes": sum(self.sizes.values()),
+            "max_bytes": max(self.sizes.values(), default=0),
+        }
+    
+    async def run(self, application) -> None:
+        """Sweep every interval seconds until cancelled."""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                dropped = self.sweep(application)
+                if dropped:
+                    stats = self.stats()
+                    logger.info(
+                        f"Dropped user_data of {dropped} idle users; holding {stats['bytes'] // 1024} KiB "
+                        f"for {stats['users']} users (largest {stats['max_bytes'] // 1024} KiB)"
+                    )
+            except Exception as e:
+                logger.error(f"Error sweeping user data: {e}")
+
+user_data_sweeper = UserDataSweeper()
+
+# Maximum number of updates handled at once across all users
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "64"))
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently across users but strictly in order for each user.
+    
+    ConversationHandler keeps one state per user, so two updates from the
+    same user must never be handled at the same time.
+    
+    The base class takes a concurrency slot before do_process_update runs,
+    so a user's queued updates would each hold one while they wait for that
+    user's lock, and one busy user could use up every slot. Its limit is
+    therefore left unbounded and max_concurrent_updates is enforced here,
+    after the user's lock is taken.
+    """
+    
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(sys.maxsize)
+        self.slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self.user_locks = {}  # user_id -> [lock, updates holding or waiting for it]
+    
+    async def do_process_update(self, update, coroutine) -> None:
+        # Only updates that arrive once a profile is armed count towards it, not the /profile command itself
+        profiled = update_profiler.active
+        try:
+            await self.process_in_order(update, coroutine)
+        finally:
+            if profiled:
+                update_profiler.update_done()
+    
+    async def process_in_order(self, update, coroutine) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self.slots:
+                await coroutine
+            return
+        user_data_sweeper.touch(user.id)
+        # asyncio.Lock wakes waiters first-in first-out, so arrival order is kept
+        entry = self.user_locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self.slots:
+                # Handlers read the session synchronously, so a cold one is loaded off the event loop first
+                await user_sessions.prefetch(user.id)
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.user_locks[user.id]
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
+
+# Telegram user ids allowed to run /profile and /memory, comma separated. Admins do not need BOT_PASSWORD
+# and other users get no answer to these commands; leave empty to disable them.
+ADMIN_IDS = frozenset(int(user_id) for user_id in os.environ.get("ADMIN_IDS", "").replace(" ", "").split(",") if user_id)
+# Directory that also keeps a copy of every profile and memory report; empty to only send them to the chat
+DIAGNOSTICS_DIR = os.environ.get("DIAGNOSTICS_DIR", "")
+PROFILE_DEFAULT_UPDATES = 100
+PROFILE_MAX_UPDATES = 10000
+DIAGNOSTICS_TOP_ENTRIES = 40  # Rows per table in profile and memory reports
+TRACEMALLOC_FRAMES = 10  # Stack frames recorded per allocation while memory tracing is on
+
+async def send_diagnostics(bot, chat_id: int, filename: str, text: str, caption: str) -> None:
+    """Send a report as a text document, keeping a copy in DIAGNOSTICS_DIR when it is set."""
+    if DIAGNOSTICS_DIR:
+        os.makedirs(DIAGNOSTICS_DIR, exist_ok=True)
+        path = os.path.join(DIAGNOSTICS_DIR, filename)
+        with open(path, "w", encoding="utf-8") as handle:
+            handle.write(text)
+        caption += f"\nSaved to {path}"
+    if SHARD_COUNT > 1:
+        caption += f"\nWorker {SHARD_INDEX} of {SHARD_COUNT}"
+    await bot.send_document(chat_id, document=io.BytesIO(text.encode("utf-8")), filename=filename, caption=caption)
+
+class UpdateProfiler:
+    """Profile the event loop while the next N updates are handled, then send the report.
+    
+    cProfile records every call on the event loop thread, handlers and
+    library code alike, so it only runs while a profile is armed. Time spent
+    waiting on the Bot API, in worker threads or in the extraction process
+    pool does not show up; a coroutine's cumulative time is the CPU time of
+    its steps on the loop.
+    """
+    
+    def __init__(self):
+        self.profile = None
+        self.updates = 0
+        self.remaining = 0
+        self.started = 0.0
+        self.bot = None
+        self.chat_id = None
+        self.tasks = set()  # Reports being sent
+    
+    @property
+    def active(self) -> bool:
+        return self.profile is not None
+    
+    def start(self, updates: int, bot, chat_id: int) -> None:
+        self.updates = self.remaining = updates
+        self.bot = bot
+        self.chat_id = chat_id
+        self.started = time.perf_counter()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+    
+    def update_done(self) -> None:
+        """Count one profiled update and finish the profile after the last one."""
+        self.remaining -= 1
+        if self.remaining <= 0:
+            self.finish()
+    
+    def finish(self) -> None:
+        """Stop profiling and send the report in the background."""
+        if self.profile is None:
+            return
+        self.profile.disable()
+        profile, self.profile = self.profile, None
+        handled = self.updates - max(self.remaining, 0)
+        elapsed = time.perf_counter() - self.started
+        task = asyncio.create_task(self.send_report(profile, handled, elapsed, self.bot, self.chat_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+    
+    def render(self, profile, handled: int, elapsed: float) -> str:
+        out = io.StringIO()
+        stats = pstats.Stats(profile, stream=out)
+        # The profiler's clock keeps running while the loop waits for I/O in its selector, so leave that out
+        idle = sum(
+            cumtime for (filename, _, name), (_, _, _, cumtime, _) in stats.stats.items()
+            if filename == selectors.__file__ and name == "select"
+        )
+        loop_time = max(stats.total_tt - idle, 0.0)
+        out.write(
+            f"Profile of {handled} updates over {elapsed:.1f}s, {loop_time:.3f}s of it busy on the event loop "
+            f"({loop_time / max(handled, 1) * 1000:.2f} ms per update)\n\n"
+        )
+        # Handler callbacks are the functions of this module that instrumented() wrapped
+        this_file = instrumented.__code__.co_filename
+        handlers = sorted(
+            ((cumtime, tottime, name) for (filename, _, name), (_, _, tottime, cumtime, _) in stats.stats.items()
+             if filename == this_file and name in handler_names),
+            reverse=True,
+        )
+        out.write("Handlers by cumulative time:\n")
+        out.write(f"{'cumtime':>10} {'tottime':>10} {'share':>6}  handler\n")
+        for cumtime, tottime, name in handlers[:DIAGNOSTICS_TOP_ENTRIES]:
+            share = cumtime / loop_time * 100 if loop_time else 0.0
+            out.write(f"{cumtime:10.4f} {tottime:10.4f} {share:5.1f}%  {name}\n")
+        out.write("\nFunctions by cumulative time:\n")
+        stats.strip_dirs().sort_stats(pstats.SortKey.CUMULATIVE).print_stats(DIAGNOSTICS_TOP_ENTRIES)
+        return out.getvalue()
+    
+    async def send_report(self, profile, handled: int, elapsed: float, bot, chat_id: int) -> None:
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        try:
+            text = self.render(profile, handled, elapsed)
+            if DIAGNOSTICS_DIR:
+                # The raw stats too, for pstats or a viewer such as snakeviz
+                os.makedirs(DIAGNOSTICS_DIR, exist_ok=True)
+                profile.dump_stats(os.path.join(DIAGNOSTICS_DIR, f"profile-{stamp}.pstats"))
+            await send_diagnostics(bot, chat_id, f"profile-{stamp}.txt", text, f"Profile of {handled} updates")
+        except Exception as e:
+            logger.error(f"Error sending profile report: {e}")
+
+update_profiler = UpdateProfiler()
+
+def memory_report(application) -> str:
+    """Describe traced memory by allocation site and the bytes held in sessions and user_data."""
+    snapshot = tracemalloc.take_snapshot()
+    traced, peak = tracemalloc.get_traced_memory()
+    session_bytes = deep_size(user_sessions.cache)
+    user_data_sizes = [deep_size(data) for data in application.user_data.values()]
+    out = io.StringIO()
+    out.write(
+        f"Memory snapshot, {time.strftime('%Y-%m-%d %H:%M:%S')}\n"
+        f"Traced: {traced // 1024} KiB now, peak {peak // 1024} KiB (allocations made since tracing started)\n"
+        f"user_sessions: {len(user_sessions.cache)} cached sessions, ~{session_bytes // 1024} KiB\n"
+        f"user_data: {len(user_data_sizes)} users, ~{sum(user_data_sizes) // 1024} KiB "
+        f"(largest {max(user_data_sizes, default=0) // 1024} KiB)\n\n"
+        "Allocation sites by size:\n"
+    )
+    for stat in snapshot.statistics("lineno")[:DIAGNOSTICS_TOP_ENTRIES]:
+        out.write(f"{stat}\n")
+    out.write("\nLargest allocation sites with their call stacks:\n")
+    for stat in snapshot.statistics("traceback")[:10]:
+        out.write(f"\n{stat.size // 1024} KiB in {stat.count} blocks\n")
+        out.write("\n".join(stat.traceback.format(most_recent_first=True)) + "\n")
+    return out.getvalue()
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Profile the next N updates and send the time spent per handler (admins only).
+    
+    /profile [N] arms the profiler, /profile stop reports early.
+    """
+    if context.args and context.args[0] == "stop":
+        if update_profiler.active:
+            update_profiler.finish()
+        else:
+            await update.message.reply_text("No profile is running.")
+        return
+    if update_profiler.active:
+        await update.message.reply_text(
+            f"A profile is already running, {update_profiler.remaining} updates to go. Send /profile stop to end it."
+        )
+        return
+    try:
+        updates = int(context.args[0]) if context.args else PROFILE_DEFAULT_UPDATES
+    except ValueError:
+        updates = 0
+    if not 1 <= updates <= PROFILE_MAX_UPDATES:
+        await update.message.reply_text(f"Usage: /profile [updates, 1-{PROFILE_MAX_UPDATES}] or /profile stop")
+        return
+    update_profiler.start(updates, context.bot, update.effective_chat.id)
+    await update.message.reply_text(f"Profiling the next {updates} updates; the report follows when they are handled.")
+
+async def memory_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Send a snapshot of memory by allocation site (admins only).
+    
+    Tracing only sees allocations made after it starts, so the first /memory
+    turns it on and the next one sends the snapshot. /memory stop turns it
+    off again, since tracing slows every allocation down.
+    """
+    if context.args and context.args[0] == "stop":
+        tracemalloc.stop()
+        await update.message.reply_text("Memory tracing stopped.")
+        return
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        await update.message.reply_text(
+            "Memory tracing started. Send /memory again for a snapshot once the bot has handled some traffic, "
+            "and /memory stop when you are done."
+        )
+        return
+    report = memory_report(context.application)
+    await send_diagnostics(
+        context.bot, update.effective_chat.id, f"memory-{time.strftime('%Y%m%d-%H%M%S')}.txt", report, "Memory snapshot"
+    )
+
+# Long-running tasks started in on_startup and cancelled in on_shutdown. post_init
+# runs before the application is started, so Application.create_task cannot track them.
+_background_tasks = []
+_metrics_server = None
+
+async def on_startup(application: Application) -> None:
+    """Start background tasks once the application is initialized."""
+    global _metrics_server
+    if METRICS_PORT:
+        _metrics_server = await asyncio.start_server(serve_metrics, METRICS_HOST, METRICS_PORT)
+        logger.info(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    auto_clear.load()
+    _background_tasks.extend([
+        asyncio.create_task(user_sessions.run_flusher()),
+        asyncio.create_task(deletion_queue.run(application.bot)),
+        asyncio.create_task(auto_clear.run()),
+        asyncio.create_task(user_data_sweeper.run(application)),
+    ])
+
+async def on_shutdown(application: Application) -> None:
+    """Stop background tasks and persist pending session changes before exiting."""
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    if _metrics_server is not None:
+        _metrics_server.close()
+    user_sessions.flush()
+    user_sessions.backend.close()
+    if _process_pool is not None:
+        _process_pool.shutdown(cancel_futures=True)
+
+# Keyboard buttons per conversation state: label -> (callback, next state or None to use the callback's)
+BUTTON_ROUTES = {
+    MAIN_MENU: {
+        "⚙️ Configuration": (show_configuration, CONFIG),
+        "📧 Input Emails": (request_emails, INPUT_EMAILS),
+        "🧹 Clear Messages": (clear_messages, MAIN_MENU),
+        "🔄 Reset": (reset_configuration, MAIN_MENU),
+        "❌ Cancel": (cancel, ConversationHandler.END),
+    },
+    CONFIG: {
+        "✅ Done": (finish_configuration, MAIN_MENU),
+        "🔙 Back to Menu": (leave_configuration, MAIN_MENU),
+        **{setting_name: (choose_setting, CONFIG) for setting_name in DEFAULT_CONFIG},
+    },
+    INPUT_EMAILS: {
+        # Depends on the batch: more input, an output, or process_emails without accumulate
+        "✅ Done": (finish_batch, None),
+        "🔙 Back to Menu": (leave_input_emails, MAIN_MENU),
+    },
+    CLEAR_MESSAGES: {
+        "🧹 Clear Messages": (clear_messages, MAIN_MENU),
+        # Stays put for an inline press, back to the menu when no batch is kept
+        "📋 Copy Again": (copy_again, None),
+        "🔙 Back to Menu": (leave_output, MAIN_MENU),
+    },
+}
+
+# Inline buttons under an output (see output_reply_markup), by state. The keyboard stays on
+# the message after the conversation moves on, so they are routed in every signed-in state,
+# and a button the state also has on its reply keyboard does the same there: Back while
+# accumulating discards the batch like the reply keyboard's Back does.
+OUTPUT_BUTTON_ROUTES = {
+    state: {label: routes.get(label, route) for label, route in BUTTON_ROUTES[CLEAR_MESSAGES].items()}
+    for state, routes in BUTTON_ROUTES.items()
+}
+
+def build_application(token: str = BOT_TOKEN, base_url: str = BOT_API_URL or None) -> Application:
+    """Build the Application with all handlers registered.
+    
+    base_url points the bot at a different Bot API server, e.g. a local
+    stand-in for load testing.
+    """
+    rate_limiter = OutboundRateLimiter(
+        chat_max_rate=CHAT_MAX_RATE,
+        # The overall limit is per bot token, so sharded workers split it; chats stay on one worker
+        overall_max_rate=OVERALL_MAX_RATE / SHARD_COUNT,
+        group_max_rate=GROUP_MAX_RATE,
+        max_retries=OUTBOUND_MAX_RETRIES,
+    )
+    builder = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .rate_limiter(rate_limiter)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(f"{base_url}/bot").base_file_url(f"{base_url}/file/bot")
+    persistence = create_persistence()
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    application = builder.build()
 
     # Add conversation handler with the states
     conv_handler = ConversationHandler(
@@ -539,29 +2086,139 @@ def main() -> None:
         states={
             PASSWORD: [MessageHandler(filters.TEXT & ~filters.COMMAND, verify_password)],
             MAIN_MENU: [
-                MessageHandler(filters.Regex("^⚙️ Configuration$"), show_configuration),
-                MessageHandler(filters.Regex("^📧 Input Emails$"), request_emails),
-                MessageHandler(filters.Regex("^🧹 Clear Messages$"), clear_messages),
-                MessageHandler(filters.Regex("^🔄 Reset$"), reset_configuration),
-                MessageHandler(filters.Regex("^❌ Cancel$"), cancel),
+                ButtonRouter(BUTTON_ROUTES[MAIN_MENU]),
+                ButtonRouter(OUTPUT_BUTTON_ROUTES[MAIN_MENU], inline=True),
             ],
             CONFIG: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, update_configuration)
+                ButtonRouter(BUTTON_ROUTES[CONFIG]),
+                ButtonRouter(OUTPUT_BUTTON_ROUTES[CONFIG], inline=True),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, update_configuration),
             ],
             INPUT_EMAILS: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, process_emails)
+                ButtonRouter(BUTTON_ROUTES[INPUT_EMAILS]),
+                ButtonRouter(OUTPUT_BUTTON_ROUTES[INPUT_EMAILS], inline=True),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, process_emails),
+                MessageHandler(filters.Document.ALL, process_document),
             ],
             CLEAR_MESSAGES: [
-                MessageHandler(filters.Regex("^🧹 Clear Messages$"), clear_messages),
-                MessageHandler(filters.Regex("^📋 Copy Again$"), copy_again),
-                MessageHandler(filters.Regex("^🔙 Back to Menu$"), show_main_menu),
+                ButtonRouter(BUTTON_ROUTES[CLEAR_MESSAGES]),
+                ButtonRouter(OUTPUT_BUTTON_ROUTES[CLEAR_MESSAGES], inline=True),
             ],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="mailsorter",
+        persistent=persistence is not None,
     )
 
+    # Record latency and errors of every callback
+    for handler in [*conv_handler.entry_points, *itertools.chain(*conv_handler.states.values()), *conv_handler.fallbacks]:
+        if isinstance(handler, ButtonRouter):
+            handler.wrap_callbacks(instrumented)
+        else:
+            handler.callback = instrumented(handler.callback)
+
     application.add_handler(conv_handler)
-    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("help", instrumented(help_command)))
+    application.add_handler(CallbackQueryHandler(instrumented(expired_button)))
+    if ADMIN_IDS:
+        admins = filters.User(user_id=ADMIN_IDS)
+        application.add_handler(CommandHandler("profile", instrumented(profile_command), filters=admins))
+        application.add_handler(CommandHandler("memory", instrumented(memory_command), filters=admins))
+
+    metrics.gauge("mailsorter_outbound_pending", "Bot API requests waiting for a rate limit slot or in flight.", lambda: rate_limiter.pending)
+    metrics.gauge("mailsorter_deletion_queue_depth", "Messages waiting in the deletion queue.", lambda: deletion_queue.depth)
+    metrics.gauge("mailsorter_auto_clear_pending", "Scheduled auto-clear deletions.", lambda: auto_clear.stats()["pending"])
+    metrics.gauge("mailsorter_auto_clear_overdue", "Auto-clear deletions past their due time.", lambda: auto_clear.stats()["overdue"])
+    metrics.gauge("mailsorter_cached_sessions", "User sessions held in the in-process cache.", lambda: len(user_sessions))
+    metrics.gauge("mailsorter_user_data_users", "Users with user_data held in memory, as of the last sweep.", lambda: user_data_sweeper.stats()["users"])
+    metrics.gauge("mailsorter_user_data_bytes", "Approximate bytes of user_data held, as of the last sweep.", lambda: user_data_sweeper.stats()["bytes"])
+    metrics.gauge("mailsorter_user_data_max_bytes", "Largest user_data held for one user, as of the last sweep.", lambda: user_data_sweeper.stats()["max_bytes"])
+    metrics.gauge("mailsorter_render_cache_bytes", "Approximate bytes of rendered outputs held in the render cache.", lambda: render_cache.bytes)
+    metrics.gauge("mailsorter_domain_cache_hits", "Email domain checks answered from the verdict cache in this process.", lambda: is_valid_domain.cache_info().hits)
+    metrics.gauge("mailsorter_domain_cache_misses", "Email domain checks that looked the domain up in the suffix table.", lambda: is_valid_domain.cache_info().misses)
+    return application
+
+async def serve_forwarded_updates(application: Application, reader, writer) -> None:
+    """Queue the updates the ingress forwards over one keep-alive connection."""
+    try:
+        while (request := await read_request(reader)) is not None:
+            method, path, headers, body = request
+            if method != "POST" or path != WORKER_UPDATE_PATH:
+                status = "404 Not Found"
+            elif not secrets.compare_digest(headers.get("x-telegram-bot-api-secret-token", ""), WEBHOOK_SECRET):
+                status = "403 Forbidden"
+            else:
+                try:
+                    update = Update.de_json(json.loads(body), application.bot)
+                    await application.update_queue.put(update)
+                    status = "200 OK"
+                except (ValueError, TypeError, KeyError) as e:
+                    logger.warning(f"Dropping a malformed forwarded update: {e}")
+                    status = "400 Bad Request"
+            write_response(writer, status)
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+async def run_worker(application: Application) -> None:
+    """Run one worker of a sharded deployment until SIGTERM or SIGINT."""
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+    # Same sequence as Application.run_webhook, without the updater
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    if SHARD_INDEX == 0 and WEBHOOK_URL:
+        certificate = open(WEBHOOK_CERT, "rb") if WEBHOOK_CERT else None
+        try:
+            await application.bot.set_webhook(
+                f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}", certificate=certificate, secret_token=WEBHOOK_SECRET
+            )
+        finally:
+            if certificate is not None:
+                certificate.close()
+    server = await asyncio.start_server(
+        functools.partial(serve_forwarded_updates, application), "127.0.0.1", WORKER_PORT
+    )
+    logger.info(f"Worker {SHARD_INDEX + 1}/{SHARD_COUNT} taking updates on 127.0.0.1:{WORKER_PORT}")
+    try:
+        await stopping.wait()
+    finally:
+        server.close()
+        await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
+
+def main() -> None:
+    """Run the bot."""
+    application = build_application()
+
+    if BOT_MODE == "worker":
+        if not WEBHOOK_SECRET:
+            raise SystemExit("BOT_MODE=worker needs the WEBHOOK_SECRET the ingress forwards; start it with mailshard.py")
+        asyncio.run(run_worker(application))
+        return
+
+    if BOT_MODE == "webhook":
+        if WEBHOOK_URL:
+            # Telegram echoes the secret in every request and PTB rejects updates
+            # without it; use a random one per start if none is configured
+            secret_token = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=secret_token,
+                cert=WEBHOOK_CERT,
+                key=WEBHOOK_KEY,
+            )
+            return
+        logger.warning("BOT_MODE=webhook but WEBHOOK_URL is not set, falling back to polling")
 
     # Run the bot until the user presses Ctrl-C
     application.run_polling()
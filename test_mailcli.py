@@ -0,0 +1,71 @@
+"""Tests for the offline batch CLI in mailcli.py.
+
+Run with `python -m pytest`.
+"""
+import subprocess
+import sys
+from types import SimpleNamespace
+
+import mailcli
+from mailcore import DEFAULT_CONFIG
+
+def make_args(paths, **options):
+    args = dict(
+        prime=DEFAULT_CONFIG["prime"], validity=DEFAULT_CONFIG["validity"], bin_type=DEFAULT_CONFIG["bin_type"],
+        prime_pass=None, mail_pass=None, sort="none", allow_domains="", block_domains="",
+        per_file=False, output=None, output_dir=None, workers=1,
+    )
+    args.update(options)
+    return SimpleNamespace(paths=[str(path) for path in paths], **args)
+
+def make_tree(root):
+    (root / "a" / "deep").mkdir(parents=True)
+    (root / "b").mkdir()
+    (root / "a" / "list.txt").write_text("one@gmail.com two@yahoo.com")
+    (root / "a" / "list.csv").write_text("two@yahoo.com,three@example.org")
+    (root / "a" / "deep" / "list.txt").write_text("four@example.org")
+    (root / "b" / "list.txt").write_text("five@example.org one@gmail.com")
+    (root / "b" / "notes.md").write_text("skipped@example.org")
+    return root
+
+def test_find_inputs_names_files_below_their_directory(tmp_path):
+    make_tree(tmp_path)
+    assert list(mailcli.find_inputs([str(tmp_path / "a"), str(tmp_path / "b" / "notes.md"), "-"])) == [
+        (str(tmp_path / "a" / "list.csv"), "list"),
+        (str(tmp_path / "a" / "list.txt"), "list"),
+        (str(tmp_path / "a" / "deep" / "list.txt"), "deep/list"),
+        (str(tmp_path / "b" / "notes.md"), "notes"),  # Named explicitly, so read whatever its extension
+        ("-", "stdin"),
+    ]
+
+def test_output_path_never_reuses_a_name():
+    written = set()
+    assert [mailcli.output_path("out", "list", written) for _ in range(3)] == ["out/list.txt", "out/list-2.txt", "out/list-3.txt"]
+    assert mailcli.output_path("out", "deep/list", written) == "out/deep/list.txt"
+
+def test_per_file_outputs_of_same_named_inputs_are_all_kept(tmp_path):
+    make_tree(tmp_path / "in")
+    out = tmp_path / "out"
+    args = make_args([tmp_path / "in" / "a", tmp_path / "in" / "b"], per_file=True, output_dir=str(out), workers=2)
+    assert mailcli.run(args) == 0
+    outputs = {path.relative_to(out).as_posix(): path.read_text() for path in out.rglob("*.txt")}
+    assert sorted(outputs) == ["deep/list.txt", "list-2.txt", "list-3.txt", "list.txt"]
+    # Inputs are written in order, each with only the addresses not printed for an earlier one
+    assert "four@example.org" in outputs["deep/list.txt"]
+    assert "three@example.org" in outputs["list.txt"] and "two@yahoo.com" in outputs["list.txt"]
+    assert outputs["list-2.txt"].startswith("1x -- ") and "one@gmail.com" in outputs["list-2.txt"]
+    assert outputs["list-3.txt"].startswith("1x -- ") and "five@example.org" in outputs["list-3.txt"]
+
+def test_combined_output_dedupes_across_inputs(tmp_path):
+    make_tree(tmp_path)
+    output = tmp_path / "all.txt"
+    (tmp_path / "broken.zip").write_bytes(b"not a zip")
+    args = make_args([tmp_path / "a", tmp_path / "b", tmp_path / "broken.zip"], output=str(output))
+    assert mailcli.run(args) == 1  # The unreadable archive is reported, the rest still written
+    text = output.read_text()
+    assert text.startswith("5x -- ")
+    assert text.count("one@gmail.com") == 1 and text.count("two@yahoo.com") == 1
+
+def test_cli_does_not_import_telegram():
+    code = "import sys, mailcli; sys.exit('telegram' in sys.modules)"
+    assert subprocess.run([sys.executable, "-c", code], cwd=mailcli.__file__.rpartition("/")[0] or ".").returncode == 0
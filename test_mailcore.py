@@ -0,0 +1,200 @@
+"""Tests for the Telegram-free extraction pipeline in mailcore.py.
+
+Run with `python -m pytest`.
+"""
+import gzip
+import json
+import os
+import tracemalloc
+import zipfile
+
+import pytest
+
+import mailcore
+from mailcore import (
+    MAX_EMAIL_LENGTH,
+    OUTPUT_CHUNK_LENGTH,
+    PasswordDetector,
+    SuffixTrie,
+    extract_emails,
+    format_output,
+    is_valid_domain,
+    split_output,
+)
+
+CONFIG = dict(mailcore.DEFAULT_CONFIG, prime_pass="p", mail_pass="m")
+
+def chunked(text, size):
+    return iter([text[i:i + size] for i in range(0, len(text), size)])
+
+@pytest.fixture
+def suffix_trie():
+    return SuffixTrie(["com", "uk", "co.uk", "ck", "*.ck", "!www.ck", "jp", "kyoto.jp", "*.kobe.jp"])
+
+@pytest.mark.parametrize("domain, length", [
+    ("gmail.com", 1),
+    ("bbc.co.uk", 2),
+    ("co.uk", 2),
+    ("anything.ck", 2),  # *.ck
+    ("www.ck", 1),  # !www.ck: the exception makes ck the suffix
+    ("shop.www.ck", 1),
+    ("city.kobe.jp", 3),
+    ("kyoto.jp", 2),
+    ("host.jpg", 0),
+])
+def test_suffix_length(suffix_trie, domain, length):
+    assert suffix_trie.suffix_length(domain.split(".")[::-1]) == length
+
+@pytest.mark.parametrize("domain, valid", [
+    ("gmail.com", True),
+    ("mail.bbc.co.uk", True),
+    ("co.uk", False),  # A bare public suffix
+    ("host.jpg", False),  # Not a TLD
+    ("foo.ck", False),  # Itself a suffix under *.ck
+    ("a.foo.ck", True),
+    ("www.ck", True),  # Registrable through !www.ck
+    ("-bad.com", False),
+    ("пример.рф", True),
+    ("xn--e1afmkfd.xn--p1ai", True),
+])
+def test_is_valid_domain(domain, valid):
+    assert is_valid_domain(domain) is valid
+
+def test_extract_keeps_order_and_dedupes():
+    assert extract_emails("b@x.com, a@y.org b@x.com\nc@z.net") == ["b@x.com", "a@y.org", "c@z.net"]
+
+@pytest.mark.parametrize("size", [1, 2, 5, 7, 64])
+def test_address_split_across_chunks(size):
+    text = "hi john.doe@gmail.com, x@yahoo.co.uk;" + "a" * 500 + " q+1@mail.example.org\nend@b.com"
+    assert extract_emails(chunked(text, size)) == extract_emails(text)
+
+def test_long_run_without_separators_keeps_addresses():
+    text = "a" * 5000 + "@b" + "x@y.com" + "z" * 5000 + "@gmail.com q@w.com"
+    assert extract_emails(chunked(text, 300)) == extract_emails(text) == ["q@w.com"]
+    run = "ab.cd@ef.com" * 2000
+    assert extract_emails(chunked(run, 1000)) == extract_emails(run)
+
+def test_carry_stays_bounded():
+    # A run of address characters without separators is not carried whole from chunk to chunk
+    chunks = ("a" * 10000 for _ in range(100))
+    tracemalloc.start()
+    try:
+        assert extract_emails(chunks) == []
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 100000 + 4 * MAX_EMAIL_LENGTH
+
+def test_extraction_drops_unregistrable_domains():
+    text = "a@shop.example.com b@host.jpg c@co.uk d@mail.bbc.co.uk e@xn--e1afmkfd.xn--p1ai"
+    assert extract_emails(text) == ["a@shop.example.com", "d@mail.bbc.co.uk", "e@xn--e1afmkfd.xn--p1ai"]
+
+def test_overlong_local_part_is_rejected():
+    assert extract_emails("a" * 70 + "@gmail.com") == []
+    assert extract_emails("a" * 64 + "@gmail.com") == ["a" * 64 + "@gmail.com"]
+
+def test_overlong_tld_is_rejected():
+    assert extract_emails("a@example." + "c" * 70) == []
+
+def test_password_ranks_fold_prefixes():
+    detector = PasswordDetector([
+        {"pattern": "prime", "prime_pass": "a", "mail_pass": "a"},
+        {"pattern": "prime123", "prime_pass": "b", "mail_pass": "b"},
+        {"pattern": "admin", "prime_pass": "c", "mail_pass": "c"},
+    ])
+    # The regex reports prime123 as the longest word, but prime comes first in the table
+    assert detector.rank("x prime123 y") == 0
+    assert detector.detect("ADMIN here")["prime_pass"] == "c"
+    assert detector.rank("nothing") is None
+
+def test_password_ranks_keep_longer_pattern_first():
+    detector = PasswordDetector([
+        {"pattern": "prime123", "prime_pass": "b", "mail_pass": "b"},
+        {"pattern": "prime", "prime_pass": "a", "mail_pass": "a"},
+    ])
+    assert detector.rank("prime123") == 0
+    assert detector.rank("prime12") == 1
+
+def test_password_table_is_reloaded_when_the_file_changes(tmp_path, monkeypatch):
+    table = tmp_path / "patterns.json"
+    monkeypatch.setattr(mailcore, "PASSWORD_PATTERNS_FILE", str(table))
+    monkeypatch.setattr(mailcore, "_password_detector", mailcore._password_detector)
+    monkeypatch.setattr(mailcore, "_password_patterns_mtime", None)
+    table.write_text(json.dumps([{"pattern": "alpha", "prime_pass": "a", "mail_pass": "a"}]))
+    assert mailcore.get_password_detector().detect("alpha")["prime_pass"] == "a"
+    table.write_text(json.dumps([{"pattern": "beta", "prime_pass": "b", "mail_pass": "b"}]))
+    os.utime(table, ns=(0, os.stat(table).st_mtime_ns + 10 ** 9))
+    assert mailcore.get_password_detector().detect("alpha") is None
+    # A broken table keeps the one already loaded
+    table.write_text(json.dumps([{"pattern": "gamma"}]))
+    os.utime(table, ns=(0, os.stat(table).st_mtime_ns + 2 * 10 ** 9))
+    assert mailcore.get_password_detector().detect("beta")["prime_pass"] == "b"
+
+def test_split_output_respects_limit_and_blocks():
+    blocks = [f"user{i}@example.com" for i in range(200)]
+    output = "\n\n".join(blocks)
+    parts = split_output(output, 500)
+    assert all(len(part) <= 500 for part in parts)
+    assert "\n\n".join(parts) == output
+    assert split_output("short", 500) == ("short",)
+
+def test_format_output_parts_fit_a_message():
+    emails = [f"user{i}@example.com" for i in range(1000)]
+    output, parts, count = format_output(emails, CONFIG)
+    assert count == 1000 and len(parts) > 1
+    assert all(len(part) <= OUTPUT_CHUNK_LENGTH for part in parts)
+    assert "\n\n".join(parts) == output
+
+def test_domain_filters_count_after_filtering():
+    emails = ["a@b.com", "c@d.org", "e@b.com"]
+    output, parts, count = format_output(emails, dict(CONFIG, allow_domains="b.com"))
+    assert count == 2
+    assert output.startswith("2x -- ")
+    assert format_output(emails, dict(CONFIG, block_domains="b.com, d.org"))[2] == 0
+
+def test_domain_sort_orders_by_domain_then_local_part():
+    emails = ["z@B.com", "a@b.com", "c@a.org"]
+    assert mailcore.arrange_emails(emails, dict(CONFIG, sort="domain")) == (["c@a.org", "a@b.com", "z@B.com"], 3)
+    # Filtering alone keeps the order the emails were found in
+    assert mailcore.arrange_emails(emails, dict(CONFIG, block_domains="a.org")) == (["z@B.com", "a@b.com"], 2)
+
+def test_grouped_output():
+    output, _, count = format_output(["z@b.com", "a@b.com", "c@a.org"], dict(CONFIG, sort="grouped"))
+    assert count == 3
+    assert output.split("\n\n")[1:6] == ["📁 a.org (1)", "c@a.org", "📁 b.com (2)", "a@b.com", "z@b.com"]
+
+def test_scan_document_reads_archives(tmp_path):
+    archive = tmp_path / "leads.zip"
+    with zipfile.ZipFile(archive, "w") as handle:
+        handle.writestr("one.txt", "first@gmail.com prime123")
+        handle.writestr("two.csv", "second@yahoo.com")
+    emails, detected = mailcore.scan_document(str(archive), "leads.zip")
+    assert list(emails) == ["first@gmail.com", "second@yahoo.com"]
+    compressed = tmp_path / "dump.txt.gz"
+    compressed.write_bytes(gzip.compress(b"x@example.com"))
+    assert list(mailcore.scan_document(str(compressed), "dump.txt.gz")[0]) == ["x@example.com"]
+
+def test_scan_document_reads_plain_files_in_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(mailcore, "SCAN_CHUNK_SIZE", 16)
+    document = tmp_path / "leads.txt"
+    # The password and the second address straddle chunk boundaries
+    document.write_text("x@gmail.com, prime123 a.longer.address@example.org; z@y.net\n")
+    emails, detected = mailcore.scan_document(str(document), "leads.txt")
+    assert list(emails) == ["x@gmail.com", "a.longer.address@example.org", "z@y.net"]
+    assert detected == {"prime_pass": "prime123", "mail_pass": "prime123"}
+    empty = tmp_path / "empty.csv"
+    empty.write_text("")
+    assert list(mailcore.scan_document(str(empty), "empty.csv")[0]) == []
+
+def test_archive_expansion_is_capped(tmp_path):
+    archive = tmp_path / "bomb.zip"
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as handle:
+        handle.writestr("one.txt", "a" * 600)
+        handle.writestr("two.txt", "b" * 600)  # Each member is under the cap, together they are not
+    assert "".join(mailcore.iter_file_chunks(str(archive), "bomb.zip", max_decompressed=1300)).count("a") == 600
+    with pytest.raises(mailcore.DecompressionLimitError):
+        list(mailcore.iter_file_chunks(str(archive), "bomb.zip", max_decompressed=1000))
+    compressed = tmp_path / "bomb.gz"
+    compressed.write_bytes(gzip.compress(b"x" * 5000))
+    with pytest.raises(mailcore.DecompressionLimitError):
+        list(mailcore.iter_file_chunks(str(compressed), "bomb.gz", max_decompressed=1000))
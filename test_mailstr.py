@@ -0,0 +1,623 @@
+"""Tests for the bot's stores, schedulers and routing in mailstr.py.
+
+Run with `python -m pytest`. Handlers are called with small stand-ins for
+Update and CallbackContext; nothing talks to Telegram.
+"""
+import asyncio
+import datetime
+import json
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+from telegram import CallbackQuery, Chat, Message, Update, User
+from telegram.error import BadRequest, NetworkError, TimedOut
+
+# Keep test sessions out of the real session database
+os.environ.setdefault("SESSION_BACKEND", "memory")
+
+import mailshard
+import mailstr
+
+class FakeMessage:
+    """The parts of telegram.Message the handlers use."""
+
+    def __init__(self, user_id, message_id=1, text=""):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.chat_id = user_id
+        self.message_id = message_id
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        return SimpleNamespace(message_id=1000 + len(self.replies))
+
+    async def reply_document(self, document, filename, caption, **kwargs):
+        self.replies.append((filename, document.read().decode("utf-8")))
+        return SimpleNamespace(message_id=1000 + len(self.replies))
+
+def make_update(user_id, text=""):
+    message = FakeMessage(user_id, text=text)
+    return SimpleNamespace(message=message, effective_message=message, effective_user=message.from_user, callback_query=None)
+
+def make_context():
+    return SimpleNamespace(user_data={})
+
+async def stage_and_flush(persistence, stage):
+    await stage(persistence)
+    await asyncio.sleep(0)
+    await persistence.flush()
+
+def test_persistence_round_trip(tmp_path):
+    path = str(tmp_path / "persistence.sqlite3")
+
+    async def stage(persistence):
+        await persistence.update_user_data(1, {"last_emails": b"blob", "output_message_ids": [5]})
+        await persistence.update_user_data(2, {"output_message_ids": [6]})
+        await persistence.update_conversation("mailsorter", (1, 1), mailstr.CLEAR_MESSAGES)
+        await persistence.drop_user_data(2)
+
+    async def load():
+        persistence = mailstr.SQLitePersistence(path)
+        try:
+            return await persistence.get_user_data(), await persistence.get_conversations("mailsorter")
+        finally:
+            await persistence.flush()
+
+    asyncio.run(stage_and_flush(mailstr.SQLitePersistence(path), stage))
+    user_data, conversations = asyncio.run(load())
+    assert user_data == {1: {"last_emails": b"blob", "output_message_ids": [5]}}
+    assert conversations == {(1, 1): mailstr.CLEAR_MESSAGES}
+
+def test_persistence_forgets_idle_rows(tmp_path):
+    path = str(tmp_path / "persistence.sqlite3")
+
+    async def stage_user(user_id):
+        await persistence.update_user_data(user_id, {"output_message_ids": [user_id]})
+
+    persistence = mailstr.SQLitePersistence(path, ttl=0)
+    asyncio.run(stage_and_flush(persistence, lambda persistence: stage_user(1)))
+    # Every write also deletes rows last written more than ttl seconds before it
+    asyncio.run(stage_and_flush(persistence, lambda persistence: stage_user(2)))
+    assert list(asyncio.run(persistence.get_user_data())) == [2]
+
+def test_accumulating_batch_stays_out_of_user_data(monkeypatch):
+    monkeypatch.setattr(mailstr, "open_batches", {})
+    context = make_context()
+    asyncio.run(mailstr.add_to_batch(make_update(7), context, ["a@b.com", "c@d.org"]))
+    asyncio.run(mailstr.add_to_batch(make_update(7), context, ["c@d.org", "e@f.net"]))
+    # user_data is deep-copied for the persistence after every update, the batch is not
+    assert set(context.user_data) == {"batch_message_ids"}
+    emails, size = mailstr.open_batches[7]
+    assert list(emails) == ["a@b.com", "c@d.org", "e@f.net"]
+    assert size == mailstr.batch_bytes(emails)
+    mailstr.discard_batch(make_update(7), context)
+    assert mailstr.open_batches == {} and context.user_data == {}
+
+def test_batch_over_the_cap_is_refused(monkeypatch):
+    monkeypatch.setattr(mailstr, "open_batches", {})
+    monkeypatch.setattr(mailstr, "USER_BATCH_MAX_BYTES", 20)
+    update = make_update(7)
+    asyncio.run(mailstr.add_to_batch(update, make_context(), ["a@b.com", "c@d.org"]))
+    update = make_update(7)
+    asyncio.run(mailstr.add_to_batch(update, make_context(), ["long.address@example.com"]))
+    assert "size limit" in update.message.replies[0]
+    assert list(mailstr.open_batches[7][0]) == ["a@b.com", "c@d.org"]
+
+class CountingBackend(mailstr.MemorySessionBackend):
+    """MemorySessionBackend that records the backend calls and the threads reads ran in."""
+
+    def __init__(self):
+        super().__init__()
+        self.loads = []
+        self.saves = []
+        self.expires = 0
+
+    def load(self, user_id):
+        self.loads.append((user_id, threading.get_ident()))
+        return super().load(user_id)
+
+    def save_many(self, rows):
+        self.saves.append(sorted(user_id for user_id, _, _ in rows))
+        super().save_many(rows)
+
+    def expire(self, cutoff):
+        self.expires += 1
+        return super().expire(cutoff)
+
+def make_session():
+    return {"authenticated": True, "config": dict(mailstr.DEFAULT_CONFIG)}
+
+def test_session_reads_are_not_written_back():
+    backend = CountingBackend()
+    sessions = mailstr.SessionStore(backend)
+    sessions[1] = make_session()
+    sessions[2] = make_session()
+    sessions.flush()
+    assert backend.saves == [[1, 2]]
+    assert sessions[1]["authenticated"] and sessions[2]["config"]
+    sessions.flush()
+    assert backend.saves == [[1, 2]]
+    sessions[2]["config"]["sort"] = "domain"
+    sessions.save(2)
+    sessions.flush()
+    assert backend.saves == [[1, 2], [2]]
+    assert json.loads(backend.rows[2][0])["config"]["sort"] == "domain"
+
+def test_session_survives_cache_eviction():
+    backend = CountingBackend()
+    sessions = mailstr.SessionStore(backend, cache_size=1)
+    sessions[1] = make_session()
+    sessions[2] = make_session()  # Evicts 1 before it was flushed
+    assert backend.saves == [] and 1 not in sessions.cache
+    assert sessions[1]["authenticated"]
+    sessions.flush()
+    assert mailstr.SessionStore(backend)[1]["authenticated"]
+
+def test_prefetch_loads_off_the_event_loop():
+    backend = CountingBackend()
+    backend.save_many([(5, json.dumps(make_session()), time.time())])
+    sessions = mailstr.SessionStore(backend)
+    asyncio.run(sessions.prefetch(5))
+    asyncio.run(sessions.prefetch(6))
+    assert [user_id for user_id, _ in backend.loads] == [5, 6]
+    assert all(thread != threading.get_ident() for _, thread in backend.loads)
+    # Both are answered from memory now, the missing user included
+    assert sessions[5]["authenticated"] and 6 not in sessions
+    assert len(backend.loads) == 2
+    sessions[6] = make_session()
+    assert 6 in sessions
+
+def test_expired_sessions_are_not_loaded():
+    backend = CountingBackend()
+    backend.save_many([(5, json.dumps(make_session()), time.time() - 100)])
+    assert 5 not in mailstr.SessionStore(backend, ttl=50)
+    assert 5 in mailstr.SessionStore(backend, ttl=200)
+
+def test_flusher_expires_on_its_own_interval():
+    backend = CountingBackend()
+    sessions = mailstr.SessionStore(backend, flush_interval=0.01, expire_interval=0.2)
+
+    async def run(seconds):
+        flusher = asyncio.create_task(sessions.run_flusher())
+        await asyncio.sleep(seconds)
+        sessions[1] = make_session()
+        await asyncio.sleep(0.05)
+        flusher.cancel()
+
+    asyncio.run(run(0.05))
+    assert backend.expires == 0 and backend.saves == [[1]]
+    asyncio.run(run(0.3))
+    assert backend.expires >= 1
+
+def test_sqlite_backend_expires_by_last_seen(tmp_path):
+    backend = mailstr.SQLiteSessionBackend(str(tmp_path / "sessions.sqlite3"))
+    try:
+        now = time.time()
+        backend.save_many([(1, "{}", now - 100), (2, "{}", now)])
+        assert backend.expire(now - 50) == 1
+        assert backend.load(1) is None and backend.load(2) == ("{}", now)
+        plan = backend.connection.execute("EXPLAIN QUERY PLAN DELETE FROM sessions WHERE last_seen < 0").fetchall()
+        assert "sessions_last_seen" in str(plan)
+    finally:
+        backend.close()
+
+class FakeBot:
+    """Records delete_messages calls; failures[i] is raised by the i-th call, if set."""
+
+    def __init__(self, failures=()):
+        self.calls = []
+        self.failures = list(failures)
+
+    async def delete_messages(self, chat_id, message_ids):
+        self.calls.append((chat_id, list(message_ids)))
+        if self.failures and (failure := self.failures.pop(0)):
+            raise failure
+        return True
+
+def test_deletions_are_sent_in_batches_of_100():
+    bot = FakeBot()
+    queue = mailstr.DeletionQueue()
+    ids = list(range(1, 251))
+    asyncio.run(queue._delete(bot, 7, ids + ids[:10]))  # Duplicates are sent once
+    assert [len(message_ids) for _, message_ids in bot.calls] == [100, 100, 50]
+    assert [message_id for _, message_ids in bot.calls for message_id in message_ids] == ids
+
+def test_deletion_queue_coalesces_per_chat():
+    bot = FakeBot()
+    queue = mailstr.DeletionQueue()
+
+    async def run():
+        queue.delete(1, [10, 11])
+        queue.delete(2, [20])
+        queue.delete(1, [12])
+        assert queue.depth == 4
+        task = asyncio.create_task(queue.run(bot))
+        await asyncio.sleep(0.01)
+        task.cancel()
+
+    asyncio.run(run())
+    assert sorted(bot.calls) == [(1, [10, 11, 12]), (2, [20])]
+    assert queue.depth == 0
+
+def test_deletion_retries_network_errors_only(monkeypatch):
+    monkeypatch.setattr(mailstr, "RETRY_BACKOFF", 0)
+    bot = FakeBot([NetworkError("down"), None])
+    asyncio.run(mailstr.DeletionQueue()._delete(bot, 7, [1]))
+    assert len(bot.calls) == 2
+    bot = FakeBot([BadRequest("Message to delete not found")])
+    asyncio.run(mailstr.DeletionQueue()._delete(bot, 7, [1]))
+    assert len(bot.calls) == 1
+    bot = FakeBot([TimedOut()] * 5)
+    asyncio.run(mailstr.DeletionQueue(max_retries=2)._delete(bot, 7, [1]))
+    assert len(bot.calls) == 3
+
+def test_rate_limiter_paces_sends_per_private_chat():
+    limiter = mailstr.OutboundRateLimiter(chat_max_rate=1, chat_time_period=0.2, overall_max_rate=0, group_max_rate=0)
+
+    async def callback(*args, **kwargs):
+        return True
+
+    async def send(endpoint, chat_id):
+        await limiter.process_request(callback, (), {}, endpoint, {"chat_id": chat_id}, None)
+        return time.perf_counter()
+
+    async def run():
+        started = time.perf_counter()
+        # The second send to chat 1 waits for its limiter; chat 2 and deletions do not
+        times = await asyncio.gather(send("sendMessage", 1), send("sendMessage", 1), send("sendMessage", 2), send("deleteMessages", 1))
+        return [moment - started for moment in times]
+
+    first, second, other_chat, deletion = asyncio.run(run())
+    assert second >= 0.15 > max(first, other_chat, deletion)
+    assert limiter.pending == 0
+
+class FakeDeletionQueue:
+    def __init__(self):
+        self.deleted = []
+
+    def delete(self, chat_id, message_ids):
+        self.deleted.append((chat_id, list(message_ids)))
+
+def test_auto_clear_survives_a_restart(tmp_path):
+    path = str(tmp_path / "sessions.sqlite3")
+    backend = mailstr.SQLiteSessionBackend(path)
+    scheduler = mailstr.AutoClearScheduler(backend)
+    asyncio.run(scheduler.schedule(7, [1, 2], 60))
+    asyncio.run(scheduler.schedule(7, [3], 0))  # 0 turns auto-clear off
+    backend.close()
+    restarted = mailstr.AutoClearScheduler(mailstr.SQLiteSessionBackend(path))
+    restarted.load()
+    assert [(chat_id, message_ids) for _, _, chat_id, message_ids in restarted.heap] == [(7, [1, 2])]
+    assert restarted.stats() == {"pending": 1, "overdue": 0}
+    restarted.backend.close()
+
+def test_auto_clear_loads_only_its_shard(monkeypatch):
+    backend = mailstr.MemorySessionBackend()
+    for chat_id in range(20):
+        backend.add_deletion(chat_id, [1], time.time() + 60)
+    monkeypatch.setattr(mailstr, "SHARD_COUNT", 2)
+    monkeypatch.setattr(mailstr, "SHARD_INDEX", 1)
+    scheduler = mailstr.AutoClearScheduler(backend)
+    scheduler.load()
+    chats = {chat_id for _, _, chat_id, _ in scheduler.heap}
+    assert chats and chats == {chat_id for chat_id in range(20) if mailshard.shard_of(chat_id, 2) == 1}
+
+def test_auto_clear_hands_due_deletions_to_the_queue(monkeypatch):
+    monkeypatch.setattr(mailstr, "deletion_queue", FakeDeletionQueue())
+    backend = mailstr.MemorySessionBackend()
+    backend.add_deletion(7, [1, 2], time.time() - 1)  # Fell due while the bot was down
+    scheduler = mailstr.AutoClearScheduler(backend)
+    scheduler.load()
+
+    async def run():
+        task = asyncio.create_task(scheduler.run())
+        await scheduler.schedule(8, [3], 0.05)
+        await scheduler.schedule(9, [4], 60)
+        await asyncio.sleep(0.01)
+        assert mailstr.deletion_queue.deleted == [(7, [1, 2])]
+        await asyncio.sleep(0.1)
+        task.cancel()
+
+    asyncio.run(run())
+    assert mailstr.deletion_queue.deleted == [(7, [1, 2]), (8, [3])]
+    assert [row[1] for row in backend.load_deletions()] == [9]
+    assert scheduler.stats()["pending"] == 1
+
+def test_failed_download_is_reported(monkeypatch):
+    monkeypatch.setitem(mailstr.user_sessions, 9, make_session())
+
+    async def get_file():
+        raise TimedOut()
+
+    update = make_update(9)
+    update.message.document = SimpleNamespace(file_name="leads.txt", file_size=100, get_file=get_file)
+    assert asyncio.run(mailstr.process_document(update, make_context())) == mailstr.INPUT_EMAILS
+    assert update.message.replies == ["❌ Could not download the file from Telegram. Please send it again."]
+
+def test_worker_accepts_only_posted_updates(monkeypatch):
+    monkeypatch.setattr(mailstr, "WEBHOOK_SECRET", "secret")
+    application = SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+    update = json.dumps({"update_id": 1}).encode()
+
+    async def request(reader, writer, method, path, secret, body=b""):
+        writer.write(
+            f"{method} {path} HTTP/1.1\r\nX-Telegram-Bot-Api-Secret-Token: {secret}\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+        )
+        status = await reader.readline()
+        while await reader.readline() != b"\r\n":
+            pass
+        return status.split()[1].decode()
+
+    async def run():
+        server = await asyncio.start_server(
+            lambda reader, writer: mailstr.serve_forwarded_updates(application, reader, writer), "127.0.0.1", 0
+        )
+        reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+        # One keep-alive connection, as the ingress uses
+        statuses = [
+            await request(reader, writer, "GET", "/update", "secret"),
+            await request(reader, writer, "POST", "/other", "secret", update),
+            await request(reader, writer, "POST", "/update", "wrong", update),
+            await request(reader, writer, "POST", "/update", "secret", b"not json"),
+            await request(reader, writer, "POST", mailshard.WORKER_UPDATE_PATH, "secret", update),
+        ]
+        writer.close()
+        server.close()
+        return statuses
+
+    assert asyncio.run(run()) == ["404", "404", "403", "400", "200"]
+    assert application.update_queue.get_nowait().update_id == 1
+
+class FakeQuery:
+    """The parts of telegram.CallbackQuery the handlers use."""
+
+    def __init__(self, message, data):
+        self.message = message
+        self.data = data
+        self.answers = []
+
+    async def answer(self, text=None):
+        self.answers.append(text)
+
+def make_callback_update(user_id, data):
+    """An inline button press on the output message with id 500."""
+    message = FakeMessage(user_id, message_id=500)
+    return SimpleNamespace(
+        message=None, effective_message=message, effective_user=SimpleNamespace(id=user_id),
+        callback_query=FakeQuery(message, data),
+    )
+
+class FakeScheduler:
+    def __init__(self):
+        self.scheduled = []
+
+    async def schedule(self, chat_id, message_ids, delay_seconds):
+        self.scheduled.append((chat_id, list(message_ids)))
+
+def test_inline_back_discards_the_open_batch(monkeypatch):
+    monkeypatch.setattr(mailstr, "open_batches", {})
+    context = make_context()
+    asyncio.run(mailstr.add_to_batch(make_update(7), context, ["a@b.com"]))
+    callback, next_state = mailstr.OUTPUT_BUTTON_ROUTES[mailstr.INPUT_EMAILS]["🔙 Back to Menu"]
+    update = make_callback_update(7, "🔙 Back to Menu")
+    asyncio.run(callback(update, context))
+    assert next_state == mailstr.MAIN_MENU
+    assert mailstr.open_batches == {} and "batch_message_ids" not in context.user_data
+    assert update.callback_query.answers == [None]
+    # The other states keep their own Back, and Copy Again is the same everywhere
+    assert mailstr.OUTPUT_BUTTON_ROUTES[mailstr.CONFIG]["🔙 Back to Menu"][0] is mailstr.leave_configuration
+    assert {routes["📋 Copy Again"][0] for routes in mailstr.OUTPUT_BUTTON_ROUTES.values()} == {mailstr.copy_again}
+
+def test_inline_copy_again_sends_the_output_again(monkeypatch):
+    monkeypatch.setitem(mailstr.user_sessions, 7, make_session())
+    monkeypatch.setattr(mailstr, "auto_clear", FakeScheduler())
+    context = make_context()
+    context.user_data.update(last_emails=mailstr.pack_emails(["a@b.com", "c@d.org"]), output_message_ids=[500])
+    update = make_callback_update(7, "📋 Copy Again")
+    assert asyncio.run(mailstr.copy_again(update, context)) is None  # The conversation stays where it was
+    replies = update.effective_message.replies
+    assert len(replies) == 1 and "a@b.com\n\nc@d.org" in replies[0]
+    assert context.user_data["output_message_ids"] == [500, 1001]
+    # Only the new output is auto-cleared: an inline press leaves no message of the user's
+    assert mailstr.auto_clear.scheduled == [(7, [1001])]
+
+def test_typed_copy_again_clears_the_request_too(monkeypatch):
+    monkeypatch.setitem(mailstr.user_sessions, 7, make_session())
+    monkeypatch.setattr(mailstr, "auto_clear", FakeScheduler())
+    context = make_context()
+    context.user_data.update(last_emails=mailstr.pack_emails(["a@b.com"]))
+    assert asyncio.run(mailstr.copy_again(make_update(7, "📋 Copy Again"), context)) == mailstr.CLEAR_MESSAGES
+    assert mailstr.auto_clear.scheduled == [(7, [1, 1001])]
+
+def test_output_filtered_to_nothing_is_not_sent(monkeypatch):
+    monkeypatch.setattr(mailstr, "auto_clear", FakeScheduler())
+    context = make_context()
+    config = dict(mailstr.DEFAULT_CONFIG, allow_domains="example.com")
+    update = make_update(7)
+    state = asyncio.run(mailstr.send_email_output(update, context, ["a@b.com", "c@d.org"], config))
+    assert state == mailstr.INPUT_EMAILS
+    assert update.message.replies == [
+        "❌ Your Allow/Block Domains filters left out all 2 emails found. Change them in Configuration or send other emails."
+    ]
+    assert context.user_data == {} and mailstr.auto_clear.scheduled == []
+
+def test_render_cache_is_bounded_by_bytes():
+    rendered = ("x" * 900, ("x" * 900,), 1)
+    cache = mailstr.RenderCache(max_entries=10, max_bytes=2.5 * mailstr.deep_size(rendered))
+    for key in "abc":
+        cache.put(key, rendered)
+    assert list(cache.entries) == ["b", "c"] and cache.bytes <= cache.max_bytes
+    cache.get("b")
+    cache.put("d", rendered)  # The least recently used entry goes first
+    assert list(cache.entries) == ["b", "d"]
+    cache.put("huge", ("x" * 5000, ("x" * 5000,), 1))
+    assert "huge" not in cache.entries
+
+def test_render_output_is_cached_per_config(monkeypatch):
+    monkeypatch.setattr(mailstr, "render_cache", mailstr.RenderCache())
+    emails = ("a@b.com", "c@d.org")
+    config = dict(mailstr.DEFAULT_CONFIG)
+    first = mailstr.render_output(emails, config)
+    assert mailstr.render_output(list(emails), dict(config)) is first
+    assert mailstr.render_output(emails, dict(config, sort="domain")) is not first
+    assert len(mailstr.render_cache.entries) == 2
+
+def test_large_outputs_are_sent_as_a_document(monkeypatch):
+    monkeypatch.setattr(mailstr, "MAX_OUTPUT_MESSAGES", 2)
+    emails = [f"user{i}@example.com" for i in range(1000)]
+    rendered = mailstr.format_output(emails, dict(mailstr.DEFAULT_CONFIG))
+    update = make_update(7)
+    assert asyncio.run(mailstr.reply_with_output(update, rendered, "title", "footer")) == [1001]
+    assert update.message.replies == [("emails.txt", rendered[0])]
+    rendered = mailstr.format_output(emails[:3], dict(mailstr.DEFAULT_CONFIG))
+    assert asyncio.run(mailstr.reply_with_output(update, rendered, "title", "footer")) == [1002]
+
+def make_telegram_update(user_id):
+    """A real telegram.Update, which the update processor needs to find the user."""
+    user = User(user_id, "user", False)
+    message = Message(1, datetime.datetime.now(), Chat(user_id, Chat.PRIVATE), from_user=user, text="hi")
+    return Update(user_id, message=message)
+
+def test_updates_run_in_order_per_user_within_the_slot_limit(monkeypatch):
+    backend = CountingBackend()
+    monkeypatch.setattr(mailstr, "user_sessions", mailstr.SessionStore(backend))
+    monkeypatch.setattr(mailstr, "user_data_sweeper", mailstr.UserDataSweeper())
+    processor = mailstr.PerUserUpdateProcessor(2)
+    started = []
+    gates = {name: asyncio.Event() for name in ("1a", "2")}
+
+    async def handle(name):
+        started.append(name)
+        if name in gates:
+            await gates[name].wait()
+
+    async def run():
+        updates = [(1, "1a"), (1, "1b"), (2, "2"), (3, "3")]
+        tasks = [
+            asyncio.create_task(processor.process_update(make_telegram_update(user_id), handle(name)))
+            for user_id, name in updates
+        ]
+        await asyncio.sleep(0.05)
+        # 1b waits for user 1 without holding a slot, and 3 waits for one of the two slots
+        assert started == ["1a", "2"]
+        gates["2"].set()
+        await asyncio.sleep(0.05)
+        assert started == ["1a", "2", "3"]
+        gates["1a"].set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert started == ["1a", "2", "3", "1b"]
+    assert processor.user_locks == {}
+    # Each user's session was looked up off the event loop before their first update ran
+    assert sorted({user_id for user_id, _ in backend.loads}) == [1, 2, 3]
+    assert set(mailstr.user_data_sweeper.last_active) == {1, 2, 3}
+
+def test_updates_without_a_user_only_take_a_slot():
+    processor = mailstr.PerUserUpdateProcessor(1)
+    done = []
+
+    async def handle(name):
+        await asyncio.sleep(0.01)
+        done.append(name)
+
+    async def run():
+        await asyncio.gather(
+            processor.process_update(object(), handle("first")),
+            processor.process_update(object(), handle("second")),
+        )
+
+    asyncio.run(run())
+    assert done == ["first", "second"] and processor.user_locks == {}
+
+class FakeApplication:
+    """The user_data mapping of telegram.ext.Application and the call that drops an entry."""
+
+    def __init__(self, user_data):
+        self.user_data = user_data
+
+    def drop_user_data(self, user_id):
+        del self.user_data[user_id]
+
+def test_sweeper_drops_idle_users_only(monkeypatch):
+    monkeypatch.setattr(mailstr, "open_batches", {1: [{"a@b.com": None}, 7], 2: [{"c@d.org": None}, 7]})
+    application = FakeApplication({1: {"last_emails": b"x" * 1000}, 2: {}, 3: {}})
+    sweeper = mailstr.UserDataSweeper(idle_timeout=60)
+    sweeper.sweep(application)  # Users restored from persistence start their idle time now
+    assert sweeper.stats()["users"] == 3 and sweeper.stats()["max_bytes"] > 1000
+    sweeper.last_active[1] -= 120
+    sweeper.last_active[3] -= 120
+    sweeper.touch(4)
+    assert sweeper.sweep(application) == 2
+    assert application.user_data == {2: {}}
+    assert list(mailstr.open_batches) == [2]
+    assert sweeper.stats()["users"] == 2  # 2 and 4, who holds nothing yet
+
+def test_sweeper_only_resizes_active_users(monkeypatch):
+    monkeypatch.setattr(mailstr, "open_batches", {})
+    application = FakeApplication({1: {"last_emails": b"x" * 1000}, 2: {}})
+    sweeper = mailstr.UserDataSweeper(idle_timeout=60)
+    sweeper.sweep(application)
+    sweeper.last_active[1] -= 1
+    application.user_data[1]["last_emails"] = b""
+    application.user_data[2]["last_emails"] = b"x" * 1000
+    sweeper.touch(2)
+    sweeper.sweep(application)
+    # User 1 sent nothing since the last sweep, so their old size is kept
+    assert sweeper.sizes[1] > 1000 and sweeper.sizes[2] > 1000
+
+def make_button_press(text, inline=False, with_message=True):
+    """A real telegram.Update for a reply keyboard press, or an inline one with the label as callback data."""
+    update = make_telegram_update(7)
+    if not inline:
+        return Update(1, message=Message(1, update.message.date, update.message.chat, from_user=update.effective_user, text=text))
+    query = CallbackQuery("q", update.effective_user, "chat", message=update.message if with_message else None, data=text)
+    return Update(1, callback_query=query)
+
+def test_button_router_matches_exact_labels():
+    async def callback(update, context):
+        return "returned"
+
+    routes = {"✅ Done": (callback, None), "🔙 Back to Menu": (callback, "menu")}
+    router = mailstr.ButtonRouter(routes)
+    inline_router = mailstr.ButtonRouter(routes, inline=True)
+    assert router.check_update(make_button_press("✅ Done")) == (callback, None)
+    assert router.check_update(make_button_press("✅ Done now")) is None
+    assert router.check_update(make_button_press("✅ Done", inline=True)) is None
+    assert router.check_update("✅ Done") is None
+    assert inline_router.check_update(make_button_press("🔙 Back to Menu", inline=True)) == (callback, "menu")
+    assert inline_router.check_update(make_button_press("🔙 Back to Menu")) is None
+    # A press on a message too old for Telegram to include is left to expired_button
+    assert inline_router.check_update(make_button_press("🔙 Back to Menu", inline=True, with_message=False)) is None
+    # The route's state wins over the callback's, unless it is None
+    update = make_button_press("✅ Done")
+    assert asyncio.run(router.handle_update(update, None, routes["✅ Done"], None)) == "returned"
+    assert asyncio.run(router.handle_update(update, None, routes["🔙 Back to Menu"], None)) == "menu"
+
+def test_button_router_wraps_each_callback_once():
+    wrapped = []
+
+    def wrapper(callback):
+        wrapped.append(callback)
+        return ("wrapped", callback)
+
+    router = mailstr.ButtonRouter(mailstr.BUTTON_ROUTES[mailstr.CONFIG])
+    router.wrap_callbacks(wrapper)
+    assert len(wrapped) == len(set(wrapped))
+    assert set(wrapped) == {callback for callback, _ in mailstr.BUTTON_ROUTES[mailstr.CONFIG].values()}
+    assert router.routes["prime"] == (("wrapped", mailstr.choose_setting), mailstr.CONFIG)
+    # The shared table is left as it was
+    assert mailstr.BUTTON_ROUTES[mailstr.CONFIG]["prime"][0] is mailstr.choose_setting
+
+def test_every_button_shown_has_a_route():
+    for accumulate in (True, False):
+        labels = {button.text for row in mailstr.input_reply_markup(accumulate).keyboard for button in row}
+        assert labels <= set(mailstr.BUTTON_ROUTES[mailstr.INPUT_EMAILS])
+    labels = {button.callback_data for row in mailstr.output_reply_markup().inline_keyboard for button in row}
+    assert labels == set(mailstr.BUTTON_ROUTES[mailstr.CLEAR_MESSAGES])
+    assert all(set(routes) == labels for routes in mailstr.OUTPUT_BUTTON_ROUTES.values())
+    assert set(mailstr.OUTPUT_BUTTON_ROUTES) == set(mailstr.BUTTON_ROUTES)